@@ -1,4 +1,5 @@
 from flask import Flask
+from PIL import Image
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from .config import getConfig
@@ -14,19 +15,49 @@ def create_app(config):
     app = Flask(__name__)
     app.config.from_object(getConfig(config))  # get config
 
+    # pillow refuses to open images with more pixels than this, the limit is for the whole process
+    Image.MAX_IMAGE_PIXELS = app.config['MAX_IMAGE_PIXELS']
+
+    # the connection pool and the sqlite pragmas, unless the config already has its own engine options
+    from .database import engine_options, register_sqlite_pragmas
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
     # set up the db
     with app.app_context():
         db.init_app(app)
-        from .models import User, History
+        register_sqlite_pragmas(app, db.engine)
+        from .models import User, History, HistoryProb, PredictionJob
         db.create_all()
         db.session.commit()
     
     # and then the login manager
     login_manager.init_app(app)
     # while also set the user loader, as specified in their docs
+    # the user comes from a short lived cache per worker, so most requests don't query the user at all
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.filter(User.id == int(user_id)).first()
+        from .routes.functions import load_cached_user
+        return load_cached_user(int(user_id))
+
+    # the cli commands, like upgrading the database
+    from .commands import register_commands
+    register_commands(app)
+
+    # the timings of every request and its stages, for /metrics and the request log
+    from .metrics import register_metrics
+    register_metrics(app)
+
+    # hashed static urls, the compressed static files and the template cache
+    from .assets import register_assets
+    register_assets(app)
+
+    # purging the histories that are older than the retention, when there is one
+    from .retention import register_retention
+    register_retention(app)
+
+    # keeping the model server warm, and what /healthz reports
+    from .health import register_health
+    register_health(app)
 
     # get the routes blueprint
     from .routes import routes
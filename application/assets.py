@@ -0,0 +1,120 @@
+# static files and templates, made cheaper to serve
+#   the static urls get a hash of the file's content (?v=...), so the browser can keep them for good and a new deploy still gets the new files
+#   compressed copies of the static files (.gz, and .br when brotli is installed) are made once and sent to the browsers that take them
+#   the compiled templates are kept in a folder that all the workers share, so a new worker doesn't have to compile them again
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+from flask import Flask, current_app, request, send_from_directory, abort
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import safe_join
+
+try:
+    import brotli       # optional, only gzip is made without it
+except ImportError:
+    brotli = None
+
+# the files worth compressing, the images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+# the compressed copies, in the order they are preferred
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# hashes of the static files by name, worked out again only when the file changes
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+def static_hash(path) -> str | None:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    with _hashes_lock:
+        cached = _hashes.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _hashes_lock:
+        _hashes[path] = (mtime, digest)
+    return digest
+
+# url_for('static', ...) adds the hash of the file
+def add_static_hash(endpoint, values) -> None:
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        path = safe_join(current_app.static_folder, values['filename'])
+        digest = static_hash(path) if path else None
+        if digest:
+            values['v'] = digest
+
+# takes the place of flask's own static view: sends the compressed copy if the browser takes it,
+# and when the url has the hash of the file as it is now, lets the browser keep it for good
+def send_static(filename):
+    folder = current_app.static_folder
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    for encoding, extension in ENCODINGS:
+        if encoding in request.accept_encodings and os.path.isfile(path + extension):
+            response = send_from_directory(folder, filename + extension, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(folder, filename)
+    response.vary.add('Accept-Encoding')
+
+    if request.args.get('v') and request.args.get('v') == static_hash(path):
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+# make the compressed copies of the static files, skipping the ones that are already up to date
+# returns the paths that were written
+def compress_static(folder) -> list:
+    written = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            copies = {'.gz' : lambda: gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                copies['.br'] = lambda: brotli.compress(data, quality=11)
+
+            for extension, compress in copies.items():
+                if os.path.isfile(path + extension) and os.path.getmtime(path + extension) >= os.path.getmtime(path):
+                    continue
+                compressed = compress()
+                # not worth it when it barely gets any smaller
+                if len(compressed) >= len(data) * 0.9:
+                    continue
+                with open(path + extension, 'wb') as f:
+                    f.write(compressed)
+                written.append(path + extension)
+    return written
+
+# compile every template into the bytecode cache, so not even the first request after a deploy has to
+def compile_templates(app: Flask) -> int:
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+def register_assets(app: Flask) -> None:
+    app.url_defaults(add_static_hash)
+    if app.has_static_folder:
+        app.view_functions['static'] = send_static
+
+    # the jinja environment is only made on first use, so the cache has to be in the options before that
+    if app.config['JINJA_CACHE_DIR']:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR']))
@@ -0,0 +1,77 @@
+# a small thread safe in-process cache, least recently used items get evicted first
+# items can also expire after ttl seconds, and the total size can be capped with max_bytes (measured by sizeof)
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    def __init__(self, max_items=1024, ttl=None, max_bytes=None, sizeof=len) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._items = OrderedDict()     # key -> (expiry, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # counters, to see if the cache is actually doing anything
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+
+            # expired items are treated as if they aren't there
+            if item is not None and item[0] is not None and item[0] < time.monotonic():
+                self._remove(key)
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[2]
+
+    def set(self, key, value) -> None:
+        # nothing is kept at all when the cache is sized to 0
+        if self.max_items <= 0:
+            return
+
+        size = self.sizeof(value) if self.max_bytes else 0
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (expiry, size, value)
+            self._bytes += size
+
+            # then evict from the least recently used end until it fits again
+            while len(self._items) > self.max_items or (self.max_bytes and self._bytes > self.max_bytes and len(self._items) > 1):
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            self._remove(key)
+            return item[2]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def _remove(self, key) -> None:
+        self._bytes -= self._items.pop(key)[1]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        return {'items' : len(self._items), 'bytes' : self._bytes, 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions}
@@ -0,0 +1,98 @@
+# flask cli commands, run them with flask --app "app:create_app('PROD')" <command>
+import click
+from flask import Flask
+from . import db
+
+def register_commands(app: Flask) -> None:
+
+    # upgrade a database made by an older version of the app, should be run before starting the new version
+    @app.cli.command('upgrade-db')
+    @click.option('--vacuum', is_flag=True, help='Reclaim the space freed by the upgrade (sqlite only)')
+    def upgrade_db(vacuum):
+        from .migrations import upgrade_database
+
+        summary = upgrade_database()
+        for name, value in summary.items():
+            click.echo(f'{name}: {value}')
+
+        if vacuum and db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('vacuum')
+            click.echo('vacuumed')
+
+    # re-encode the history images still stored as raw rgb bytes into HISTORY_IMAGE_FORMAT (or the given format), to save space
+    # the original bytes are gone afterwards, so this is never done by upgrade-db
+    @app.cli.command('reencode-images')
+    @click.option('--format', 'image_format', type=click.Choice(['png', 'webp', 'gray']), help='The format to store them in, HISTORY_IMAGE_FORMAT by default')
+    @click.confirmation_option(prompt='The raw images are replaced for good, continue?')
+    def reencode_images(image_format):
+        from .migrations import migrate_history_images
+
+        click.echo(f'history_images: {migrate_history_images(image_format)}')
+
+    # make the compressed copies of the static files and compile the templates into the shared cache, should be run after every deploy
+    @app.cli.command('build-assets')
+    def build_assets():
+        from .assets import compress_static, compile_templates
+
+        written = compress_static(app.static_folder)
+        click.echo(f'compressed: {len(written)} files')
+        if app.config['JINJA_CACHE_DIR']:
+            click.echo(f'compiled: {compile_templates(app)} templates')
+
+    # purge the histories older than the retention once, for running from cron instead of (or as well as) the workers' own purging
+    # along with the finished jobs older than JOB_RETENTION_HOURS
+    @app.cli.command('purge-history')
+    @click.option('--days', type=int, help='Purge the histories older than this many days, HISTORY_RETENTION_DAYS by default')
+    @click.option('--archive-dir', help='Write the purged histories into this folder first, RETENTION_ARCHIVE_DIR by default')
+    def purge_history(days, archive_dir):
+        import datetime
+        from .retention import purge_histories, purge_jobs
+
+        days = days if days is not None else app.config['HISTORY_RETENTION_DAYS']
+        if days <= 0:
+            raise click.UsageError('No retention, set HISTORY_RETENTION_DAYS or pass --days')
+        before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+        purged = purge_histories(before, archive_dir=archive_dir or app.config['RETENTION_ARCHIVE_DIR'])
+        click.echo(f'purged: {purged} histories')
+
+        if app.config['JOB_RETENTION_HOURS'] > 0:
+            before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=app.config['JOB_RETENTION_HOURS'])
+            click.echo(f'purged: {purge_jobs(before)} jobs')
+
+    # replay a mix of traffic against a running instance and report the throughput, latency and errors of each action
+    # the users are seeded into the database of this config, so it has to be the same database the instance uses
+    @app.cli.command('bench')
+    @click.option('--url', default='http://127.0.0.1:5000', show_default=True, help='Address of the running instance')
+    @click.option('--concurrency', default=4, show_default=True, help='Client threads, each one a signed in user')
+    @click.option('--duration', default=30.0, show_default=True, help='Seconds to run for')
+    @click.option('--users', default=4, show_default=True, help='Users to seed and sign in as')
+    @click.option('--histories', default=50, show_default=True, help='Histories to seed for each user')
+    @click.option('--images', default='./tests/test_veg_images', show_default=True, help='Folder of the images to upload')
+    @click.option('--mix', multiple=True, help='Weight of an action as name=weight, e.g. --mix delete=0')
+    @click.option('--think', default=0.0, show_default=True, help='Seconds every client waits between requests')
+    @click.option('--output', help='Save the results as json')
+    def bench(url, concurrency, duration, users, histories, images, mix, think, output):
+        import json
+        from .loadtest import MIX, seed_users, run_load
+
+        weights = dict(MIX)
+        for item in mix:
+            name, _, weight = item.partition('=')
+            if name not in MIX or not weight.replace('.', '', 1).isdigit():
+                raise click.BadParameter(f'{item}, expected one of {", ".join(MIX)} with a weight', param_hint='--mix')
+            weights[name] = float(weight)
+
+        emails = seed_users(users, histories, images)
+        click.echo(f'seeded {len(emails)} users, running {concurrency} clients against {url} for {duration:g}s')
+        results = run_load(url, emails, images, concurrency, duration, {name : weight for name, weight in weights.items() if weight > 0}, think)
+
+        click.echo(f'{"action":<12} {"requests":>8} {"req/s":>8} {"errors":>7} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8}')
+        for action, r in results.items():
+            if r['requests']:
+                click.echo(f'{action:<12} {r["requests"]:>8} {r["requests_per_second"]:>8.1f} {r["error_rate"]:>7.1%} '
+                           f'{r["p50_ms"]:>8.1f} {r["p90_ms"]:>8.1f} {r["p99_ms"]:>8.1f}')
+
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,57 @@
+# tuning of the database connections, from the settings in the config
+# sqlite gets its pragmas set on every new connection, and any database that is not in memory gets a sized connection pool
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# the engine options for the database the app is configured with, these go into SQLALCHEMY_ENGINE_OPTIONS
+# an in memory sqlite database is a single connection shared by everything, so there's no pool to size
+def engine_options(config) -> dict:
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    return {
+        'pool_size' : config['DB_POOL_SIZE'],
+        'max_overflow' : config['DB_MAX_OVERFLOW'],
+        'pool_timeout' : config['DB_POOL_TIMEOUT'],
+        'pool_recycle' : config['DB_POOL_RECYCLE'],
+        'pool_pre_ping' : config['DB_POOL_PRE_PING']
+    }
+
+# the pragmas every new sqlite connection gets, the busy timeout first so that switching to wal can wait for the other workers too
+# and auto vacuum before wal, since it has to be set before the first table is made to take on a new database
+def sqlite_pragmas(config) -> list:
+    return [
+        f"pragma busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}",
+        f"pragma auto_vacuum = {config['SQLITE_AUTO_VACUUM']}",
+        f"pragma journal_mode = {config['SQLITE_JOURNAL_MODE']}",
+        f"pragma synchronous = {config['SQLITE_SYNCHRONOUS']}",
+        f"pragma cache_size = {int(config['SQLITE_CACHE_SIZE'])}",
+        f"pragma mmap_size = {int(config['SQLITE_MMAP_SIZE'])}"
+    ]
+
+# set the pragmas on every connection the engine makes, for sqlite only
+def register_sqlite_pragmas(app: Flask, engine) -> None:
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(app.config)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+# hand the pages freed by deleting back to the disk, sqlite only since the database servers do this on their own
+# this is a no-op unless auto vacuum is incremental, and the wal is truncated too so it doesn't stay as big as the deletes made it
+def reclaim_space(engine) -> None:
+    if engine.dialect.name != 'sqlite':
+        return
+    # incremental vacuum frees a page on every step, and only a script is stepped through to the end by the driver
+    connection = engine.raw_connection()
+    try:
+        connection.driver_connection.executescript('pragma incremental_vacuum; pragma wal_checkpoint(truncate);')
+    finally:
+        connection.close()
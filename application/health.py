@@ -0,0 +1,114 @@
+# keeping the model server warm and telling whoever asks (the load balancer, a monitor) whether this worker is ready
+# the model server sleeps when it's idle and takes a while to wake up, so every worker pings each of its models
+# with a tiny prediction when it starts and then every MODEL_KEEPALIVE_INTERVAL seconds. The pings go through the circuit breaker
+# like any other prediction, so once the cooldown is over a ping is the probe and the breaker can close again without a user waiting on it
+import os
+import time
+import datetime
+import threading
+import numpy as np
+from flask import Flask, current_app
+from sqlalchemy import text
+from . import db
+from .config import get_setting
+from .inference import get_backend
+
+# the models that are on the model server, the others don't have anything to warm up
+def remote_models() -> list:
+    return [model for model, settings in get_setting('MODEL_BACKENDS').items() if settings.get('type', 'remote') == 'remote']
+
+class ModelWarmer(object):
+    def __init__(self, app) -> None:
+        self.app = app
+        self.pings = {}         # model -> the result of its last ping
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # the thread is started by the first request of every worker, a forked worker doesn't get the parent's thread
+    def ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop, daemon=True, name='model-keepalive').start()
+
+    def _loop(self) -> None:
+        while True:
+            self.ping_all()
+            time.sleep(self.app.config['MODEL_KEEPALIVE_INTERVAL'])
+
+    # predict a blank image with the model, and keep how that went
+    def ping(self, model) -> dict:
+        model_input_size = int(model.split('_')[1])
+        start = time.perf_counter()
+        with self.app.app_context():
+            try:
+                get_backend(model_input_size).predict(np.zeros((1, model_input_size, model_input_size, 1), dtype=np.float32))
+                error = None
+            except Exception as e:
+                error = str(e)
+
+        self.pings[model] = {
+            'ok' : error is None,
+            'at' : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'latency_ms' : round((time.perf_counter() - start) * 1000, 3),
+            'error' : error
+        }
+
+        # and the version the model server serves, here so that the requests have it without ever waiting on it
+        if error is None:
+            with self.app.app_context():
+                get_backend(model_input_size).refresh_version()
+        return self.pings[model]
+
+    def ping_all(self) -> dict:
+        with self.app.app_context():
+            models = remote_models()
+        return {model : self.ping(model) for model in models}
+
+
+def register_health(app: Flask) -> None:
+    warmer = app.extensions['model_warmer'] = ModelWarmer(app)
+    if app.config['MODEL_KEEPALIVE_INTERVAL'] > 0:
+        app.before_request(warmer.ensure_started)
+
+# whether the database and each model can be used by this worker right now, nothing here waits on the model server:
+# the models are as ready as their circuit breakers say, along with how their last ping went
+# a worker whose database isn't ready can't do anything, while one whose models aren't ready still has everything but predicting,
+# so only the database makes it unhealthy and the models make it degraded. Returns the report and whether the worker is healthy
+def check_health() -> tuple:
+    start = time.perf_counter()
+    try:
+        db.session.execute(text('select 1'))
+        database = {'ready' : True, 'latency_ms' : round((time.perf_counter() - start) * 1000, 3)}
+    except Exception as error:
+        db.session.rollback()
+        database = {'ready' : False, 'error' : str(error)}
+
+    warmer = current_app.extensions.get('model_warmer')
+    models = {}
+    for model, settings in get_setting('MODEL_BACKENDS').items():
+        status = {'backend' : settings.get('type', 'remote')}
+        try:
+            backend = get_backend(int(model.split('_')[1]))
+        except Exception as error:
+            # like a local model whose file isn't there
+            models[model] = dict(status, ready=False, error=str(error))
+            continue
+
+        status['ready'] = backend.available()
+        breaker = getattr(backend, 'breaker', None)
+        if breaker is not None:
+            status['circuit'] = breaker.status()
+        if warmer is not None and model in warmer.pings:
+            status['last_ping'] = warmer.pings[model]
+        models[model] = status
+
+    if not database['ready']:
+        state = 'unhealthy'
+    elif not all(status['ready'] for status in models.values()):
+        state = 'degraded'
+    else:
+        state = 'ok'
+    return {'status' : state, 'database' : database, 'models' : models}, database['ready']
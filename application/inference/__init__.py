@@ -0,0 +1,6 @@
+# everything to do with getting a prediction out of the models, kept apart from the routes
+from .encoders import Encoder, ENCODERS, get_encoder, detect_encoder
+from .backends import InferenceBackend, RemoteBackend, LocalBackend, FakeBackend, NumpyEngine, export_keras_model, create_backend, get_backend, get_session
+from .cache import PredictionCache, get_prediction_cache
+from .batching import MicroBatcher, BatchingBackend
+from .breaker import CircuitBreaker, CircuitOpenError, BreakerBackend
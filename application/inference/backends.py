@@ -0,0 +1,329 @@
+# the backends that actually run the models, each model size can use a different one (MODEL_BACKENDS in the config)
+#   remote: tf serving over rest, which is what the models were deployed with
+#   local:  the exported model loaded into this process, either with onnx runtime or the pure numpy engine below
+#   fake:   deterministic made up probabilities, so that everything else can be tested without any model
+# every backend takes a batch of shape (batch, pixels, pixels, 1) and returns the probabilities of shape (batch, labels)
+import os
+import json
+import time
+import zlib
+import threading
+import requests
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app, has_app_context
+from ..config import get_setting
+from .encoders import get_encoder
+
+NUM_LABELS = 15
+
+class InferenceBackend(object):
+    # the version of the model behind the backend, anything that caches predictions has to take it into account
+    # None when it isn't known, then the predictions can't be cached at all
+    version = None
+
+    # find out the version again, for the backends that have to ask for it. This can wait on the network, so it's only done
+    # off the request path: by the keep alive thread, or by the thread the version starts when it's out of date
+    def refresh_version(self) -> None:
+        pass
+
+    def predict(self, batch) -> np.ndarray:
+        raise NotImplementedError
+
+    # whether a prediction would be tried right now, only a backend behind an open circuit breaker says no
+    def available(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+# the session to the model server is created once per process and then reused, so the connections are kept alive
+# the pid is stored as well, since gunicorn forks the workers and a forked process must not share the parent's sockets
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            retries = get_setting('MODEL_SERVER_RETRIES')
+
+            # predicting has no side effects, so a POST is safe to retry when the request never reached the model,
+            # or when the proxy in front of it says it's not ready yet. Read timeouts are not retried as it will just hang again
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                backoff_factor=get_setting('MODEL_SERVER_BACKOFF'),
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(['POST']),
+                raise_on_status=False
+            )
+
+            # one connection per thread of the worker
+            pool_size = max(1, get_setting('MODEL_SERVER_POOL_SIZE'))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session, _session_pid = session, os.getpid()
+
+        return _session
+
+
+# tf serving over rest, the model is selected by its name in the url (and optionally a pinned version)
+class RemoteBackend(InferenceBackend):
+    def __init__(self, model, url, encoder='inputs', version=None) -> None:
+        self.pinned_version = version
+        self.encoder = get_encoder(encoder)
+        self.url = f'{url}/v1/models/{model}' + (f'/versions/{version}' if version else '') + ':predict'
+        self.status_url = f'{url}/v1/models/{model}'
+        self.timeout = (get_setting('MODEL_SERVER_CONNECT_TIMEOUT'), get_setting('MODEL_SERVER_READ_TIMEOUT'))
+        self.refresh = get_setting('MODEL_VERSION_REFRESH')
+        self._served_version = None
+        self._checked = None
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    # without a pinned version it's whichever version the model server serves, asked for again every MODEL_VERSION_REFRESH seconds
+    # so a model deployed again under the same name doesn't keep getting the old one's cached predictions
+    # this is read on the way to a prediction, so it never waits: it's the last version found out, and when that's out of date
+    # a thread asks again for the next predictions. Until the first answer it's None, and nothing is cached
+    @property
+    def version(self) -> str | None:
+        if self.pinned_version:
+            return self.pinned_version
+        if self._checked is None or time.monotonic() - self._checked >= self.refresh:
+            with self._lock:
+                # a forked worker doesn't get the parent's thread, so one that isn't alive here doesn't count
+                if (self._checked is None or time.monotonic() - self._checked >= self.refresh) and not (self._refresher and self._refresher.is_alive()):
+                    self._checked = time.monotonic()
+                    self._refresher = threading.Thread(target=self.refresh_version, daemon=True, name='model-version')
+                    self._refresher.start()
+        return self._served_version
+
+    def refresh_version(self) -> None:
+        if not self.pinned_version:
+            self._served_version = self.served_version()
+            self._checked = time.monotonic()
+
+    # the newest available version from tf serving's model status, None when it can't be had
+    def served_version(self) -> str | None:
+        try:
+            res = get_session().get(self.status_url, timeout=(self.timeout[0], min(self.timeout[1], 5)))
+            res.raise_for_status()
+            versions = [status['version'] for status in res.json()['model_version_status'] if status['state'] == 'AVAILABLE']
+        except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+            print(error)
+            return None
+        return max(versions, key=int) if versions else None
+
+    def predict(self, batch) -> np.ndarray:
+        header = {'Content-Type' : self.encoder.content_type}
+        res = get_session().post(self.url, self.encoder.encode(batch), headers=header, timeout=self.timeout)
+        res.raise_for_status()
+        return self.encoder.decode_predictions(res.content)
+
+
+# the layers, activations and settings the numpy engine can run, anything else is refused when the model is exported
+ENGINE_LAYERS = ('conv2d', 'maxpool2d', 'flatten', 'dense', 'dropout')
+ENGINE_ACTIVATIONS = ('linear', 'relu', 'softmax')
+
+# a setting that is either one number for both sides or a pair of them, like keras takes them
+def pair(value, default) -> tuple:
+    value = default if value is None else value
+    return tuple(value) if isinstance(value, (list, tuple)) else (value, value)
+
+# pad the height and width the way keras (tensorflow) does for same padding: the output is the input divided by the stride
+# rounded up, and when the padding is uneven the extra goes at the end
+def pad_same(x, window, strides, value=0.0) -> np.ndarray:
+    pads = []
+    for size, k, s in zip(x.shape[1:3], window, strides):
+        total = max((-(-size // s) - 1) * s + k - size, 0)
+        pads.append((total // 2, total - total // 2))
+    return np.pad(x, ((0, 0), pads[0], pads[1], (0, 0)), constant_values=value)
+
+# a tiny inference engine in numpy, for models exported with export_keras_model below
+# only the layers used by our cnn models are supported, which is good enough to drop the network hop for the small models
+class NumpyEngine(object):
+    def __init__(self, path) -> None:
+        weights = np.load(path)
+        self.layers = json.loads(str(weights['layers']))
+        self.weights = {name : weights[name].astype(np.float32) for name in weights.files if name != 'layers'}
+
+    def conv2d(self, x, i, layer) -> np.ndarray:
+        kernel, bias = self.weights[f'{i}/kernel'], self.weights.get(f'{i}/bias', 0)
+        kh, kw = kernel.shape[:2]
+        sh, sw = pair(layer.get('strides'), 1)
+        dh, dw = pair(layer.get('dilation_rate'), 1)
+        window = ((kh - 1) * dh + 1, (kw - 1) * dw + 1)     # how far the kernel reaches with the dilation
+        if layer.get('padding') == 'same':
+            x = pad_same(x, window, (sh, sw))
+
+        # every kernel sized window as a view, taking every stride-th window and every dilation-th pixel in it,
+        # and then one tensordot over the window and the input channels
+        windows = np.lib.stride_tricks.sliding_window_view(x, window, axis=(1, 2))     # (batch, h, w, in, kh, kw)
+        windows = windows[:, ::sh, ::sw, :, ::dh, ::dw]
+        return np.tensordot(windows, kernel, axes=([4, 5, 3], [0, 1, 2])) + bias
+
+    def maxpool2d(self, x, layer) -> np.ndarray:
+        ph, pw = pair(layer.get('pool_size'), 2)
+        sh, sw = pair(layer.get('strides'), (ph, pw))
+        if layer.get('padding') == 'same':
+            x = pad_same(x, (ph, pw), (sh, sw), -np.inf)
+
+        # the usual non overlapping pooling is just a reshape
+        if (sh, sw) == (ph, pw):
+            h, w = x.shape[1] // ph * ph, x.shape[2] // pw * pw
+            x = x[:, :h, :w]
+            return x.reshape(x.shape[0], h // ph, ph, w // pw, pw, x.shape[3]).max(axis=(2, 4))
+
+        windows = np.lib.stride_tricks.sliding_window_view(x, (ph, pw), axis=(1, 2))[:, ::sh, ::sw]
+        return windows.max(axis=(4, 5))
+
+    def __call__(self, x) -> np.ndarray:
+        for i, layer in enumerate(self.layers):
+            kind = layer['type']
+            if kind == 'conv2d':
+                x = self.conv2d(x, i, layer)
+            elif kind == 'maxpool2d':
+                x = self.maxpool2d(x, layer)
+            elif kind == 'flatten':
+                x = x.reshape(x.shape[0], -1)
+            elif kind == 'dense':
+                x = x @ self.weights[f'{i}/kernel'] + self.weights[f'{i}/bias']
+            elif kind == 'dropout':
+                continue
+            else:
+                raise ValueError(f'Layer not supported: {kind}')
+
+            # the activations are fused into the layers the same way keras does it
+            activation = layer.get('activation', 'linear')
+            if activation == 'relu':
+                x = np.maximum(x, 0)
+            elif activation == 'softmax':
+                x = np.exp(x - x.max(axis=-1, keepdims=True))
+                x /= x.sum(axis=-1, keepdims=True)
+        return x
+
+# save a keras model into the format the numpy engine loads, this has to be run wherever tensorflow is installed
+# anything the engine can't run exactly is refused here, rather than making a model that gives the wrong predictions
+def export_keras_model(model, path) -> None:
+    layers, weights = [], {}
+    for i, keras_layer in enumerate(model.layers):
+        config = keras_layer.get_config()
+        kind = type(keras_layer).__name__.lower().replace('maxpooling2d', 'maxpool2d')
+        if kind not in ENGINE_LAYERS:
+            raise ValueError(f'Layer not supported: {type(keras_layer).__name__}')
+
+        layer = {'type' : kind, 'activation' : config.get('activation', 'linear')}
+        if layer['activation'] not in ENGINE_ACTIVATIONS:
+            raise ValueError(f'Activation not supported: {layer["activation"]} in {config.get("name", kind)}')
+        if config.get('data_format') not in (None, 'channels_last'):
+            raise ValueError(f'Only channels_last is supported: {config.get("name", kind)}')
+        if config.get('padding') not in (None, 'valid', 'same'):
+            raise ValueError(f'Padding not supported: {config["padding"]} in {config.get("name", kind)}')
+
+        if kind == 'conv2d':
+            if config.get('groups', 1) != 1:
+                raise ValueError(f'Grouped convolutions are not supported: {config.get("name", kind)}')
+            layer['padding'] = config['padding']
+            layer['strides'] = list(pair(config.get('strides'), 1))
+            layer['dilation_rate'] = list(pair(config.get('dilation_rate'), 1))
+        if kind == 'maxpool2d':
+            layer['pool_size'] = list(pair(config.get('pool_size'), 2))
+            layer['strides'] = list(pair(config.get('strides'), layer['pool_size']))
+            layer['padding'] = config.get('padding', 'valid')
+
+        for name, value in zip(['kernel', 'bias'], keras_layer.get_weights()):
+            weights[f'{i}/{name}'] = value
+        layers.append(layer)
+
+    np.savez(path, layers=json.dumps(layers), **weights)
+
+# the model loaded into this process, onnx runtime is used when it's installed and the model is an .onnx file
+class LocalBackend(InferenceBackend):
+    def __init__(self, path, version=None) -> None:
+        self.version = version or str(os.path.getmtime(path))
+        if path.endswith('.onnx'):
+            import onnxruntime      # optional, only needed for onnx models
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+            self.engine = lambda batch: self.session.run(None, {self.input_name : batch})[0]
+        else:
+            self.engine = NumpyEngine(path)
+
+    def predict(self, batch) -> np.ndarray:
+        return np.asarray(self.engine(np.asarray(batch, dtype=np.float32)), dtype=np.float32)
+
+
+# deterministic probabilities made from a checksum of each image, the same image always gets the same prediction
+# latency (in seconds) can be added to stand in for a slow model
+class FakeBackend(InferenceBackend):
+    version = 'fake'
+
+    def __init__(self, latency=0) -> None:
+        self.latency = latency
+
+    def predict(self, batch) -> np.ndarray:
+        if self.latency:
+            time.sleep(self.latency)
+
+        preds = []
+        for image in np.asarray(batch, dtype=np.float32):
+            logits = np.random.default_rng(zlib.crc32(image.tobytes())).normal(0, 3, NUM_LABELS)
+            probs = np.exp(logits - logits.max())
+            preds.append(probs / probs.sum())
+        return np.asarray(preds, dtype=np.float32)
+
+
+# make a backend out of its settings in the config
+def create_backend(model, settings) -> InferenceBackend:
+    kind = settings.get('type', 'remote')
+    if kind == 'remote':
+        return RemoteBackend(model, settings.get('url') or get_setting('MODEL_SERVER_URL'), settings.get('encoder', 'inputs'), settings.get('version'))
+    elif kind == 'local':
+        return LocalBackend(settings['path'], settings.get('version'))
+    elif kind == 'fake':
+        return FakeBackend(settings.get('latency', 0))
+    else:
+        raise ValueError(f'Backend does not exists: {kind}')
+
+# the backends are made once and kept, per app when there's one, otherwise per process
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend(model_input_size) -> InferenceBackend:
+    model = f'model_{model_input_size}'
+    backends = current_app.extensions.setdefault('inference_backends', {}) if has_app_context() else _backends
+
+    with _backends_lock:
+        if model not in backends:
+            settings = get_setting('MODEL_BACKENDS')[model]
+            backend = create_backend(model, settings)
+
+            # concurrent predictions for the same model get batched together, when turned on
+            if get_setting('MODEL_BATCHING'):
+                from .batching import BatchingBackend
+                backend = BatchingBackend(backend, get_setting('MODEL_BATCH_SIZE'), get_setting('MODEL_BATCH_WINDOW_MS') / 1000)
+
+            # and the model server goes behind a circuit breaker, outside of the batching so an open one doesn't even queue
+            if settings.get('type', 'remote') == 'remote' and get_setting('MODEL_BREAKER_ENABLED'):
+                from .breaker import CircuitBreaker, BreakerBackend
+                breaker = CircuitBreaker(
+                    model,
+                    get_setting('MODEL_BREAKER_WINDOW'),
+                    get_setting('MODEL_BREAKER_MIN_REQUESTS'),
+                    get_setting('MODEL_BREAKER_ERROR_RATE'),
+                    get_setting('MODEL_BREAKER_COOLDOWN')
+                )
+                backend = BreakerBackend(backend, breaker)
+
+            backends[model] = backend
+        return backends[model]
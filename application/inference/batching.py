@@ -0,0 +1,116 @@
+# dynamic micro batching: predictions for the same model that come in at about the same time get sent as one batch
+# a request waits at most max_wait seconds for others to join it, or until the batch is full, and then each one gets its own row back
+# this only helps when a worker handles more than one request at a time (gunicorn threads), otherwise there's nobody to batch with
+import os
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future
+from .backends import InferenceBackend
+
+class MicroBatcher(object):
+    def __init__(self, backend, max_batch_size=16, max_wait=0.005) -> None:
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        # how many batches were sent and how many images went in them
+        self.batches = self.images = 0
+
+    # the thread is started on first use, and again after a fork since threads don't survive it
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def submit(self, tensor) -> Future:
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((np.asarray(tensor, dtype=np.float32), future))
+        return future
+
+    def _run(self) -> None:
+        while True:
+            # wait for the first one, and from then on only wait until the window closes
+            item = self._queue.get()
+            if item is None:
+                return
+            pending = [item]
+            size = item[0].shape[0]
+            deadline = time.monotonic() + self.max_wait
+
+            while size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)   # finish this batch first, then stop
+                    break
+                pending.append(item)
+                size += item[0].shape[0]
+
+            self._send(pending)
+
+    def _send(self, pending) -> None:
+        try:
+            preds = self.backend.predict(np.concatenate([tensor for tensor, _ in pending]))
+        except Exception as error:
+            # everyone in the batch gets the same error
+            for _, future in pending:
+                future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.images += len(preds)
+
+        # then fan the rows back out to whoever asked for them
+        start = 0
+        for tensor, future in pending:
+            future.set_result(preds[start:start + tensor.shape[0]])
+            start += tensor.shape[0]
+
+    def close(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+
+# a backend that goes through the batcher, so nothing else has to know that batching is happening
+class BatchingBackend(InferenceBackend):
+    def __init__(self, backend, max_batch_size=16, max_wait=0.005, timeout=None) -> None:
+        self.backend = backend
+        self.timeout = timeout
+        self.batcher = MicroBatcher(backend, max_batch_size, max_wait)
+
+    def predict(self, batch) -> np.ndarray:
+        # something that is already a full batch can just go straight through
+        if batch.shape[0] >= self.batcher.max_batch_size:
+            return self.backend.predict(batch)
+        return self.batcher.submit(batch).result(self.timeout)
+
+    @property
+    def version(self) -> str | None:
+        return self.backend.version
+
+    def refresh_version(self) -> None:
+        self.backend.refresh_version()
+
+    def available(self) -> bool:
+        return self.backend.available()
+
+    def close(self) -> None:
+        self.batcher.close()
+        self.backend.close()
@@ -0,0 +1,133 @@
+# a circuit breaker for the model server, so that when it's down (or still waking up) the requests fail straight away
+# instead of every one of them waiting for the timeouts and the retries, and holding up a gunicorn worker all that time
+#   closed:    everything goes through, the last few results are kept and too many failures among them opens it
+#   open:      everything fails with CircuitOpenError until the cooldown is over
+#   half open: one request at a time goes through as a probe, it closes the breaker when it works and opens it again when it doesn't
+# every worker has its own breakers, they each find out on their own that the model server is down (or back)
+import time
+import threading
+from collections import deque
+import numpy as np
+import requests
+from .backends import InferenceBackend
+
+class CircuitOpenError(Exception):
+    pass
+
+# a request the model server answered with a 4xx says something about the request, not about the model server
+def is_failure(error) -> bool:
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return True
+
+class CircuitBreaker(object):
+    def __init__(self, name, window=20, min_requests=5, error_rate=0.5, cooldown=30) -> None:
+        self.name = name
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.trips = 0              # how many times it opened
+        self.rejected = 0           # how many calls failed fast because of it
+        self._results = deque(maxlen=window)    # True for every call that worked, False for every one that failed
+        self._opened = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        self.state = 'open'
+        self.trips += 1
+        self._opened = time.monotonic()
+        self._results.clear()
+
+    # how many seconds until the next probe is let through, 0 when calls go through now
+    def _retry_after(self) -> float:
+        return max(self.cooldown - (time.monotonic() - self._opened), 0) if self.state == 'open' else 0
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return self._retry_after()
+
+    # whether a call would go through right now, without letting one through
+    def available(self) -> bool:
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() - self._opened >= self.cooldown
+            return not (self.state == 'half_open' and self._probing)
+
+    # let a call through or raise CircuitOpenError, returns whether the call is the probe
+    def before_call(self) -> bool:
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened >= self.cooldown:
+                self.state = 'half_open'
+            if self.state == 'open' or (self.state == 'half_open' and self._probing):
+                self.rejected += 1
+                raise CircuitOpenError(f'The model server for {self.name} is not available right now')
+            if self.state == 'half_open':
+                self._probing = True
+                return True
+            return False
+
+    # the result of a call that was let through. A call that was let through before the breaker opened and finishes after
+    # doesn't count, only the probe decides what happens to an open breaker
+    def record(self, ok, probe=False) -> None:
+        with self._lock:
+            if probe:
+                self._probing = False
+                if ok:
+                    self.state = 'closed'
+                    self._results.clear()
+                else:
+                    self._open()
+                return
+            if self.state != 'closed':
+                return
+
+            self._results.append(ok)
+            failures = len(self._results) - sum(self._results)
+            if len(self._results) >= self.min_requests and failures / len(self._results) >= self.error_rate:
+                self._open()
+
+    def call(self, fn, *args):
+        probe = self.before_call()
+        try:
+            result = fn(*args)
+        except Exception as error:
+            self.record(not is_failure(error), probe)
+            raise
+        self.record(True, probe)
+        return result
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'state' : self.state,
+                'recent_requests' : len(self._results),
+                'recent_failures' : len(self._results) - sum(self._results),
+                'retry_after' : round(self._retry_after(), 3),
+                'trips' : self.trips,
+                'rejected' : self.rejected
+            }
+
+
+# a backend that goes through the breaker, so nothing else has to know about it
+class BreakerBackend(InferenceBackend):
+    def __init__(self, backend, breaker) -> None:
+        self.backend = backend
+        self.breaker = breaker
+
+    @property
+    def version(self) -> str | None:
+        return self.backend.version
+
+    def refresh_version(self) -> None:
+        self.backend.refresh_version()
+
+    def predict(self, batch) -> np.ndarray:
+        return self.breaker.call(self.backend.predict, batch)
+
+    def available(self) -> bool:
+        return self.breaker.available()
+
+    def close(self) -> None:
+        self.backend.close()
@@ -0,0 +1,131 @@
+# cache of predictions, so the same image sent to the same model doesn't have to go to the model again
+# the key is a hash of the preprocessed tensor together with the model and its version, so it's the content that matters, not the file
+# there are two tiers: an lru in this process, and optionally a sqlite file that all the gunicorn workers share
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from flask import current_app, has_app_context
+from ..cache import LRUCache
+from ..config import get_setting
+
+# the shared tier, a single table in its own sqlite file so it never gets in the way of the main database
+class SharedPredictionStore(object):
+    def __init__(self, path, max_items, ttl) -> None:
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self._local = threading.local()     # sqlite connections can't be shared between threads
+        self._writes = 0
+
+        with self._connect() as conn:
+            conn.execute('create table if not exists prediction_cache (key text primary key, probs blob not null, created real not null)')
+            conn.execute('create index if not exists ix_prediction_cache_created on prediction_cache (created)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute('select probs, created from prediction_cache where key = ?', (key,)).fetchone()
+        if row is None or (self.ttl and row[1] < time.time() - self.ttl):
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def set(self, key, probs) -> None:
+        conn = self._connect()
+        conn.execute('insert or replace into prediction_cache (key, probs, created) values (?, ?, ?)',
+                     (key, np.asarray(probs, dtype=np.float32).tobytes(), time.time()))
+
+        # every now and then, drop whatever has expired and then the oldest rows over the limit
+        self._writes += 1
+        if self._writes % 100 == 0:
+            if self.ttl:
+                conn.execute('delete from prediction_cache where created < ?', (time.time() - self.ttl,))
+            conn.execute('delete from prediction_cache where key in (select key from prediction_cache order by created desc limit -1 offset ?)', (self.max_items,))
+
+
+class PredictionCache(object):
+    def __init__(self, max_items=1024, ttl=None, shared_path=None, shared_max_items=100000) -> None:
+        self.local = LRUCache(max_items, ttl)
+        self.shared = SharedPredictionStore(shared_path, shared_max_items, ttl) if shared_path else None
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.local.max_items > 0 or self.shared is not None
+
+    # hash of the exact tensor the model would get, plus which model and which version of it
+    @staticmethod
+    def key(tensor, model, version) -> str:
+        digest = hashlib.sha256(np.ascontiguousarray(tensor, dtype=np.float32).tobytes())
+        digest.update(f'|{model}|{version}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        probs = self.local.get(key)
+        if probs is not None or self.shared is None:
+            return probs
+
+        # the shared tier is only a bonus, so if the file is locked or broken just carry on without it
+        try:
+            probs = self.shared.get(key)
+        except sqlite3.Error:
+            self.shared_errors += 1
+            return None
+
+        # and keep it locally as well for the next time
+        if probs is not None:
+            self.shared_hits += 1
+            self.local.set(key, probs)
+        return probs
+
+    def set(self, key, probs) -> None:
+        probs = np.asarray(probs, dtype=np.float32)
+        self.local.set(key, probs)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, probs)
+            except sqlite3.Error:
+                self.shared_errors += 1
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['misses'] -= self.shared_hits      # a local miss that the shared tier had is still a hit overall
+        stats['shared_errors'] = self.shared_errors
+        return stats
+
+
+# same as the backends, one cache per app when there's one, otherwise one per process
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_prediction_cache() -> PredictionCache:
+    global _cache
+
+    with _cache_lock:
+        if has_app_context() and 'prediction_cache' in current_app.extensions:
+            return current_app.extensions['prediction_cache']
+        if not has_app_context() and _cache is not None:
+            return _cache
+
+        cache = PredictionCache(
+            get_setting('PREDICTION_CACHE_SIZE'),
+            get_setting('PREDICTION_CACHE_TTL'),
+            get_setting('PREDICTION_CACHE_PATH'),
+            get_setting('PREDICTION_CACHE_SHARED_SIZE')
+        )
+        if has_app_context():
+            current_app.extensions['prediction_cache'] = cache
+        else:
+            _cache = cache
+        return cache
@@ -0,0 +1,171 @@
+# encoders for the payload sent to the model server, and for the predictions that come back
+# each remote model picks its own encoder in the config (MODEL_BACKENDS[...]['encoder'], from MODEL_31_ENCODER/MODEL_128_ENCODER), depending on what the serving side accepts
+import json
+import base64
+import struct
+import numpy as np
+
+# the base encoder, every encoder has to be able to do both sides of the wire
+# so that the same classes can be used by a stand-in model server as well
+class Encoder(object):
+    name = None
+    content_type = 'application/json'
+
+    # client side: tensor of shape (batch, pixels, pixels, 1) -> request body
+    def encode(self, tensor) -> bytes:
+        raise NotImplementedError
+
+    # client side: response body -> array of shape (batch, labels)
+    def decode_predictions(self, body) -> np.ndarray:
+        raise NotImplementedError
+
+    # server side: request body -> tensor
+    def decode(self, body) -> np.ndarray:
+        raise NotImplementedError
+
+    # server side: predictions -> response body
+    def encode_predictions(self, preds) -> bytes:
+        raise NotImplementedError
+
+
+# the original format, tf serving's row based "instances" with every float written out in full
+class InstancesEncoder(Encoder):
+    name = 'instances'
+
+    def encode(self, tensor) -> bytes:
+        return json.dumps({
+            'signature_name' : 'serving_default',
+            'instances' : tensor.tolist()
+        }).encode()
+
+    def decode_predictions(self, body) -> np.ndarray:
+        return np.asarray(json.loads(body)['predictions'], dtype=np.float32)
+
+    def decode(self, body) -> np.ndarray:
+        return np.asarray(json.loads(body)['instances'], dtype=np.float32)
+
+    def encode_predictions(self, preds) -> bytes:
+        return json.dumps({'predictions' : np.asarray(preds).tolist()}).encode()
+
+
+# tf serving's columnar "inputs" format, still json so any tf serving accepts it, but much more compact
+# the transformer always produces pixel / 255, so each of the 256 possible values is written from a lookup table
+# with 5 decimals instead of asking json to print 17 digits for every single pixel
+class ColumnarEncoder(Encoder):
+    name = 'inputs'
+    decimals = 5
+    _table = [f'{k / 255:.5f}'.rstrip('0').rstrip('.') for k in range(256)]
+
+    def encode(self, tensor) -> bytes:
+        quantised = np.rint(tensor * 255)
+
+        # if it's not made out of pixel / 255 values, then just round it and let json do the writing
+        if not np.allclose(quantised / 255, tensor, atol=1e-6):
+            inputs = json.dumps(np.round(tensor.astype(np.float64), self.decimals).tolist(), separators=(',', ':'))
+        else:
+            # build the nested lists row by row, each pixel is its own 1 channel list
+            images = []
+            for image in quantised.astype(np.uint8)[..., 0]:
+                rows = ['[[' + '],['.join(map(self._table.__getitem__, row)) + ']]' for row in image.tolist()]
+                images.append('[' + ','.join(rows) + ']')
+            inputs = '[' + ','.join(images) + ']'
+
+        return ('{"signature_name":"serving_default","inputs":' + inputs + '}').encode()
+
+    def decode_predictions(self, body) -> np.ndarray:
+        return np.asarray(json.loads(body)['outputs'], dtype=np.float32)
+
+    def decode(self, body) -> np.ndarray:
+        return np.asarray(json.loads(body)['inputs'], dtype=np.float32)
+
+    def encode_predictions(self, preds) -> bytes:
+        return json.dumps({'outputs' : np.asarray(preds).tolist()}).encode()
+
+
+# base64 of the raw tensor bytes, for models exported with a signature that takes in a string and decodes it
+# the shape and dtype are sent along since the string loses them. uint8 is 4 times smaller, and the model has to do the / 255 itself
+class Base64Encoder(ColumnarEncoder):
+    def __init__(self, dtype) -> None:
+        self.dtype = np.dtype(dtype)
+        self.name = f'b64_{self.dtype.name}'
+
+    def encode(self, tensor) -> bytes:
+        if self.dtype == np.uint8:
+            tensor = np.rint(tensor * 255)
+        data = np.ascontiguousarray(tensor, dtype=self.dtype.newbyteorder('<')).tobytes()
+
+        return json.dumps({
+            'signature_name' : 'serving_default',
+            'inputs' : {
+                'image' : {'b64' : base64.b64encode(data).decode()},
+                'shape' : list(tensor.shape),
+                'dtype' : self.dtype.name
+            }
+        }, separators=(',', ':')).encode()
+
+    def decode(self, body) -> np.ndarray:
+        inputs = json.loads(body)['inputs']
+        data = base64.b64decode(inputs['image']['b64'])
+        tensor = np.frombuffer(data, dtype=self.dtype.newbyteorder('<')).reshape(inputs['shape']).astype(np.float32)
+        return tensor / 255 if self.dtype == np.uint8 else tensor
+
+
+# a small binary tensor format for backends that accept it, both ways:
+# magic, dtype code and number of dimensions, each dimension as uint32, then the raw little endian data
+class BinaryEncoder(Encoder):
+    name = 'binary'
+    content_type = 'application/octet-stream'
+    magic = b'TNSR'
+    dtypes = {0 : np.dtype('<f4'), 1 : np.dtype('<u1')}
+
+    def _pack(self, array) -> bytes:
+        code = 1 if array.dtype == np.uint8 else 0
+        array = np.ascontiguousarray(array, dtype=self.dtypes[code])
+        header = self.magic + struct.pack('<BB', code, array.ndim) + struct.pack(f'<{array.ndim}I', *array.shape)
+        return header + array.tobytes()
+
+    def _unpack(self, body) -> np.ndarray:
+        if body[:4] != self.magic:
+            raise ValueError('Not a binary tensor')
+        code, ndim = struct.unpack_from('<BB', body, 4)
+        shape = struct.unpack_from(f'<{ndim}I', body, 6)
+        return np.frombuffer(body, dtype=self.dtypes[code], offset=6 + 4 * ndim).reshape(shape)
+
+    def encode(self, tensor) -> bytes:
+        return self._pack(np.asarray(tensor, dtype=np.float32))
+
+    def decode_predictions(self, body) -> np.ndarray:
+        return self._unpack(body)
+
+    def decode(self, body) -> np.ndarray:
+        return self._unpack(body)
+
+    def encode_predictions(self, preds) -> bytes:
+        return self._pack(np.asarray(preds, dtype=np.float32))
+
+
+# all the encoders that can be selected from the config
+ENCODERS = {encoder.name : encoder for encoder in [
+    InstancesEncoder(),
+    ColumnarEncoder(),
+    Base64Encoder('uint8'),
+    Base64Encoder('float32'),
+    BinaryEncoder()
+]}
+
+def get_encoder(name) -> Encoder:
+    if name not in ENCODERS:
+        raise ValueError(f'Encoder does not exists: {name}')
+    return ENCODERS[name]
+
+# for the serving side, work out which encoder a request body was made with
+def detect_encoder(body) -> Encoder:
+    if body[:4] == BinaryEncoder.magic:
+        return ENCODERS['binary']
+
+    data = json.loads(body)
+    if 'instances' in data:
+        return ENCODERS['instances']
+    if isinstance(data['inputs'], dict):
+        return ENCODERS[f'b64_{data["inputs"]["dtype"]}']
+    return ENCODERS['inputs']
@@ -0,0 +1,91 @@
+# background prediction jobs, so the api can hand back a job id straight away instead of holding the request until the model answers
+# the jobs run on a thread pool in the worker that accepted them, while their status lives in the database
+# so that whichever gunicorn worker gets the polling request can answer it
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from . import db
+from .models import PredictionJob
+from .config import get_setting
+
+class JobRunner(object):
+    def __init__(self, app, workers) -> None:
+        self.app = app
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # the pool is made on first use, and again after a fork since the threads don't come along
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prediction-job')
+                self._pid = os.getpid()
+            return self._executor
+
+    # store the job as queued and then hand it to the pool, returns the job and the error from storing it (if any)
+    # the image is the decoded upload, the request will be long gone by the time the job runs
+    def submit(self, img, model_input_size, user_id=None):
+        from .routes.functions import add_entry
+
+        job = PredictionJob(id=uuid.uuid4().hex, user_id=user_id, model=str(model_input_size), status='queued')
+        error = add_entry(job)
+        if error is None:
+            self._get_executor().submit(self._run, job.id, img, model_input_size, user_id)
+        return job, error
+
+    def _run(self, job_id, img, model_input_size, user_id) -> None:
+        from .routes.functions import predict_and_save
+
+        with self.app.app_context():
+            job = db.session.get(PredictionJob, job_id)
+            job.status = 'running'
+            db.session.commit()
+
+            try:
+                # the same path as the prediction page, including storing it into the history
+                pred, probs, history, error = predict_and_save(img, model_input_size, user_id)
+
+                job.pred = pred
+                job.probs = probs[0]
+                if error:
+                    print(error)
+                    job.error = 'Error adding the predicted data into database.'
+                elif history is not None:
+                    job.history_id = history.id
+                job.status = 'done'
+            except Exception as error:
+                print(error)
+                db.session.rollback()
+                job = db.session.get(PredictionJob, job_id)
+                job.status = 'failed'
+                job.error = 'Error making the prediction'
+
+            db.session.commit()
+
+    def shutdown(self, wait=True) -> None:
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=wait)
+        self._executor = None
+
+
+# get the job runner of the current app, made on first use
+def get_job_runner() -> JobRunner:
+    if 'job_runner' not in current_app.extensions:
+        current_app.extensions['job_runner'] = JobRunner(current_app._get_current_object(), get_setting('JOB_WORKERS'))
+    return current_app.extensions['job_runner']
+
+# get the job, and if it's not finished yet, keep checking on it for up to wait seconds (long polling)
+def wait_for_job(job_id, wait=0):
+    deadline = time.monotonic() + min(wait, get_setting('JOB_MAX_WAIT'))
+    while True:
+        # always read it fresh, the job is updated by another thread or even another process
+        job = db.session.get(PredictionJob, job_id, populate_existing=True)
+        if job is None or job.status in ('done', 'failed') or time.monotonic() >= deadline:
+            return job
+        db.session.commit()     # end the read transaction, otherwise sqlite keeps showing the same snapshot
+        time.sleep(get_setting('JOB_POLL_INTERVAL'))
@@ -0,0 +1,187 @@
+# a load generator for a running instance of the website, to find out how many gunicorn workers and threads a deploy needs
+# every client thread is a signed in user going through a mix of what users do: predicting with both models, searching,
+# looking at a history and deleting one, and signing in again every now and then
+# the users (and a few histories for each) are seeded into the instance's database first, so it has to be run with the same config
+import os
+import re
+import time
+import random
+import threading
+import numpy as np
+import requests
+from PIL import Image
+from . import db
+from .models import User, History
+from .routes.functions import add_entry, add_entries, make_history, resize_image, LABELS
+
+# how often each action is picked, relative to the others
+MIX = {
+    'signin' : 5,
+    'predict_31' : 25,
+    'predict_128' : 25,
+    'search' : 20,
+    'history' : 20,
+    'delete' : 5
+}
+
+# the searches a user might do, picked at random
+SEARCHES = [
+    {'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0},
+    {'model' : '31 pixels model', 'prediction' : 'Any', 'prob_pred' : 50},
+    {'model' : 'Any', 'prediction' : 'Tomato', 'prob_pred' : 0},
+    {'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'label' : 'Bean', 'top_k' : 3},
+    {'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'max_margin' : 10}
+]
+
+PASSWORD = 'Loadtest12345$'
+
+# the ids of the histories on a page, from the view buttons of the search results
+HISTORY_ID = re.compile(r'action="/history/(\d+)"')
+
+def load_images(folder) -> list:
+    images = []
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), 'rb') as f:
+            images.append((name, f.read()))
+    return images
+
+# make the users that don't exist yet, and top up each one's histories to the given number, returns the emails
+def seed_users(count, histories, image_folder) -> list:
+    rng = np.random.default_rng(0)
+    images = []
+    for name, _ in load_images(image_folder):
+        with Image.open(os.path.join(image_folder, name)) as img:
+            images.append(img.convert('RGB'))
+
+    emails = []
+    for i in range(count):
+        email = f'loadtest{i}@loadtest.com'
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            user = User(email=email, password=PASSWORD)
+            error = add_entry(user)
+            if error:
+                raise error
+
+        missing = histories - History.query.filter_by(user_id=user.id).count()
+        entries = []
+        for j in range(max(missing, 0)):
+            model_input_size = (31, 128)[j % 2]
+            probs = rng.dirichlet(np.ones(len(LABELS)) * 0.3).tolist()
+            img = resize_image(images[j % len(images)], model_input_size)
+            entries.append(make_history(img, model_input_size, LABELS[int(np.argmax(probs))], probs, user.id))
+        if entries:
+            error = add_entries(entries)
+            if error:
+                raise error
+        emails.append(email)
+
+    db.session.remove()
+    return emails
+
+class LoadClient(object):
+    def __init__(self, url, email, images, rng) -> None:
+        self.url = url.rstrip('/')
+        self.email = email
+        self.images = images
+        self.rng = rng
+        self.history_ids = []       # the histories this user has seen in the search results, to view and delete
+        self.session = None
+
+    def signin(self) -> requests.Response:
+        self.session = requests.Session()
+        return self.session.post(f'{self.url}/signin', data={'email' : self.email, 'password' : PASSWORD}, allow_redirects=False)
+
+    def predict(self, model_input_size) -> requests.Response:
+        name, data = self.rng.choice(self.images)
+        return self.session.post(f'{self.url}/predict', files={'image' : (name, data)}, data={'model' : f'{model_input_size} pixels model'})
+
+    def search(self) -> requests.Response:
+        response = self.session.post(f'{self.url}/search', data=self.rng.choice(SEARCHES))
+        self.history_ids = HISTORY_ID.findall(response.text)
+        return response
+
+    def history(self) -> requests.Response:
+        return self.session.get(f'{self.url}/history/{self.rng.choice(self.history_ids)}')
+
+    def delete(self) -> requests.Response:
+        history_id = self.history_ids.pop(self.rng.randrange(len(self.history_ids)))
+        return self.session.post(f'{self.url}/delete_history/{history_id}', allow_redirects=False)
+
+    # do the action, and whether it worked: a sign in or a delete redirects, the pages show their errors with id="error"
+    # and any other page that redirects has sent a user whose session is gone back to the sign in page
+    # a user with no histories at hand to view or delete searches for them first, so returns the action that was really done
+    def act(self, action) -> tuple:
+        if action in ('history', 'delete') and not self.history_ids:
+            action = 'search'
+        if action == 'signin':
+            response = self.signin()
+        elif action.startswith('predict_'):
+            response = self.predict(int(action.split('_')[1]))
+        else:
+            response = getattr(self, action)()
+
+        if action in ('signin', 'delete'):
+            return action, response.status_code == 302
+        return action, response.status_code == 200 and not response.history and 'id="error"' not in response.text
+
+# time every request of every client thread until the time is up, returns the timings and errors by action
+def run_load(url, emails, image_folder, concurrency=4, duration=30, mix=None, think=0, seed=0) -> dict:
+    mix = mix or MIX
+    actions, weights = list(mix), list(mix.values())
+    images = load_images(image_folder)
+    samples = {action : [] for action in MIX}
+    errors = {action : 0 for action in MIX}
+    lock = threading.Lock()
+
+    def record(action, seconds, ok):
+        with lock:
+            samples[action].append(seconds)
+            errors[action] += not ok
+
+    def client_thread(i, deadline):
+        rng = random.Random(seed + i)
+        client = LoadClient(url, emails[i % len(emails)], images, rng)
+        action = 'signin'
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                action, ok = client.act(action)
+            except requests.RequestException:
+                ok = False
+            record(action, time.perf_counter() - start, ok)
+
+            if think:
+                time.sleep(think)
+            action = rng.choices(actions, weights)[0]
+
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=client_thread, args=(i, deadline)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return summarize_load(samples, errors, elapsed)
+
+# throughput, error rate and latency percentiles of every action and of all of them together
+def summarize_load(samples, errors, elapsed) -> dict:
+    summary = {}
+    everything = [seconds for action in samples for seconds in samples[action]]
+    for action, values in list(samples.items()) + [('total', everything)]:
+        count = len(values)
+        failed = sum(errors.values()) if action == 'total' else errors[action]
+        values = np.asarray(values) * 1000
+        summary[action] = {
+            'requests' : count,
+            'errors' : failed,
+            'error_rate' : failed / count if count else 0,
+            'requests_per_second' : count / elapsed,
+            'p50_ms' : float(np.percentile(values, 50)) if count else None,
+            'p90_ms' : float(np.percentile(values, 90)) if count else None,
+            'p99_ms' : float(np.percentile(values, 99)) if count else None,
+            'max_ms' : float(values.max()) if count else None
+        }
+    return summary
@@ -0,0 +1,245 @@
+# timings and counters of the stages that every request goes through, shown on /metrics in the prometheus text format
+# every process keeps its own numbers and writes them into a file of its own in METRICS_DIR every now and then,
+# so whichever gunicorn worker answers /metrics adds up the files of all the others to get the numbers of the whole server
+# every request also gets a log line in json with how long it took and how long each stage in it took
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from flask import Flask, current_app, g, has_request_context, request, before_render_template, template_rendered
+from .config import get_setting
+
+# the upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# every metric, with its type and what it is
+METRICS = {
+    'vegclf_stage_seconds' : ('histogram', 'Time spent in each stage of handling a request'),
+    'vegclf_request_seconds' : ('histogram', 'Time spent handling a request, by endpoint'),
+    'vegclf_requests_total' : ('counter', 'Requests handled, by endpoint, method and status'),
+    'vegclf_stage_errors_total' : ('counter', 'Stages that ended with an exception'),
+    'vegclf_cache_hits_total' : ('counter', 'Lookups the cache had the item for, by cache'),
+    'vegclf_cache_misses_total' : ('counter', 'Lookups the cache did not have the item for, by cache'),
+    'vegclf_cache_items' : ('gauge', 'Items kept in the cache, by cache')
+}
+
+# the caches whose numbers go on /metrics, by the name they are kept under in app.extensions
+CACHES = {
+    'user' : 'user_cache',
+    'image' : 'image_cache',
+    'prediction' : 'prediction_cache',
+    'similarity' : 'similarity_indexes'
+}
+
+logger = logging.getLogger('application.requests')
+
+class MetricsRegistry(object):
+    def __init__(self) -> None:
+        self.histograms = {}        # (name, labels) -> [bucket counts, sum, count]
+        self.counters = {}          # (name, labels) -> value
+        self.pid = os.getpid()
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+    # the numbers a forked worker inherits belong to the parent, so it starts over
+    def _check_fork(self) -> None:
+        if self.pid != os.getpid():
+            self.histograms, self.counters, self.pid, self._flushed = {}, {}, os.getpid(), 0
+
+    def observe(self, name, labels, seconds) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def inc(self, name, labels, value=1) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # for numbers that are counted somewhere else, like by the caches themselves
+    def set(self, name, labels, value) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_fork()
+            self.counters[key] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._check_fork()
+            return {
+                'histograms' : [[name, list(labels), buckets[:], total, count] for (name, labels), (buckets, total, count) in self.histograms.items()],
+                'counters' : [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            }
+
+    # write the numbers of this process into its file, at most once every interval seconds unless forced
+    def flush(self, folder, interval=0, force=False) -> None:
+        if not folder or (not force and time.monotonic() - self._flushed < interval):
+            return
+        self._flushed = time.monotonic()
+
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)      # so a reader never sees half a file
+
+
+_registry = MetricsRegistry()
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+# the numbers of every process added together: this one from memory, the others from their files
+def collect(folder=None) -> dict:
+    snapshots = [_registry.snapshot()]
+    if folder and os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if not name.endswith('.json') or name == f'{os.getpid()}.json':
+                continue
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue        # a worker that's gone and left a broken file behind
+
+    histograms, counters = {}, {}
+    for snapshot in snapshots:
+        for name, labels, buckets, total, count in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+    return {'histograms' : histograms, 'counters' : counters}
+
+def format_labels(labels, extra=()) -> str:
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels) + '}'
+
+# the numbers in the prometheus text format
+def render_metrics(folder=None) -> str:
+    data = collect(folder)
+    lines = []
+    for metric, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+
+        if kind == 'histogram':
+            for (name, labels), (buckets, total, count) in sorted(data['histograms'].items()):
+                if name != metric:
+                    continue
+                # the buckets are cumulative in the text format
+                cumulative = 0
+                for bound, value in zip(BUCKETS, buckets):
+                    cumulative += value
+                    lines.append(f'{metric}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{metric}_bucket{format_labels(labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {total}')
+                lines.append(f'{metric}_count{format_labels(labels)} {count}')
+        else:
+            for (name, labels), value in sorted(data['counters'].items()):
+                if name == metric:
+                    lines.append(f'{metric}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# record a stage of the request: its time goes into the histogram and into the request's log line
+# this works outside of requests as well (like in the background jobs), there it only goes into the histogram
+@contextmanager
+def timed(stage):
+    if not get_setting('METRICS_ENABLED'):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        _registry.inc('vegclf_stage_errors_total', {'stage' : stage})
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _registry.observe('vegclf_stage_seconds', {'stage' : stage}, seconds)
+        if has_request_context():
+            stages = g.setdefault('stage_times', {})
+            stages[stage] = stages.get(stage, 0) + seconds
+
+
+# take the latest numbers of the app's caches, they count their own hits and misses so the registry just keeps a copy
+def record_cache_stats(app) -> None:
+    for cache, name in CACHES.items():
+        if name in app.extensions:
+            stats = app.extensions[name].stats()
+            _registry.set('vegclf_cache_hits_total', {'cache' : cache}, stats['hits'])
+            _registry.set('vegclf_cache_misses_total', {'cache' : cache}, stats['misses'])
+            _registry.set('vegclf_cache_items', {'cache' : cache}, stats['items'])
+
+
+def start_request() -> None:
+    g.request_start = time.perf_counter()
+
+def finish_request(response):
+    start = g.pop('request_start', None)
+    if start is None or not current_app.config['METRICS_ENABLED']:
+        return response
+
+    seconds = time.perf_counter() - start
+    endpoint = request.endpoint or 'unknown'
+    _registry.observe('vegclf_request_seconds', {'endpoint' : endpoint}, seconds)
+    _registry.inc('vegclf_requests_total', {'endpoint' : endpoint, 'method' : request.method, 'status' : response.status_code})
+    record_cache_stats(current_app)
+    _registry.flush(current_app.config['METRICS_DIR'], current_app.config['METRICS_FLUSH_INTERVAL'])
+
+    # one line per request, with how long each stage took
+    if current_app.config['REQUEST_LOG']:
+        logger.info(json.dumps({
+            'method' : request.method,
+            'path' : request.path,
+            'endpoint' : endpoint,
+            'status' : response.status_code,
+            'duration_ms' : round(seconds * 1000, 3),
+            'stages_ms' : {stage : round(value * 1000, 3) for stage, value in g.get('stage_times', {}).items()},
+            'pid' : os.getpid()
+        }))
+    return response
+
+# the templates are timed through flask's signals, so the views don't have to do anything
+def _template_started(sender, template, context, **extra) -> None:
+    g.template_start = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra) -> None:
+    start = g.pop('template_start', None)
+    if start is not None and sender.config['METRICS_ENABLED']:
+        seconds = time.perf_counter() - start
+        _registry.observe('vegclf_stage_seconds', {'stage' : 'render'}, seconds)
+        stages = g.setdefault('stage_times', {})
+        stages['render'] = stages.get('render', 0) + seconds
+
+def register_metrics(app: Flask) -> None:
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+    if app.config['REQUEST_LOG'] and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
@@ -0,0 +1,200 @@
+# upgrades for databases made by older versions of the app
+# db.create_all only makes the tables that don't exist yet, so the columns and indexes added to existing tables are done here,
+# along with converting the data that is stored differently now. Everything here is safe to run more than once
+import pickle
+from sqlalchemy import inspect, select, insert, update, text
+from sqlalchemy.schema import CreateTable, CreateIndex
+from . import db
+from .models import History, HistoryProb, rank_labels
+from .config import get_setting
+from .similarity import image_hash
+
+# add whatever columns and indexes the models have but the tables in the database don't
+# returns a list of what was added
+def upgrade_schema() -> list:
+    added = []
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            # new columns, the ones that are not nullable have a server default to fill in the existing rows
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                sql = f'alter table {table.name} add column {column.name} {column.type.compile(dialect=engine.dialect)}'
+                if column.server_default is not None:
+                    sql += f" default '{column.server_default.arg}'"
+                if not column.nullable:
+                    sql += ' not null'
+                conn.execute(text(sql))
+                added.append(f'{table.name}.{column.name}')
+
+            # and the indexes
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    added.append(index.name)
+
+    return added
+
+# remake the sqlite tables that should have autoincrement but were made without it, so the ids of deleted rows are never used again
+# sqlite can't change that on an existing table, so the table is made again under another name, the rows are copied over,
+# and it takes the old one's place, the way the sqlite docs say to. Returns the tables that were remade
+def migrate_autoincrement() -> list:
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return []
+
+    remade = []
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if not table.dialect_options['sqlite']['autoincrement'] or not inspector.has_table(table.name):
+            continue
+        with engine.connect() as conn:
+            sql = conn.execute(text("select sql from sqlite_master where type = 'table' and name = :name"), {'name' : table.name}).scalar()
+        if 'autoincrement' in sql.lower():
+            continue
+
+        # only the columns the models have are copied, so any other one has to be migrated out of the table before this
+        existing = [column['name'] for column in inspector.get_columns(table.name)]
+        unknown = [name for name in existing if name not in table.columns]
+        if unknown:
+            raise RuntimeError(f'{table.name} still has the columns {", ".join(unknown)}, they would be lost by remaking it')
+        columns = ', '.join(existing)
+
+        # the other tables keep pointing at it by name, so the foreign keys are off while it's gone
+        metadata = db.MetaData()
+        for other in db.metadata.sorted_tables:
+            other.to_metadata(metadata)     # for the foreign keys of the new table to point at
+        new_table = table.to_metadata(metadata, name=f'{table.name}_new')
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('pragma foreign_keys = off')
+            cursor.execute('begin')
+            cursor.execute(str(CreateTable(new_table).compile(dialect=engine.dialect)))
+            cursor.execute(f'insert into {new_table.name} ({columns}) select {columns} from {table.name}')
+            cursor.execute(f'drop table {table.name}')
+            cursor.execute(f'alter table {new_table.name} rename to {table.name}')
+            for index in table.indexes:
+                cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+            cursor.execute('commit')
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        remade.append(table.name)
+    return remade
+
+# move the probabilities out of the old pickled probs column into the history_prob table, a chunk of histories at a time,
+# and then drop the old column. Returns how many histories were moved
+def migrate_history_probs(chunk_size=500) -> int:
+    columns = {column['name'] for column in inspect(db.engine).get_columns('history')}
+    if 'probs' not in columns:
+        return 0
+
+    last_id = count = 0
+    while True:
+        rows = db.session.execute(
+            text('select id, probs from history where id > :last_id order by id limit :limit'),
+            {'last_id' : last_id, 'limit' : chunk_size}
+        ).all()
+        if not rows:
+            break
+
+        # skip the ones that were already moved, in case an earlier run got cut off
+        ids = [row[0] for row in rows]
+        moved = set(db.session.scalars(select(HistoryProb.history_id).where(HistoryProb.history_id.in_(ids))))
+
+        prob_rows = []
+        for history_id, data in rows:
+            if history_id in moved:
+                continue
+            probs = pickle.loads(data)
+            ranks = rank_labels(probs)
+            prob_rows += [{'history_id' : history_id, 'label' : label, 'prob' : float(prob), 'rank' : ranks[label]} for label, prob in enumerate(probs)]
+
+        if prob_rows:
+            db.session.execute(insert(HistoryProb), prob_rows)
+        db.session.commit()
+
+        count += len(rows) - len(moved)
+        last_id = rows[-1][0]
+
+    # the new histories don't have it, so it has to go, otherwise inserting them would fail on the not null
+    db.session.execute(text('alter table history drop column probs'))
+    db.session.commit()
+    return count
+
+# re-encode the history images that are still stored as raw rgb bytes into the configured format, a chunk of rows at a time
+# returns how many rows were converted. This can't be undone (and loses detail when the format is lossy), so it's not part of
+# upgrade_database and only runs when asked for with flask reencode-images
+def migrate_history_images(image_format=None, chunk_size=500) -> int:
+    from .routes.functions import encode_history_image, decode_history_image
+
+    image_format = image_format or get_setting('HISTORY_IMAGE_FORMAT')
+    if image_format == 'raw':
+        return 0
+
+    last_id = count = 0
+    while True:
+        rows = db.session.execute(
+            select(History.id, History.image, History.image_format, History.image_width, History.image_height, History.model)
+            .where(History.image_format == 'raw', History.id > last_id)
+            .order_by(History.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return count
+
+        changes = []
+        for row in rows:
+            img = decode_history_image(row.image, row.image_format, row.image_width, row.image_height, row.model)
+            image, new_format, width, height = encode_history_image(img, image_format)
+            changes.append({'id' : row.id, 'image' : image, 'image_format' : new_format, 'image_width' : width, 'image_height' : height})
+
+        # update the whole chunk by primary key in one go
+        db.session.execute(update(History), changes)
+        db.session.commit()
+
+        count += len(rows)
+        last_id = rows[-1].id
+
+# work out the image hashes of the histories from before they were stored, a chunk of rows at a time
+# returns how many rows got one
+def migrate_history_hashes(chunk_size=500) -> int:
+    from .routes.functions import decode_history_image
+
+    last_id = count = 0
+    while True:
+        rows = db.session.execute(
+            select(History.id, History.image, History.image_format, History.image_width, History.image_height, History.model)
+            .where(History.image_hash.is_(None), History.id > last_id)
+            .order_by(History.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return count
+
+        changes = [{'id' : row.id, 'image_hash' : image_hash(decode_history_image(row.image, row.image_format, row.image_width, row.image_height, row.model))} for row in rows]
+        db.session.execute(update(History), changes)
+        db.session.commit()
+
+        count += len(rows)
+        last_id = rows[-1].id
+
+# run every upgrade, returns a summary of what was done
+def upgrade_database() -> dict:
+    return {
+        'schema' : upgrade_schema(),
+        'history_probs' : migrate_history_probs(),       # before autoincrement, which only keeps the columns the models have
+        'autoincrement' : migrate_autoincrement(),
+        'history_hashes' : migrate_history_hashes()
+    }
@@ -1,9 +1,9 @@
 from . import db
-from sqlalchemy import Integer, String, ForeignKey, PickleType, LargeBinary, DateTime, Float
+from sqlalchemy import Integer, BigInteger, SmallInteger, String, ForeignKey, LargeBinary, DateTime, Float, JSON, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 from flask_login import UserMixin
-from typing import List
+from typing import List, Optional
 import datetime
 
 # user credential model
@@ -12,14 +12,78 @@ class User(UserMixin, db.Model):
     email: Mapped[str] = mapped_column(String, unique=True, nullable=False)
     password: Mapped[str] = mapped_column(String, nullable=False)
     histories: Mapped[List['History']] = relationship(cascade='all, delete-orphan')
+    jobs: Mapped[List['PredictionJob']] = relationship(cascade='all, delete-orphan')
+
+    # the id of a deleted user is never given to another one, in sqlite that needs autoincrement
+    __table_args__ = {'sqlite_autoincrement' : True}
+
+# the rank of every label by its probability, 1 for the most probable
+def rank_labels(probs) -> dict:
+    return {label : rank + 1 for rank, label in enumerate(sorted(range(len(probs)), key=lambda label: -probs[label]))}
+
+# probability of one label of a history, one row per label, so that any label's probability and rank can be filtered on in sql
+class HistoryProb(db.Model):
+    history_id: Mapped[int] = mapped_column(ForeignKey('history.id'), primary_key=True)
+    label: Mapped[int] = mapped_column(SmallInteger, primary_key=True)     # index into the labels
+    prob: Mapped[float] = mapped_column(Float, nullable=False)
+    rank: Mapped[int] = mapped_column(SmallInteger, nullable=False)        # 1 for the most probable label, 2 for the next and so on
+
+    __table_args__ = (
+        Index('ix_history_prob_label_prob', 'label', 'prob'),
+        Index('ix_history_prob_label_rank', 'label', 'rank')
+    )
 
 # history model
 class History(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), nullable=False)
-    probs: Mapped[list] = mapped_column(PickleType, nullable=False)
+    prob_rows: Mapped[List[HistoryProb]] = relationship(cascade='all, delete-orphan', order_by=HistoryProb.label)
     highest_prob: Mapped[float] = mapped_column(Float, nullable=False)
     pred: Mapped[str] = mapped_column(String, nullable=False)
     image: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    image_format: Mapped[str] = mapped_column(String, nullable=False, server_default='raw')    # raw (rgb bytes, the original format), png, webp or gray
+    image_width: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)                  # missing for the rows from before the format was stored
+    image_height: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    image_hash: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)                # difference hash of the image, for finding similar ones
+    model: Mapped[str] = mapped_column(String, nullable=False)
+    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime(True), server_default=func.current_timestamp())
+
+    # indexes for the search page: one for the filters, and one for going through a user's histories newest first
+    # and one with the hashes of a user, so loading and checking the similarity index doesn't have to read the rows
+    # and one for the retention purge to find the old histories of every user
+    # like the users, the id of a deleted history is never given to another one
+    __table_args__ = (
+        Index('ix_history_user_search', 'user_id', 'pred', 'model', 'highest_prob'),
+        Index('ix_history_user_timestamp', 'user_id', 'timestamp'),
+        Index('ix_history_user_hash', 'user_id', 'image_hash'),
+        Index('ix_history_timestamp', 'timestamp'),
+        {'sqlite_autoincrement' : True}
+    )
+
+    # the list of probabilities for each label, in the order of the labels, stored as one row per label
+    @property
+    def probs(self) -> list:
+        return [row.prob for row in self.prob_rows]
+
+    @probs.setter
+    def probs(self, probs) -> None:
+        ranks = rank_labels(probs)
+        self.prob_rows = [HistoryProb(label=label, prob=float(prob), rank=ranks[label]) for label, prob in enumerate(probs)]
+
+# prediction job model, for predictions that run in the background and get polled for through the api
+# the status goes from queued -> running -> done or failed
+class PredictionJob(db.Model):
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)                       # random hex, so the ids can't be guessed
+    user_id: Mapped[Optional[int]] = mapped_column(ForeignKey('user.id'), nullable=True)  # no user for anonymous predictions
     model: Mapped[str] = mapped_column(String, nullable=False)
-    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime(True), server_default=func.current_timestamp())
\ No newline at end of file
+    status: Mapped[str] = mapped_column(String, nullable=False, default='queued')
+    pred: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    probs: Mapped[Optional[list]] = mapped_column(JSON, nullable=True)
+    history_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    created: Mapped[datetime.datetime] = mapped_column(DateTime(True), server_default=func.current_timestamp())
+
+    # for purging the finished jobs
+    __table_args__ = (
+        Index('ix_prediction_job_created', 'created'),
+    )
@@ -0,0 +1,151 @@
+# the retention policy: histories older than HISTORY_RETENTION_DAYS are purged, a chunk at a time so the database is never held for long
+# and written into an archive first if there's a folder for it. Every worker runs a thread that purges every RETENTION_INTERVAL seconds,
+# and a lock file makes sure only one of them purges at a time. flask purge-history does the same once, for running it from cron
+# the finished prediction jobs are only needed until the client picks up the result, so they are purged after JOB_RETENTION_HOURS
+import os
+import gzip
+import json
+import time
+import base64
+import datetime
+import threading
+from flask import Flask
+from sqlalchemy import select, delete
+from . import db
+from .models import History, HistoryProb, PredictionJob
+from .config import get_setting
+from .database import reclaim_space
+from .similarity import get_similarity_indexes
+
+try:
+    import fcntl        # the lock between the workers, without it (on windows) every worker just purges on its own
+except ImportError:
+    fcntl = None
+
+# append the full histories (image included) to the archive, so they can still be had after they are purged
+def archive_histories(ids, path) -> None:
+    from .routes.functions import LABELS
+
+    rows = db.session.execute(select(History).where(History.id.in_(ids)).order_by(History.id)).scalars().all()
+    probs = {history_id : [0.0] * len(LABELS) for history_id in ids}
+    for history_id, label, prob in db.session.execute(select(HistoryProb.history_id, HistoryProb.label, HistoryProb.prob).where(HistoryProb.history_id.in_(ids))):
+        probs[history_id][label] = prob
+
+    lines = ''.join(json.dumps({
+        'id' : history.id,
+        'user_id' : history.user_id,
+        'timestamp' : history.timestamp.isoformat(),
+        'model' : history.model,
+        'prediction' : history.pred,
+        'probability' : history.highest_prob,
+        'probabilities' : dict(zip(LABELS, probs[history.id])),
+        'image' : base64.b64encode(history.image).decode(),
+        'image_format' : history.image_format,
+        'image_width' : history.image_width,
+        'image_height' : history.image_height
+    }) + '\n' for history in rows)
+    db.session.expunge_all()       # don't hold on to the images
+
+    # every chunk is its own gzip member, which together still read as one file
+    with gzip.open(path, 'at') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+# purge the histories from before the given time, returns how many were purged
+def purge_histories(before, chunk_size=None, archive_dir=None) -> int:
+    from .routes.functions import delete_history_rows, image_version_columns
+
+    chunk_size = chunk_size or get_setting('DELETE_CHUNK_SIZE')
+    query = select(History.id, *image_version_columns())
+    query = query.where(History.timestamp < before).order_by(History.timestamp, History.id).limit(chunk_size)
+
+    path = None
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f'history-{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}.ndjson.gz')
+
+    purged = 0
+    try:
+        while rows := db.session.execute(query).all():
+            if path:
+                archive_histories([row.id for row in rows], path)
+            delete_history_rows(rows)
+            purged += len(rows)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if purged:
+            get_similarity_indexes().clear()
+            reclaim_space(db.engine)
+    return purged
+
+# delete the finished prediction jobs from before the given time, the ones still queued or running are left alone
+# returns how many were purged
+def purge_jobs(before, chunk_size=None) -> int:
+    chunk_size = chunk_size or get_setting('DELETE_CHUNK_SIZE')
+    query = select(PredictionJob.id).where(PredictionJob.status.in_(('done', 'failed')), PredictionJob.created < before).limit(chunk_size)
+
+    purged = 0
+    try:
+        while ids := db.session.scalars(query).all():
+            db.session.execute(delete(PredictionJob).where(PredictionJob.id.in_(ids)))
+            db.session.commit()
+            purged += len(ids)
+    except Exception:
+        db.session.rollback()
+        raise
+    return purged
+
+class RetentionPurger(object):
+    def __init__(self, app) -> None:
+        self.app = app
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # the thread is started by the first request of every worker, a forked worker doesn't get the parent's thread
+    def ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop, daemon=True, name='retention-purge').start()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.run_once()
+            except Exception as error:
+                print(error)
+            time.sleep(self.app.config['RETENTION_INTERVAL'])
+
+    # purge once, unless another worker is at it already. Returns how many histories and jobs were purged, or None when it was skipped
+    def run_once(self) -> dict | None:
+        with open(self.app.config['RETENTION_LOCK_FILE'], 'a') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+
+            now = datetime.datetime.now(datetime.timezone.utc)
+            purged = {'histories' : 0, 'jobs' : 0}
+            with self.app.app_context():
+                try:
+                    if self.app.config['HISTORY_RETENTION_DAYS'] > 0:
+                        before = now - datetime.timedelta(days=self.app.config['HISTORY_RETENTION_DAYS'])
+                        purged['histories'] = purge_histories(before, archive_dir=self.app.config['RETENTION_ARCHIVE_DIR'])
+                    if self.app.config['JOB_RETENTION_HOURS'] > 0:
+                        purged['jobs'] = purge_jobs(now - datetime.timedelta(hours=self.app.config['JOB_RETENTION_HOURS']))
+                    return purged
+                finally:
+                    db.session.remove()
+
+# with no interval the workers don't purge on their own, only flask purge-history does
+def register_retention(app: Flask) -> None:
+    if app.config['HISTORY_RETENTION_DAYS'] > 0 or app.config['JOB_RETENTION_HOURS'] > 0:
+        purger = app.extensions['retention_purger'] = RetentionPurger(app)
+        if app.config['RETENTION_INTERVAL'] > 0:
+            app.before_request(purger.ensure_started)
@@ -1,29 +1,21 @@
 from flask_wtf import FlaskForm
-from wtforms import SelectField, SubmitField, EmailField, PasswordField, FloatField
-from wtforms.validators import ValidationError, InputRequired, Email, NumberRange
-from flask_wtf.file import FileAllowed, FileField, FileRequired
-from PIL import Image
-from .functions import LABELS
+from wtforms import SelectField, SubmitField, EmailField, PasswordField, FloatField, IntegerField, DateField, StringField
+from wtforms.widgets import HiddenInput
+from wtforms.validators import ValidationError, InputRequired, Email, NumberRange, Optional
+from flask_wtf.file import FileAllowed, FileField, FileRequired, MultipleFileField
+from flask_login import current_user
+from .functions import LABELS, open_image, needs_color, decode_cursor
 
 # custom validator to check that the images are capped at 512 by 512 pixels
+# the image is only decoded once, here, and then kept on the field as field.decoded for the view to use
+# it's decoded for the selected model, so a big jpeg is only decoded at the scale that model needs
 class ImageSizeValidator(object):
     def __call__(self, form, field):
-        # use pillow's image class to "parse" the image data
-        img = Image.open(field.data)
-        img_size = img.size
-        img_size_text = f'Current image size: {img_size[0]} x {img_size[1]} pixels'
-        
-        # first check that the width and height are the same, which means the image is exactly a square image
-        if img_size[0] != img_size[1]:
-            raise ValidationError('Error: Image must be exactly a square image! ' + img_size_text)
-
-        # then check if the pixel of the image exceeds the length/height
-        if img_size[0] > 512:
-            raise ValidationError('Error: Image must not exceed the specified width/height! ' + img_size_text)
-        
-        # lastly, check if the pixels are smaller than the specified one
-        if img_size[0] < 31:
-            raise ValidationError('Error: Image must not be below the specified width/height ' + img_size_text)
+        model_input_size = int(form.model.data.split()[0]) if form.model.data in form.model.choices else None
+        user_id = current_user.id if current_user.is_authenticated else None
+        field.decoded, error = open_image(field.data, model_input_size, needs_color(user_id))
+        if error:
+            raise ValidationError(error)
 
 # checks for both the password strength, and also checking if the confirm password is the same as well
 class ValidatePassword(object):
@@ -63,6 +55,32 @@ class NotEqualTo(object):
             raise ValidationError(self.errorMsg)
         
 
+# the filters on a single label need a label to be selected
+class RequiresLabel(object):
+    def __init__(self, fieldname) -> None:
+        self.fieldname = fieldname
+
+    def __call__(self, form, field):
+        if field.data and form[self.fieldname].data == 'Any':
+            raise ValidationError(f'Error: Select a label to filter by {field.label.text.lower()}')
+
+# the end of the date range must not be before the start
+class NotBefore(object):
+    def __init__(self, fieldname) -> None:
+        self.fieldname = fieldname
+
+    def __call__(self, form, field):
+        if field.data and form[self.fieldname].data and field.data < form[self.fieldname].data:
+            raise ValidationError('Error: The end date must not be before the start date')
+
+# the cursor of the next page has to be one that the search made
+class SearchCursor(object):
+    def __call__(self, form, field):
+        try:
+            decode_cursor(field.data)
+        except ValueError:
+            raise ValidationError('Error: Invalid page')
+
 # a form for uploading the images, while also selecting the model
 class ImageForm(FlaskForm):
     image = FileField('Upload image', validators=[
@@ -72,6 +90,12 @@ class ImageForm(FlaskForm):
     model = SelectField('Select model', choices=['128 pixels model', '31 pixels model'], validators=[InputRequired()])
     submit = SubmitField('Predict')
 
+# a form for uploading many images at once, either as separate files or in a zip, each image is checked on its own later
+class BatchImageForm(FlaskForm):
+    images = MultipleFileField('Upload images')
+    archive = FileField('Upload zip', validators=[FileAllowed(['zip'], 'Please upload a zip file only!')])
+    model = SelectField('Select model', choices=['128 pixels model', '31 pixels model'], validators=[InputRequired()])
+
 # a form for signup
 class SignUpForm(FlaskForm):
     email = EmailField('Email', validators=[InputRequired(), Email('Invalid email address!')])
@@ -103,4 +127,11 @@ class SearchForm(FlaskForm):
     model = SelectField('Model used', choices=['Any', '128 pixels model', '31 pixels model'], validators=[InputRequired()])
     prediction = SelectField('Predicted type', choices=['Any'] + LABELS, validators=[InputRequired()])
     prob_pred = FloatField('Min. probability', validators=[NumberRange(0, 100, 'Error: Minimum probablity of the prediction must not exceed below 0 or above 100 percent')], default=0)
+    label = SelectField('Label', choices=['Any'] + LABELS, default='Any')
+    top_k = IntegerField('Label in top-k', validators=[Optional(), NumberRange(1, len(LABELS), f'Error: Top-k must be between 1 and {len(LABELS)}'), RequiresLabel('label')])
+    label_prob = FloatField('Min. label probability', validators=[Optional(), NumberRange(0, 100, 'Error: Minimum probability of the label must not exceed below 0 or above 100 percent'), RequiresLabel('label')])
+    max_margin = FloatField('Max. top-2 margin', validators=[Optional(), NumberRange(0, 100, 'Error: Margin between the top 2 probabilities must not exceed below 0 or above 100 percent')])
+    date_from = DateField('From', validators=[Optional()])
+    date_to = DateField('To', validators=[Optional(), NotBefore('date_from')])
+    after = StringField(widget=HiddenInput(), validators=[Optional(), SearchCursor()])     # the timestamp and id of the last result of the previous page
     submit = SubmitField('Seach')
\ No newline at end of file
@@ -1,10 +1,24 @@
 # functions for performing something so to make the views.py less cluttered
+import io
+import math
+import csv
 import json
-import requests
+import zipfile
+import datetime
+import hashlib
 import numpy as np
-from ..models import User
+from sqlalchemy import select, update, delete, func, tuple_, type_coerce, String
+from ..models import User, History, HistoryProb, PredictionJob
+from PIL import Image
+from flask import current_app, url_for
 from flask_login import current_user
 from .. import db
+from ..config import get_setting
+from ..cache import LRUCache
+from ..similarity import image_hash, forget_user_index
+from ..metrics import timed
+from ..writebehind import get_history_writer
+from ..inference import get_backend, get_prediction_cache
 
 # vegetable labels
 LABELS = ['Bean',
@@ -23,56 +37,632 @@ LABELS = ['Bean',
             'Radish',
             'Tomato']
 
-# function to transform image data, resizing has been done earlier
-def transformer(img, pixels):
-    pixelScaler = np.vectorize(lambda x: x / 255)   # to normalise the image data
+# the image formats that uploads can be in, anything else is rejected straight from the header
+UPLOAD_FORMATS = ('JPEG', 'PNG')
 
-    # simply convert to grayscale and then into numpy array
-    img = pixelScaler(np.array(img.convert('L')))
+# check that the images are capped at 512 by 512 pixels, returns the error message if the image is not allowed
+# this is shared by the image size validator of the forms and the batch upload, where every image gets checked on its own
+def check_image_size(img) -> str | None:
+    img_size = img.size
+    img_size_text = f'Current image size: {img_size[0]} x {img_size[1]} pixels'
+    
+    # first check that the width and height are the same, which means the image is exactly a square image
+    if img_size[0] != img_size[1]:
+        return 'Error: Image must be exactly a square image! ' + img_size_text
+
+    # then check if the pixel of the image exceeds the length/height
+    if img_size[0] > 512:
+        return 'Error: Image must not exceed the specified width/height! ' + img_size_text
+    
+    # lastly, check if the pixels are smaller than the specified one
+    if img_size[0] < 31:
+        return 'Error: Image must not be below the specified width/height ' + img_size_text
+
+    return None
+
+# the filters that images can be resized with, from the fastest to the best looking (RESIZE_FILTER in the config)
+RESIZE_FILTERS = {
+    'nearest' : Image.Resampling.NEAREST,
+    'box' : Image.Resampling.BOX,
+    'bilinear' : Image.Resampling.BILINEAR,
+    'hamming' : Image.Resampling.HAMMING,
+    'bicubic' : Image.Resampling.BICUBIC,
+    'lanczos' : Image.Resampling.LANCZOS
+}
+
+# resize an image to the model's input size with the configured filter
+def resize_image(img, pixels):
+    with timed('resize'):
+        return img.resize((pixels, pixels), RESIZE_FILTERS[get_setting('RESIZE_FILTER')])
+
+# whether the uploads of a user have to be decoded in colour, only the history ever shows them and not when it's stored in gray
+def needs_color(user_id) -> bool:
+    return user_id is not None and get_setting('HISTORY_IMAGE_FORMAT') != 'gray'
 
-    # reshape and return
-    return img.reshape(1, pixels, pixels, 1)
+# open an uploaded image with a single decode, and only once it's known to be allowed
+# opening only reads the header, so the format, the size and decompression bombs (more pixels than MAX_IMAGE_PIXELS) are all
+# rejected before any pixel is decoded. Returns the decoded image, or the error message if the image is not allowed
+# when the model size is given, a jpeg is decoded straight to grayscale unless the colour is needed, and if it's at least twice as big
+# as the model, at a reduced scale (1/2, 1/4 or 1/8) that is still at least as big as the model, which skips most of the decoding work
+def open_image(file, model_input_size=None, color=True):
+    with timed('decode'):
+        return _open_image(file, model_input_size, color)
+
+def _open_image(file, model_input_size, color):
+    try:
+        img = Image.open(file, formats=UPLOAD_FORMATS)
+    except Image.DecompressionBombError:
+        return None, 'Error: Image has too many pixels'
+    except Exception:
+        return None, 'Error: Not a readable image'
+
+    error = check_image_size(img)
+    if error:
+        return None, error
+
+    if model_input_size and img.format == 'JPEG' and get_setting('JPEG_DRAFT'):
+        img.draft('RGB' if color else 'L', (model_input_size, model_input_size))
+
+    # the header was fine, now decode it for real, which can still fail on a truncated or broken file
+    try:
+        img.load()
+    except Exception:
+        return None, 'Error: Not a readable image'
+    return img, None
+
+# function to transform image data into the model's input tensor
+# the grayscale conversion, resize (if it hasn't been done earlier) and the normalising are all done by pillow and numpy in one pass,
+# writing straight into a float32 buffer, instead of calling a python function for every single pixel
+# an existing buffer of shape (1, pixels, pixels, 1) can be passed in as out to avoid allocating a new one
+def transformer(img, pixels, out=None):
+    # grayscale first so that the resize only has a single channel to work on
+    if img.mode != 'L':
+        img = img.convert('L')
+    if img.size != (pixels, pixels):
+        img = resize_image(img, pixels)
+
+    if out is None:
+        out = np.empty((1, pixels, pixels, 1), dtype=np.float32)
+
+    # normalise the uint8 pixels directly into the buffer
+    np.divide(np.asarray(img, dtype=np.uint8), 255, out=out[0, :, :, 0], dtype=np.float32)
+    return out
+
+# function to make predictions for a list of images (already resized), returns the label and the probabilities for each image
+def make_predictions(model_input_size, imgs):
+    backend = get_backend(model_input_size)
+    cache = get_prediction_cache()
+
+    # transform every image straight into its row of one batch buffer
+    batch = np.empty((len(imgs), model_input_size, model_input_size, 1), dtype=np.float32)
+    with timed('transform'):
+        for i, img in enumerate(imgs):
+            transformer(img, model_input_size, out=batch[i:i + 1])
+
+    # the same image for the same model and version has been predicted before, then there's no need to ask the model again
+    # a model whose version isn't known can't be cached, since there's no telling when it changes. The version is only
+    # looked at when there's a cache, and not while the circuit breaker is open, since the prediction fails straight away then
+    version = backend.version if cache.enabled and backend.available() else None
+    cached = version is not None
+    keys = [cache.key(tensor, f'model_{model_input_size}', version) for tensor in batch] if cached else [None] * len(imgs)
+    probs = [cache.get(key) if cached else None for key in keys]
+
+    # otherwise run the rest through whichever backend is set up for this model size, in batches
+    missing = [i for i, p in enumerate(probs) if p is None]
+    batch_size = max(1, get_setting('MODEL_BATCH_SIZE'))
+    for start in range(0, len(missing), batch_size):
+        chunk = missing[start:start + batch_size]
+        with timed('model'):
+            preds = backend.predict(batch[chunk])
+        for i, p in zip(chunk, preds):
+            probs[i] = p
+            if cached:
+                cache.set(keys[i], p)
+
+    # the prediction label as well as the list of probabilities for each label, to be later store for advanced search
+    return [(LABELS[np.argmax(p)], p.tolist()) for p in probs]
+
+# whether the model would be asked right now, it's not while its circuit breaker is open
+def model_available(model_input_size):
+    return get_backend(model_input_size).available()
+
+# how many whole seconds until the model's circuit breaker lets a request through again, at least 1 since it's only asked when it's open
+def model_retry_after(model_input_size):
+    breaker = getattr(get_backend(model_input_size), 'breaker', None)
+    if breaker is None:
+        return math.ceil(get_setting('MODEL_BREAKER_COOLDOWN'))
+    return max(math.ceil(breaker.retry_after()), 1)
 
 # function to make a prediction
 def make_prediction(model_input_size, img):
+    pred, probs = make_predictions(model_input_size, [img])[0]
+    return pred, [probs]    # return the prediction label as well as the list of probabilities for each label, to be later store for advanced search
+
+# the options pillow saves a history image with. For lossless webp the quality is how hard it tries to compress,
+# so it gets the effort instead (and the method that goes with it) rather than 100, which is the slowest there is
+def image_save_options(image_format) -> dict:
+    if image_format != 'webp':
+        return {}
+    quality = get_setting('HISTORY_IMAGE_QUALITY')
+    if quality < 100:
+        return {'quality' : quality}
+    effort = get_setting('HISTORY_IMAGE_EFFORT')
+    return {'lossless' : True, 'quality' : effort, 'method' : effort * 6 // 100}
+
+# function to encode an image for storing in the history, returns the data and the format, width and height to store along with it
+def encode_history_image(img, image_format=None):
+    image_format = image_format or get_setting('HISTORY_IMAGE_FORMAT')
+
+    with timed('image_encode'):
+        if image_format == 'gray':
+            img = img.convert('L')
+            data = img.tobytes()
+        elif image_format == 'raw':
+            img = img.convert('RGB')
+            data = img.tobytes()
+        elif image_format in ('png', 'webp'):
+            # png and webp can keep whatever mode the image is in, other than palettes and such
+            if img.mode not in ('RGB', 'RGBA', 'L'):
+                img = img.convert('RGB')
+            buffer = io.BytesIO()
+            img.save(buffer, image_format.upper(), **image_save_options(image_format))
+            data = buffer.getvalue()
+        else:
+            raise ValueError(f'Image format does not exists: {image_format}')
+
+    return data, image_format, img.size[0], img.size[1]
+
+# function to turn the stored image of a history back into an image
+# the rows from before the format was stored don't have the size, but they were always the size of the model
+def decode_history_image(data, image_format, width=None, height=None, model=None):
+    if image_format in ('raw', 'gray'):
+        size = (width or int(model), height or int(model))
+        return Image.frombytes(mode='RGB' if image_format == 'raw' else 'L', data=data, size=size)
+    return Image.open(io.BytesIO(data))
+
+# function to get what the image endpoint sends for a history: the stored data when the browser can show it as it is,
+# otherwise encoded as png. Returns the data and its mimetype
+def history_image_response_data(history):
+    if history.image_format in ('png', 'webp'):
+        return history.image, f'image/{history.image_format}'
+
+    with timed('image_encode'):
+        img = decode_history_image(history.image, history.image_format, history.image_width, history.image_height, history.model)
+        buffer = io.BytesIO()
+        img.save(buffer, 'PNG')
+    return buffer.getvalue(), 'image/png'
+
+# the columns that the version of a history's image is made of: whose it is, when it was made, the hash of its content
+# and how it's stored (only the upgrade ever re-encodes them). The id alone isn't enough, since a database from before
+# autoincrement gives the id of a deleted history to the next one, which can even be another user's
+def image_version_columns() -> list:
+    return [History.user_id, History.timestamp, History.image_hash, History.image_format, func.length(History.image).label('image_length')]
+
+# the version of a history's image, from a row with the image version columns
+def history_image_version(row) -> str:
+    key = f'{row.user_id}|{row.timestamp.isoformat() if row.timestamp else None}|{row.image_hash}|{row.image_format}|{row.image_length}'
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+# the etag of a history's image, which is also its key in the image cache
+def history_image_etag(history_id, version) -> str:
+    return f'{history_id}-{version}'
+
+# the url of a history's image, with the version in it so that the browser can keep it for good
+def history_image_url(row) -> str:
+    return url_for('routes.get_history_image', history_id=row.id, v=history_image_version(row))
+
+# the images sent by the image endpoint, kept per app so that viewing the same ones again costs nothing
+def get_image_cache() -> LRUCache:
+    if 'image_cache' not in current_app.extensions:
+        current_app.extensions['image_cache'] = LRUCache(
+            max_items=get_setting('IMAGE_CACHE_SIZE'),
+            max_bytes=get_setting('IMAGE_CACHE_BYTES'),
+            sizeof=lambda item: len(item[0])
+        )
+    return current_app.extensions['image_cache']
+
+# the signed in users, kept per app for a short while so that most requests don't have to query the user at all
+# only the columns are kept, every request gets its own user object made from them, which is never attached to a session
+def get_user_cache() -> LRUCache:
+    if 'user_cache' not in current_app.extensions:
+        current_app.extensions['user_cache'] = LRUCache(max_items=get_setting('USER_CACHE_SIZE'), ttl=get_setting('USER_CACHE_TTL'))
+    return current_app.extensions['user_cache']
+
+# get the user for flask login, from the cache when it's there, otherwise from the database (and then it's cached)
+def load_cached_user(user_id) -> User | None:
+    cache = get_user_cache()
+    columns = cache.get(user_id)
+    if columns is None:
+        row = db.session.execute(select(User.email, User.password).where(User.id == user_id)).first()
+        if row is None:
+            return None
+        columns = (row.email, row.password)
+        cache.set(user_id, columns)
+    return User(id=user_id, email=columns[0], password=columns[1])
+
+# drop the user from the cache, whenever the user is changed or deleted
+def forget_user(user_id) -> None:
+    get_user_cache().pop(user_id)
+
+# function to make the history entry of a prediction, the image must be resized to the model's input size already
+def make_history(img, model_input_size, pred, probs, user_id) -> History:
+    image, image_format, image_width, image_height = encode_history_image(img)
+    return History(
+        probs = probs,                              # stores list of probabilites, as one row per label
+        image = image,                              # stores the image data, in the configured format
+        image_format = image_format,                # and the format and the size so that it can be turned back into an image
+        image_width = image_width,
+        image_height = image_height,
+        image_hash = image_hash(img),               # stores the hash of the image, to find the similar ones
+        user_id = user_id,                          # stores user id, foreign key to the user model
+        model = str(model_input_size),              # stores the model used
+        highest_prob = max(probs),                  # stores the highest likely probability
+        pred = pred                                 # stores the predicted vegetable
+    )
+
+# function to store the history of a prediction, on the write behind queue when it's on and the caller doesn't need it stored yet
+# (the history won't have an id then), otherwise straight away. Returns the error from storing it, if any
+def save_history(history, defer=False) -> Exception | None:
+    if defer and get_setting('HISTORY_WRITE_BEHIND') and get_history_writer().put(history):
+        return None
+    return add_entry(history)
+
+# function to run a whole prediction for an uploaded image: resize to the model's input size, predict,
+# and then store it into the history if there's a user to store it for, later on when defer_save is given (see save_history)
+# returns the prediction, the probabilities, the history (if stored) and the error from storing it (if any)
+def predict_and_save(img, model_input_size, user_id=None, defer_save=False):
+    # first check if the image size matches the model size, if not then perform a resize
+    if model_input_size != img.size[0]:
+        img = resize_image(img, model_input_size)
+
+    # now we can send the image to the model server
+    pred, probs = make_prediction(model_input_size, img)
+
+    history = error = None
+    if user_id is not None:
+        history = make_history(img, model_input_size, pred, probs[0], user_id)
+        error = save_history(history, defer_save)
+
+    return pred, probs, history, error
+
+# function to go through the images of a batch upload, the separate files first and then whatever is in the zip
+# yields the file name, a readable file and an error for each one (the file is None when there is an error), the zip is read one entry at a time so it never gets fully unpacked
+def iter_uploads(files, archive=None):
+    max_images = get_setting('BATCH_MAX_IMAGES')
+    max_bytes = get_setting('BATCH_MAX_IMAGE_BYTES')
+    count = 0
+
+    # the images past the limit aren't read at all, but they still each get their error so nothing goes missing without a word
+    too_many = f'Error: Only {max_images} images are taken per upload'
+
+    for file in files:
+        if file and file.filename:
+            count += 1
+            if count > max_images:
+                yield file.filename, None, too_many
+                continue
+            yield file.filename, file.stream, None
+
+    if archive:
+        with zipfile.ZipFile(archive.stream) as zip_file:
+            for info in zip_file.infolist():
+                # skip the folders, and the junk that macs put into zips
+                if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                    continue
+                count += 1
+                if count > max_images:
+                    yield info.filename, None, too_many
+                    continue
+
+                # the sizes in the zip can't be trusted, so never read more than the limit no matter what it says
+                with zip_file.open(info) as entry:
+                    data = entry.read(max_bytes + 1)
+                if len(data) > max_bytes:
+                    yield info.filename, None, 'Error: Image file is too large'
+                else:
+                    yield info.filename, io.BytesIO(data), None
 
-    # first transform the image
-    img = transformer(img, model_input_size)  
+# function to predict a whole batch upload and store the results into the history, going through the images in batches
+# yields one result per image, either the prediction or the errors for images that are not allowed
+def predict_batch_and_save(uploads, model_input_size, user_id=None):
+    batch_size = max(1, get_setting('MODEL_BATCH_SIZE'))
+    pending = []
 
-    # note that I can literally select the model just by inserting the the model input size into the url
-    url = f'https://twob01-2239745-shawnlim-ca2-models.onrender.com/v1/models/model_{model_input_size}:predict'
+    # predict whatever is pending as one batch, and store all of their histories in one go
+    def flush():
+        imgs = [img for _, img in pending]
+        results = make_predictions(model_input_size, imgs)
 
-    # then set up the stuff for posting prediction
-    data = json.dumps({
-        'signature_name' : 'serving_default',
-        'instances' : img.tolist()
-    })
-    header = {'content_type' : 'application/json'}
+        histories = []
+        if user_id is not None:
+            histories = [make_history(img, model_input_size, pred, probs, user_id) for img, (pred, probs) in zip(imgs, results)]
+            error = add_entries(histories)
+            if error:
+                print(error)
+                histories = []
 
-    # post the request and get the response
-    res = requests.post(url, data, headers=header)
-    pred = json.loads(res.text)['predictions']
-    return LABELS[np.argmax(pred)], pred    # return the prediction label as well as the list of probabilities for each label, to be later store for advanced search
+        for i, ((filename, _), (pred, probs)) in enumerate(zip(pending, results)):
+            result = {'filename' : filename, 'prediction' : pred, 'probabilities' : dict(zip(LABELS, probs))}
+            if user_id is not None:
+                result['history_id'] = histories[i].id if histories else None
+            yield result
+        pending.clear()
+
+    for filename, file, error in uploads:
+        # same rules as the prediction page: only jpg and png, and the image size has to be allowed
+        if error:
+            yield {'filename' : filename, 'errors' : [error]}
+            continue
+        if filename.rsplit('.', 1)[-1].lower() not in ('jpg', 'png'):
+            yield {'filename' : filename, 'errors' : ['Please upload images only!']}
+            continue
+        img, error = open_image(file, model_input_size, needs_color(user_id))
+        if error:
+            yield {'filename' : filename, 'errors' : [error]}
+            continue
+
+        if model_input_size != img.size[0]:
+            img = resize_image(img, model_input_size)
+        pending.append((filename, img))
+
+        if len(pending) >= batch_size:
+            yield from flush()
+
+    if pending:
+        yield from flush()
+
+# the conditions for a user's histories that match the filters, shared by the search and the bulk delete
+# all the filters are done in sql: the ones on a label's probability or rank, and the margin between the top 2, go through history_prob
+def history_filters(user_id, model=None, pred=None, min_prob=0, label=None, top_k=None, label_min_prob=None,
+                    max_margin=None, date_from=None, date_to=None) -> list:
+    conditions = [History.user_id == user_id]
+    if model is not None:
+        conditions.append(History.model == model)
+    if pred is not None:
+        conditions.append(History.pred == pred)
+    if min_prob:
+        conditions.append(History.highest_prob >= min_prob)
+
+    # the label is in the top k, and/or has at least this probability. This is an exists on the history's own row of the label,
+    # which is one lookup in the primary key of history_prob for every history of the user, instead of going through
+    # that label's rows of every user (which grows with everyone's histories, not the user's)
+    if label is not None and (top_k or label_min_prob):
+        label_filter = select(HistoryProb.history_id).where(HistoryProb.history_id == History.id, HistoryProb.label == LABELS.index(label))
+        if top_k:
+            label_filter = label_filter.where(HistoryProb.rank <= top_k)
+        if label_min_prob:
+            label_filter = label_filter.where(HistoryProb.prob >= label_min_prob)
+        conditions.append(label_filter.exists())
+
+    # ambiguous predictions, where the 2nd most probable is within the margin of the most probable
+    if max_margin is not None:
+        margin_filter = select(HistoryProb.history_id).where(HistoryProb.history_id == History.id, HistoryProb.rank == 2,
+                                                             HistoryProb.prob >= History.highest_prob - max_margin)
+        conditions.append(margin_filter.exists())
+
+    # the dates are whole days, a microsecond is taken off the bounds so that they work the same
+    # whether the database compares real timestamps or, like sqlite, the text they are stored as
+    if date_from is not None:
+        conditions.append(History.timestamp > datetime.datetime.combine(date_from, datetime.time()) - datetime.timedelta(microseconds=1))
+    if date_to is not None:
+        conditions.append(History.timestamp <= datetime.datetime.combine(date_to, datetime.time()) + datetime.timedelta(days=1, microseconds=-1))
+    return conditions
+
+# the history timestamp the way the search cursor keeps it. sqlite keeps the timestamps as text, and the ones made by the database
+# have no microseconds, so they wouldn't compare equal to the same time written back by sqlalchemy (which always adds them):
+# there the text is kept and compared as it is, everywhere else it's a real timestamp
+def cursor_timestamp():
+    return type_coerce(History.timestamp, String) if db.engine.dialect.name == 'sqlite' else History.timestamp
+
+# the search cursor is the timestamp and the id of the last history of a page, so it still works when that history is gone
+def encode_cursor(timestamp, history_id) -> str:
+    timestamp = timestamp if isinstance(timestamp, str) else timestamp.isoformat()
+    return f'{timestamp}_{history_id}'
+
+# the timestamp and the id of a cursor, raises ValueError if it's not one
+def decode_cursor(cursor) -> tuple:
+    timestamp, _, history_id = cursor.rpartition('_')
+    history_id = int(history_id)
+    if db.engine.dialect.name == 'sqlite':
+        datetime.datetime.fromisoformat(timestamp)     # only to check it
+        return timestamp, history_id
+    return datetime.datetime.fromisoformat(timestamp), history_id
+
+# function to search through a user's histories, newest first, one page at a time
+# instead of an offset, the page starts after the timestamp and id of the last history of the previous page (keyset pagination),
+# so that every page costs the same no matter how far in it is. Returns the page and the cursor to continue after, if there's more
+def search_histories(user_id, model=None, pred=None, min_prob=0, after=None, page_size=None, **filters):
+    page_size = page_size or get_setting('SEARCH_PAGE_SIZE')
+    timestamp = cursor_timestamp()
+    query = select(History.highest_prob, History.pred, History.model, History.id, timestamp.label('cursor_timestamp'), *image_version_columns())
+    query = query.where(*history_filters(user_id, model, pred, min_prob, **filters))
+
+    # continue from the last history of the previous page, the id breaks the ties between histories from the same second
+    if after:
+        after_timestamp, after_id = decode_cursor(after)
+        query = query.where(tuple_(timestamp, History.id) < tuple_(after_timestamp, after_id))
+
+    # one more than a page, to know if there's another page after this
+    query = query.order_by(History.timestamp.desc(), History.id.desc()).limit(page_size + 1)
+    with timed('search'):
+        rows = db.session.execute(query).all()
+
+    next_after = None
+    if len(rows) > page_size:
+        next_after = encode_cursor(rows[page_size - 1].cursor_timestamp, rows[page_size - 1].id)
+    return rows[:page_size], next_after
+
+# function to go through all of a user's histories for the export, oldest first, one chunk at a time
+# the rows are streamed from the database (yield_per) instead of all being loaded at once, and the probabilities of a chunk
+# come in a single query, so the memory used stays the same no matter how many histories the user has
+# yields lists of (row, probabilities), the rows have the image columns as well when asked for
+def iter_history_export(user_id, with_images=False):
+    columns = [History.id, History.timestamp, History.model, History.pred, History.highest_prob]
+    if with_images:
+        columns += [History.image, History.image_format, History.image_width, History.image_height]
+    query = select(*columns).where(History.user_id == user_id).order_by(History.timestamp, History.id)
+
+    for rows in db.session.execute(query.execution_options(yield_per=get_setting('EXPORT_CHUNK_SIZE'))).partitions():
+        probs = {row.id : [0.0] * len(LABELS) for row in rows}
+        prob_query = select(HistoryProb.history_id, HistoryProb.label, HistoryProb.prob).where(HistoryProb.history_id.in_(probs))
+        for history_id, label, prob in db.session.execute(prob_query):
+            probs[history_id][label] = prob
+        yield [(row, probs[row.id]) for row in rows]
+
+EXPORT_COLUMNS = ['id', 'timestamp', 'model', 'prediction', 'probability'] + LABELS
+
+# the histories as csv, a chunk of lines at a time, with the probability of every label in its own column
+def export_csv(user_id):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in iter_history_export(user_id):
+        for row, probs in chunk:
+            writer.writerow([row.id, row.timestamp.isoformat(), row.model, row.pred, row.highest_prob] + probs)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()     # just the header, when there's no history at all
+
+# the histories as one json object per line
+def export_ndjson(user_id):
+    for chunk in iter_history_export(user_id):
+        yield ''.join(json.dumps({
+            'id' : row.id,
+            'timestamp' : row.timestamp.isoformat(),
+            'model' : row.model,
+            'prediction' : row.pred,
+            'probability' : row.highest_prob,
+            'probabilities' : dict(zip(LABELS, probs))
+        }) + '\n' for row, probs in chunk)
+
+# a file that only holds on to what is written to it until it's taken, for streaming a zip as it's being written
+# it can't seek, so zipfile puts the sizes after every file instead of going back to write them in the header
+class ZipStream(io.RawIOBase):
+    def __init__(self) -> None:
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+# the images of the histories in a zip, along with the csv of them all
+# the images that are stored as png or webp go in as they are, the others are encoded as png
+def export_zip(user_id):
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for chunk in iter_history_export(user_id, with_images=True):
+            for row, _ in chunk:
+                data, mimetype = history_image_response_data(row)
+                # compressing the images again would barely make them smaller
+                zip_file.writestr(f'images/{row.id}_{row.pred}.{mimetype.split("/")[1]}', data, zipfile.ZIP_STORED)
+            yield stream.take()
+
+        # the csv goes last, written into the zip as it's made
+        with zip_file.open('history.csv', 'w') as entry:
+            for text in export_csv(user_id):
+                entry.write(text.encode())
+                yield stream.take()
+    yield stream.take()
+
+# delete histories along with their probabilities with set based deletes, one chunk of rows at a time
+# so the database is never held for long, and without ever loading the histories (or their images) themselves
+# the rows have the id and the image version columns of the histories, to drop their images from the cache as well
+def delete_history_rows(rows) -> None:
+    ids = [row.id for row in rows]
+    db.session.execute(delete(HistoryProb).where(HistoryProb.history_id.in_(ids)), execution_options={'synchronize_session' : False})
+    db.session.execute(delete(History).where(History.id.in_(ids)), execution_options={'synchronize_session' : False})
+    db.session.commit()
+
+    cache = get_image_cache()
+    for row in rows:
+        cache.pop(history_image_etag(row.id, history_image_version(row)))
+
+# function to delete a user's histories, the ones given by id and/or the ones matching the search filters (all of them without either)
+# returns how many were deleted, and the error (if any), which leaves the chunks before it deleted
+def delete_histories(user_id, history_ids=None, **filters):
+    query = select(History.id, *image_version_columns()).where(*history_filters(user_id, **filters))
+    if history_ids is not None:
+        query = query.where(History.id.in_(history_ids))
+    query = query.limit(get_setting('DELETE_CHUNK_SIZE'))
+
+    deleted = 0
+    try:
+        # the deleted rows are gone from the next query, so it just keeps going until nothing is left
+        while rows := db.session.execute(query).all():
+            delete_history_rows(rows)
+            deleted += len(rows)
+        return deleted, None
+    except Exception as error:
+        db.session.rollback()
+        return deleted, error
+    finally:
+        if deleted:
+            forget_user_index(user_id)
+
+# function to delete a user's account with everything in it, the histories a chunk at a time and then the rest
+def delete_user_data(user_id) -> Exception | None:
+    _, error = delete_histories(user_id)
+    if error:
+        return error
+    try:
+        db.session.execute(delete(PredictionJob).where(PredictionJob.user_id == user_id), execution_options={'synchronize_session' : False})
+        db.session.execute(delete(User).where(User.id == user_id), execution_options={'synchronize_session' : False})
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        return error
+    forget_user(user_id)
+    return None
 
 # function to add new user or history into the database
 def add_entry(entry) -> Exception | None:
     try:
         db.session.add(entry)
-        db.session.commit()
+        with timed('db_commit'):
+            db.session.commit()
         return None
     except Exception as error:
         db.session.rollback()
         return error
     
+# function to add many histories at once, in a single transaction
+def add_entries(entries) -> Exception | None:
+    try:
+        db.session.add_all(entries)
+        with timed('db_commit'):
+            db.session.commit()
+        return None
+    except Exception as error:
+        db.session.rollback()
+        return error
+
 # function to edit email or password of the user
+# updated straight in the database without loading the user first, and then the cached user is dropped
 def edit_entry(email = None, password = None) -> Exception | None:
+    changes = {}
+    if email:
+        changes['email'] = email
+    if password:
+        changes['password'] = password
+
     try:
-        user = User.query.get(current_user.id)
-        if email:
-            user.email = email
-        if password:
-            user.password = password
+        db.session.execute(update(User).where(User.id == current_user.id).values(**changes))
         db.session.commit()
     except Exception as error:
         db.session.rollback()
-        return error
\ No newline at end of file
+        return error
+
+    # the user of this request has to show the change as well
+    forget_user(current_user.id)
+    for name, value in changes.items():
+        setattr(current_user, name, value)
\ No newline at end of file
@@ -1,12 +1,17 @@
-from .forms import ImageForm, SignUpForm, SignInForm, ChangeEmailForm, ChangePasswordForm, SearchForm
+from .forms import ImageForm, BatchImageForm, SignUpForm, SignInForm, ChangeEmailForm, ChangePasswordForm, SearchForm
 from . import routes
 from .functions import *
 from ..models import User, History
+from ..jobs import get_job_runner, wait_for_job
+from ..similarity import similar_histories
+from ..metrics import timed, render_metrics, record_cache_stats
+from ..health import check_health
+from ..inference import CircuitOpenError
 from .. import login_manager
-from flask import render_template, request, url_for, redirect, json, jsonify, send_file
+from flask import render_template, request, url_for, redirect, json, jsonify, send_file, stream_with_context, Response, abort, current_app
 from flask_login import login_required, login_user, logout_user, current_user
-from PIL import Image
-from sqlalchemy.sql import text
+from sqlalchemy import select
+from sqlalchemy.orm import defer
 
 # home page
 @routes.route('/')
@@ -50,36 +55,29 @@ def predict():
     errors = None
     pred = None
 
-    # check validation, then see how
-    if form.validate_on_submit():
+    # check validation (which decodes the image as well), then see how
+    with timed('validate'):
+        valid = form.validate_on_submit()
+    if valid:
         # if no errors, proceed to do check the image size and the model selected, and scale them if needed
-        img = Image.open(form.data['image'])                    # convert the data to pillow image object
+        img = form.image.decoded                                # the image, already decoded when it was validated
         model_input_size = int(form.data['model'].split()[0])   # get the model input size
 
-        # first check if the image size matches the model size, if not then perform a resize
-        if model_input_size != img.size[0]:
-            img = img.resize((model_input_size, model_input_size))
-
-        # now we can send the image to the model server
-        pred, probs = make_prediction(model_input_size, img)
-
-        # then check if the user is authenticated, then proceed to store in the database
-        if current_user.is_authenticated:
-
-            history = History(
-                probs = probs[0],                              # stores list of probabilites as pickle object
-                image = img.tobytes(),                      # stores the image data as bytes
-                user_id = current_user.id,                  # stores user id, foreign key to the user model
-                model = str(model_input_size),              # stores the model used
-                highest_prob = max(probs[0]),                  # stores the highest likely probability
-                pred = pred                                 # stores the predicted vegetable
-            )
-
-            error = add_entry(history)
+        # then predict, and store it in the database if the user is authenticated (with write behind, after the response)
+        user_id = current_user.id if current_user.is_authenticated else None
+        try:
+            pred, probs, history, error = predict_and_save(img, model_input_size, user_id, defer_save=True)
             if error:
                 print(error)
                 error = 'Error adding the predicted data into database.'
-           
+        except CircuitOpenError as error:
+            # the model server is down, which is already known so this didn't wait for it
+            print(error)
+            errors = [['Error: The model is not available right now, please try again in a bit']]
+        except Exception as error:
+            print(error)
+            errors = [['Error: The model could not make the prediction, please try again']]
+
     else:
         # get the errors which will be displayed to the user
         errors = list(form.errors.values())
@@ -87,6 +85,95 @@ def predict():
 
     return render_template('index.html', title='Home', form=form, errors=errors, prediction=pred, current_user=current_user)
 
+# the api's answer when the model's circuit breaker is open, with when the breaker lets the next request through
+def model_unavailable(model_input_size):
+    return jsonify({'errors' : ['The model is not available right now']}), 503, {'Retry-After' : str(model_retry_after(model_input_size))}
+
+# turn a prediction job into what the api sends back
+def job_to_json(job):
+    data = {
+        'job_id' : job.id,
+        'status' : job.status,
+        'model' : f'{job.model} pixels model',
+        'status_url' : url_for('routes.get_job', job_id=job.id)
+    }
+    if job.status == 'done':
+        data['prediction'] = job.pred
+        data['probabilities'] = dict(zip(LABELS, job.probs))
+        data['history_id'] = job.history_id
+    if job.error:
+        data['error'] = job.error
+    return data
+
+# prediction through the api, takes the same form data as the prediction page but returns a job id straight away
+# the prediction then runs in the background and the job can be polled at the status url
+@routes.route('/api/predict', methods=['POST'])
+def api_predict():
+    form = ImageForm()
+
+    with timed('validate'):
+        valid = form.validate_on_submit()
+    if not valid:
+        return jsonify({'errors' : [error for errors in form.errors.values() for error in errors]}), 400
+
+    # the image was already decoded when it was validated, so the job gets that instead of the upload
+    model_input_size = int(form.data['model'].split()[0])
+    user_id = current_user.id if current_user.is_authenticated else None
+
+    # no point in making a job that will fail straight away
+    if not model_available(model_input_size):
+        return model_unavailable(model_input_size)
+
+    job, error = get_job_runner().submit(form.image.decoded, model_input_size, user_id)
+    if error:
+        print(error)
+        return jsonify({'errors' : ['Error creating the prediction job']}), 500
+
+    return jsonify(job_to_json(job)), 202, {'Location' : url_for('routes.get_job', job_id=job.id)}
+
+# prediction of many images in one request, either as many files under images or as a zip under archive
+# every image is checked and predicted on its own, and the results are streamed back as one json object per line
+@routes.route('/api/predict/batch', methods=['POST'])
+def api_predict_batch():
+    form = BatchImageForm()
+
+    if not form.validate_on_submit():
+        return jsonify({'errors' : [error for errors in form.errors.values() for error in errors]}), 400
+
+    model_input_size = int(form.data['model'].split()[0])
+    user_id = current_user.id if current_user.is_authenticated else None
+    if not model_available(model_input_size):
+        return model_unavailable(model_input_size)
+    uploads = iter_uploads(form.images.data or [], form.archive.data)
+
+    def generate():
+        count = errors = 0
+        try:
+            for result in predict_batch_and_save(uploads, model_input_size, user_id):
+                count += 1
+                errors += 'errors' in result
+                yield json.dumps(result) + '\n'
+        except Exception as error:
+            # the response has already started, so the error can only go at the end
+            print(error)
+            yield json.dumps({'errors' : ['Error making the predictions']}) + '\n'
+        yield json.dumps({'done' : True, 'images' : count, 'failed' : errors}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# get the status of a prediction job, ?wait=<seconds> holds the request until the job is finished or the time is up
+@routes.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    wait = request.args.get('wait', 0, type=float)
+    job = wait_for_job(job_id, max(wait, 0))
+
+    # jobs of a user can only be seen by that user
+    user_id = current_user.id if current_user.is_authenticated else None
+    if job is None or (job.user_id is not None and job.user_id != user_id):
+        return jsonify({'errors' : ['Job not found']}), 404
+
+    return jsonify(job_to_json(job))
+
 # create account
 @routes.route('/signup', methods=['POST'])
 def post_signup():
@@ -153,8 +240,7 @@ def change_email():
     # validate the form and then see how
     if e_form.validate_on_submit():
         # first, check if the current email is the correct one
-        current_user_email = User.query.get(current_user.id).email
-        if current_user_email != e_form.data['current_email']:
+        if current_user.email != e_form.data['current_email']:
             # if there is email mismatch, then error
             error = [['Error, current email does not match with your existing email!']]
             return render_template('/setting.html', title='Setting', forms=[e_form, ChangePasswordForm()], errors=error, success = None, current_user=current_user)
@@ -183,8 +269,7 @@ def change_password():
     # validate password
     if p_form.validate_on_submit():
         # first check if the current password matches the existing one
-        current_user_pass = User.query.get(current_user.id).password
-        if current_user_pass != p_form.data['current_password']:
+        if current_user.password != p_form.data['current_password']:
             error = [['Error, current password does not match with your existing password!']]
             return render_template('/setting.html', title='Setting', forms=[ChangeEmailForm(), p_form], errors=error, success = None, current_user=current_user)
         
@@ -207,10 +292,10 @@ def change_password():
 def deleteUser():
     # simple just attempt to delete the user
     try:
-        # get the user and delete it, and redirect back to the home page
-        user = User.query.get(current_user.id)
-        db.session.delete(user)
-        db.session.commit()
+        # delete the user with everything of theirs, straight in the database without loading any of it, and redirect back to the home page
+        error = delete_user_data(current_user.id)
+        if error:
+            raise error
         return redirect(url_for('routes.home'))
     except Exception as error:
         print(error)
@@ -221,7 +306,8 @@ def deleteUser():
 @login_required
 def get_history(history_id):
     # attempt to fetch the history based on the user's own id and the history id inputted
-    history = History.query.filter_by(id = history_id, user_id = current_user.id).first()
+    # the image is left out, the page gets it from the image endpoint instead
+    history = History.query.options(defer(History.image)).filter_by(id = history_id, user_id = current_user.id).first()
 
     text_groups = []      # groups of text to display the user
     error = None
@@ -245,80 +331,180 @@ def get_history(history_id):
         text_groups.append({'Model used' : f'{history.model} pixels model'})
         text_groups.append({'Predicted time' : f'{history.timestamp}'})
 
-        # and lastly get the image
-        image = Image.frombytes(mode='RGB', data=history.image, size=[int(history.model), int(history.model)])
-        image.save('application/static/temp.png')
+    image_url = None
+    if history is not None:
+        image_url = history_image_url(db.session.execute(select(History.id, *image_version_columns()).where(History.id == history.id)).first())
 
-    return render_template('history.html', title='History', text_groups=text_groups, error=error, history_id=history.id)
+    return render_template('history.html', title='History', text_groups=text_groups, error=error, history_id=history_id, image_url=image_url)
+
+# get the image of a history, encoded only when it's not already in a format the browser can show
+# the url has the version of the image in it (?v=), and that version never changes, so the browser can keep it for good
+# without the version (or with one that's not the image's any more) it has to ask again with the etag every time
+@routes.route('/history/<history_id>/image', methods=['GET'])
+@login_required
+def get_history_image(history_id):
+    # first only get what the etag is made of, so a conditional request never has to touch the image itself
+    row = db.session.execute(
+        select(History.id, *image_version_columns())
+        .where(History.id == history_id, History.user_id == current_user.id)
+    ).first()
+    if row is None:
+        abort(404)
+
+    version = history_image_version(row)
+    etag = history_image_etag(row.id, version)
+    headers = {'Cache-Control' : 'private, max-age=31536000, immutable' if request.args.get('v') == version else 'private, no-cache'}
+    if etag in request.if_none_match:
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    # then either the cache has it already, or it gets encoded and kept for next time
+    cache = get_image_cache()
+    cached = cache.get(etag)
+    if cached is None:
+        history = db.session.get(History, row.id)
+        cached = history_image_response_data(history)
+        cache.set(etag, cached)
+
+    data, mimetype = cached
+    response = Response(data, mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    return response
+
+# the user's other histories that look like this one, closest first
+# only the hashes kept in memory are searched, the images themselves come from the image endpoint
+@routes.route('/history/<int:history_id>/similar', methods=['GET'])
+@login_required
+def get_similar_histories(history_id):
+    history = History.query.options(defer(History.image)).filter_by(id = history_id, user_id = current_user.id).first()
+    if history is None:
+        return render_template('similar.html', title='Similar images', error='Result is not available', results=None, history_id=history_id)
+
+    matches = similar_histories(history)
+    rows = {row.id : row for row in db.session.execute(
+        select(History.id, History.model, History.pred, History.highest_prob, *image_version_columns()).where(History.id.in_([match[0] for match in matches]))
+    )}
+
+    results = []
+    for match_id, distance in matches:
+        # one that was deleted since the index was loaded
+        row = rows.get(match_id)
+        if row is None:
+            continue
+        # result structure = [image url, model used, prediction, probability, id, how many bits of the hashes differ]
+        results.append([history_image_url(row), row.model, row.pred, round(row.highest_prob * 100, 2), row.id, distance])
+
+    image_url = history_image_url(db.session.execute(select(History.id, *image_version_columns()).where(History.id == history.id)).first())
+    return render_template('similar.html', title='Similar images', error=None, results=results, history_id=history_id, image_url=image_url)
 
 # get the histories list
+# the filters of the search form, as search_histories takes them. "Any" means no filter at all
+def search_filters(form) -> dict:
+    return {
+        'model' : form.data['model'].split()[0] if form.data['model'] != 'Any' else None,
+        'pred' : form.data['prediction'] if form.data['prediction'] != 'Any' else None,
+        'min_prob' : form.data['prob_pred'] / 100,
+        'label' : form.data['label'] if form.data['label'] != 'Any' else None,
+        'top_k' : form.data['top_k'],
+        'label_min_prob' : form.data['label_prob'] / 100 if form.data['label_prob'] else None,
+        'max_margin' : form.data['max_margin'] / 100 if form.data['max_margin'] is not None else None,
+        'date_from' : form.data['date_from'],
+        'date_to' : form.data['date_to']
+    }
+
 @routes.route('/search', methods=['POST'])
 @login_required
 def post_search():
     form = SearchForm()
     errors = None
     results = []
+    next_after = None
     
     if form.validate_on_submit():
-
-        # as I will just use the db.session.execute to run an SQL query to get the results, I will piece together some code
-        filter_statements = []
-        # if the model field is not "Any", then get whatever result and append into the "where" clause of the sql statement
-        if form.data['model'] != 'Any':
-            data = form.data['model'].split()[0]
-            filter_statements.append(f'model = "{data}"')
-        
-        # same thing for the prediction
-        if form.data['prediction'] != 'Any':
-            data = form.data['prediction']
-            filter_statements.append(f'pred = "{data}"')
-        
-        # same for probs but filter by if is at least the user specified amount
-        if form.data['prob_pred'] != 0:
-            filter_statements.append(f'highest_prob >= {form.data["prob_pred"] / 100}')
-        
-        # and more importantly, must be the current user as well
-        filter_statements.append(f'user_id = {current_user.id}')
-        
-        # join the statement with the and keyword
-        joined_statement = ' and '.join(filter_statements)
-        
-        # now attempt to construct an sql statement that can get the filtered results
-        sql = f'select highest_prob, pred, image, model, id from history where ' + joined_statement + ';'
-        cursor = db.session.execute(text(sql))
-
-        # fetch all the results and then transform each image data into an Image object and save them temporarily
-        raw_results = cursor.fetchall()
+        # get the page of results, and must be of the current user as well, the images come from the image endpoint
+        rows, next_after = search_histories(current_user.id, after=form.data['after'], **search_filters(form))
 
         results = []
-        for i, raw_result in enumerate(raw_results):
-            tmp_img = Image.frombytes(mode='RGB', data=raw_result[2], size=[int(raw_result[3]), int(raw_result[3])])
-            tmp_img.save(f'application/static/temp{i + 1}.png')
-
-            # result structure = [image path, model used, prediction, probability, id]
-            results.append([f'../static/temp{i + 1}.png', raw_result[3], raw_result[1], round(raw_result[0] * 100, 2), raw_result[4]])
+        for row in rows:
+            # result structure = [image url, model used, prediction, probability, id]
+            results.append([history_image_url(row), row.model, row.pred, round(row.highest_prob * 100, 2), row.id])
 
     else:
         errors = list(form.errors.values())
 
-    return render_template('search.html', title='Search', form=form, results=results, errors=errors)
+    return render_template('search.html', title='Search', form=form, results=results, errors=errors, next_after=next_after)
+
+# download all of the user's histories, as csv, ndjson or a zip with the images as well
+# the file is made as it's sent, so no matter how many histories there are, it's never all in memory at once
+EXPORTS = {
+    'csv' : (export_csv, 'text/csv'),
+    'ndjson' : (export_ndjson, 'application/x-ndjson'),
+    'zip' : (export_zip, 'application/zip')
+}
 
-# delete the history entry
-@routes.route('/delete_history/<history_id>', methods=['POST'])
+@routes.route('/history/export.<any(csv, ndjson, zip):export_format>', methods=['GET'])
+@login_required
+def export_history(export_format):
+    export, mimetype = EXPORTS[export_format]
+    response = Response(stream_with_context(export(current_user.id)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=history.{export_format}'
+    return response
+
+# the search page again with an error, for when deleting goes wrong
+def delete_error(message):
+    return render_template('search.html', title='Search', form=SearchForm(), results=None, errors=[[message]])
+
+# delete the history entry, only if it's the user's own
+@routes.route('/delete_history/<int:history_id>', methods=['POST'])
 @login_required
 def deleteHistory(history_id):
-    # again, try to just delete the history
-    try:
-        # get the history and delete it, and then stay in the search page
-        history = History.query.get(history_id)
-        db.session.delete(history)
-        db.session.commit()
-        return redirect(url_for('routes.search'))
-    except Exception as error:
-        # if got error, display the error message
-        form = SearchForm()
-        errors = [['Error deleting history result']]
-        return render_template('search.html', title='Search', form=form, results=None, errors=errors)
+    deleted, error = delete_histories(current_user.id, [history_id])
+    if error:
+        print(error)
+    if error or not deleted:
+        return delete_error('Error deleting history result')
+    return redirect(url_for('routes.search'))
+
+# delete the histories ticked on the search page
+@routes.route('/delete_histories', methods=['POST'])
+@login_required
+def delete_selected_histories():
+    history_ids = request.form.getlist('history_ids', type=int)
+    if not history_ids:
+        return delete_error('Error: no history results selected')
+
+    _, error = delete_histories(current_user.id, history_ids)
+    if error:
+        print(error)
+        return delete_error('Error deleting history results')
+    return redirect(url_for('routes.search'))
+
+# delete every history matching the search, not just the page that's shown
+@routes.route('/search/delete', methods=['POST'])
+@login_required
+def delete_matching_histories():
+    form = SearchForm()
+    if not form.validate_on_submit():
+        return render_template('search.html', title='Search', form=form, results=None, errors=list(form.errors.values()))
+
+    _, error = delete_histories(current_user.id, **search_filters(form))
+    if error:
+        print(error)
+        return delete_error('Error deleting history results')
+    return redirect(url_for('routes.search'))
+
+# the timings and counters of every worker, in the prometheus text format
+@routes.route('/metrics', methods=['GET'])
+def metrics():
+    record_cache_stats(current_app)
+    return Response(render_metrics(current_app.config['METRICS_DIR']), mimetype='text/plain; version=0.0.4')
+
+# whether this worker can take requests: 200 when the database is ready (with the models' readiness in the body), 503 when it's not
+@routes.route('/healthz', methods=['GET'])
+def healthz():
+    health, healthy = check_health()
+    return jsonify(health), 200 if healthy else 503
 
 # handles error 404
 @routes.app_errorhandler(404)
@@ -326,6 +512,14 @@ def page_not_found(error):
     msg = 'Error 404: Page not found'
     return render_template('blank.html', title=msg, error=msg, current_user=current_user), 404
 
+# handles error 413, the upload is bigger than MAX_CONTENT_LENGTH and was refused without reading the rest of it
+@routes.app_errorhandler(413)
+def request_too_large(error):
+    msg = 'Error 413: Upload is too large'
+    if request.path.startswith('/api/'):
+        return jsonify({'errors' : [msg]}), 413
+    return render_template('blank.html', title=msg, error=msg, current_user=current_user), 413
+
 # handles error 401
 @routes.app_errorhandler(401)
 def page_not_found(error):
@@ -0,0 +1,111 @@
+# finding the histories of a user that look alike, like the same shot uploaded twice or a near miss of the model
+# every history gets a 64 bit difference hash of its image when it's stored, and images that look alike have hashes that differ in only a few bits
+# the hashes of a user are kept in memory as a numpy array, so a search is a xor and a bit count over all of them without touching any image
+import numpy as np
+from PIL import Image
+from flask import current_app
+from sqlalchemy import select, func
+from . import db
+from .models import History
+from .cache import LRUCache
+from .config import get_setting
+
+HASH_SIZE = 8
+
+# how many bits are set in every possible byte
+_BIT_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# difference hash: shrink to 9x8 in grayscale and set a bit for every pixel that's brighter than the one to its right
+# it's stored as a signed 64 bit integer, since that's what the database can hold
+def image_hash(img) -> int:
+    pixels = np.asarray(img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>i8')[0])
+
+# the number of bits that differ between each of the hashes and the one hash
+def hamming_distances(hashes, query) -> np.ndarray:
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.int64), np.int64(query))
+    return _BIT_COUNTS[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+# the hashes of one user's histories, never changed once made so it can be searched from any thread
+class HashIndex(object):
+    def __init__(self, ids, hashes) -> None:
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.hashes = np.asarray(hashes, dtype=np.int64)
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    @property
+    def max_id(self) -> int:
+        return int(self.ids.max()) if len(self.ids) else 0
+
+    # a new index with the newer histories added on
+    def extended(self, ids, hashes) -> 'HashIndex':
+        return HashIndex(np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)]), np.concatenate([self.hashes, np.asarray(hashes, dtype=np.int64)]))
+
+    # the closest histories to the hash, up to limit of them and at most max_distance bits apart
+    # returns a list of (history id, distance), closest first and then newest first
+    def search(self, query, limit=10, max_distance=64, exclude=None) -> list:
+        distances = hamming_distances(self.hashes, query)
+        mask = distances <= max_distance
+        if exclude is not None:
+            mask &= self.ids != exclude
+        ids, distances = self.ids[mask], distances[mask]
+
+        # only the closest ones need to be sorted
+        if len(ids) > limit:
+            closest = np.argpartition(distances, limit - 1)[:limit]
+            ids, distances = ids[closest], distances[closest]
+        order = np.lexsort((-ids, distances))
+        return [(int(ids[i]), int(distances[i])) for i in order]
+
+
+# the indexes of the users that searched lately, per worker
+def get_similarity_indexes() -> LRUCache:
+    if 'similarity_indexes' not in current_app.extensions:
+        current_app.extensions['similarity_indexes'] = LRUCache(get_setting('SIMILARITY_INDEX_USERS'))
+    return current_app.extensions['similarity_indexes']
+
+# get the index of the user, checked against the database by the count and the newest id, which comes straight from an index
+# when only new histories were added since (by this or another worker) just those are loaded, otherwise it's loaded all over again
+# only added ones is when the histories after the index's newest make up all of the difference in the count,
+# anything else (like another worker deleting one and adding one, which keeps the count) means something in the index is gone
+def get_user_index(user_id) -> HashIndex:
+    indexes = get_similarity_indexes()
+    hashed = (History.user_id == user_id, History.image_hash.is_not(None))
+    count, max_id = db.session.execute(select(func.count(), func.max(History.id)).where(*hashed)).one()
+
+    index = indexes.get(user_id)
+    if index is not None and (index.count, index.max_id) != (count, max_id or 0):
+        rows = []
+        if count > index.count:
+            rows = db.session.execute(select(History.id, History.image_hash).where(*hashed, History.id > index.max_id)).all()
+        index = index.extended([row[0] for row in rows], [row[1] for row in rows]) if rows and index.count + len(rows) == count else None
+
+    if index is None:
+        rows = db.session.execute(select(History.id, History.image_hash).where(*hashed)).all()
+        index = HashIndex([row[0] for row in rows], [row[1] for row in rows])
+    indexes.set(user_id, index)
+    return index
+
+# drop the index of the user, when its histories are deleted
+def forget_user_index(user_id) -> None:
+    get_similarity_indexes().pop(user_id)
+
+# the histories of the same user that look like this one, as a list of (history id, distance)
+def similar_histories(history, limit=None, max_distance=None) -> list:
+    # the ones from before the hashes were stored get theirs now
+    if history.image_hash is None:
+        from .routes.functions import decode_history_image
+        history.image_hash = image_hash(decode_history_image(history.image, history.image_format, history.image_width, history.image_height, history.model))
+        db.session.commit()
+
+    return get_user_index(history.user_id).search(
+        history.image_hash,
+        limit or get_setting('SIMILAR_RESULTS'),
+        get_setting('SIMILAR_MAX_DISTANCE') if max_distance is None else max_distance,
+        exclude=history.id
+    )
@@ -0,0 +1,267 @@
+# write behind for the histories of the prediction page, so the request doesn't wait for the database commit
+# the histories go onto a queue in the worker, and a thread stores them in batches: once there's a batch's worth,
+# or once the first of them has waited the interval. Whatever is left is stored when the worker exits,
+# and a batch that can't be stored is spilled into a file, which is stored again later (by any worker) once the database takes writes
+# a spilled batch that keeps failing (like one with a history the database will never take) is put aside in the quarantine folder
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import base64
+import datetime
+import threading
+from flask import current_app
+from . import db
+from .models import History
+from .config import get_setting
+
+# the columns of a history as they go onto the queue, the history itself belongs to the request's session
+COLUMNS = ['user_id', 'highest_prob', 'pred', 'image', 'image_format', 'image_width', 'image_height', 'image_hash', 'model']
+
+# the history as plain values, with the time of the prediction rather than of when it gets stored
+def history_record(history) -> dict:
+    record = {name : getattr(history, name) for name in COLUMNS}
+    record['probs'] = history.probs
+    record['timestamp'] = datetime.datetime.now(datetime.timezone.utc)
+    return record
+
+def record_history(record) -> History:
+    return History(**record)
+
+# the records in a spill file are json lines, with the image in base64 and the time as text
+def dump_record(record) -> str:
+    return json.dumps(dict(record, image=base64.b64encode(record['image']).decode(), timestamp=record['timestamp'].isoformat())) + '\n'
+
+def load_record(line) -> dict:
+    record = json.loads(line)
+    record['image'] = base64.b64decode(record['image'])
+    record['timestamp'] = datetime.datetime.fromisoformat(record['timestamp'])
+    return record
+
+# how many times a spill file failed to be stored is kept in its name, like <name>.2.ndjson, so that every worker knows it
+def spill_attempts(name) -> tuple:
+    stem = name[:-len('.ndjson')]
+    base, _, attempts = stem.rpartition('.')
+    return (base, int(attempts)) if base and attempts.isdigit() else (stem, 0)
+
+def process_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass        # it's there, it just belongs to someone else
+    return True
+
+class HistoryWriter(object):
+    def __init__(self, app, batch_size, interval, max_queue, spill_dir, max_attempts=5) -> None:
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self.spill_dir = spill_dir
+        self.max_attempts = max_attempts
+        self._queue = None
+        self._thread = None
+        self._stopping = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    # the queue and the thread are made on first use, and again after a fork since the thread doesn't come along
+    def _ensure_started(self) -> queue.Queue:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_queue)
+                self._stopping = threading.Event()
+                self._thread = threading.Thread(target=self._loop, daemon=True, name='history-writer')
+                self._pid = os.getpid()
+                self._thread.start()
+                atexit.register(self.shutdown)
+            return self._queue
+
+    # put the history onto the queue, False when the queue is full and the caller has to store it itself
+    def put(self, history) -> bool:
+        try:
+            self._ensure_started().put_nowait(history_record(history))
+            return True
+        except queue.Full:
+            return False
+
+    # wait until everything on the queue so far has been stored (or spilled)
+    def join(self) -> None:
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    # the records for the next batch: waits for the first one, and then for up to the interval for the rest
+    def _take(self) -> list:
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            timeout = self.interval if deadline is None else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            if deadline is None:
+                deadline = time.monotonic() + self.interval
+        return batch
+
+    # nothing that goes wrong with one batch is allowed to end the thread, or nothing would be stored by this worker after that
+    def _loop(self) -> None:
+        with self.app.app_context():
+            try:
+                self.recover_spills()
+                self.replay_spills()
+            except Exception as error:
+                print(error)
+            finally:
+                db.session.remove()
+
+        while True:
+            batch = self._take()
+            if batch:
+                try:
+                    self.flush(batch)
+                except Exception as error:
+                    print(error)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            elif self._stopping.is_set():
+                return
+
+    # whether there are spilled batches waiting to be stored
+    def has_spills(self) -> bool:
+        return bool(self.spill_dir) and os.path.isdir(self.spill_dir) and any(name.endswith('.ndjson') for name in os.listdir(self.spill_dir))
+
+    # store a batch in one transaction, or spill it when that fails. A batch that gets stored means the database is fine again,
+    # so any spilled batches are stored as well
+    def flush(self, batch) -> None:
+        from .routes.functions import add_entries
+
+        with self.app.app_context():
+            try:
+                try:
+                    error = add_entries([record_history(record) for record in batch])
+                except Exception as e:
+                    error = e       # like a record that doesn't make a history, it still goes into the spill file rather than being lost
+                if error:
+                    print(error)
+                    self.spill(batch)
+                elif self.has_spills():
+                    self.replay_spills()
+            finally:
+                db.session.remove()
+
+    # write the batch into a file of its own, which is only seen by the others once it's complete
+    def spill(self, batch) -> str | None:
+        if not self.spill_dir:
+            print(f'lost {len(batch)} histories, there is no WRITE_BEHIND_SPILL_DIR')
+            return None
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f'{os.getpid()}-{uuid.uuid4().hex}.ndjson')
+        with open(path + '.tmp', 'w') as f:
+            f.writelines(dump_record(record) for record in batch)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        return path
+
+    # put back the spill files claimed by a worker that died while storing them, so they aren't stuck as claimed for good
+    # run when the writer starts, which is also when a claim with this worker's pid can only be left over from an earlier process
+    def recover_spills(self) -> int:
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return 0
+
+        recovered = 0
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith('.replaying'):
+                continue
+            path, pid = name[:-len('.replaying')].rsplit('.', 1)
+            if pid.isdigit() and int(pid) != os.getpid() and process_alive(int(pid)):
+                continue        # still being stored
+            try:
+                os.rename(os.path.join(self.spill_dir, name), os.path.join(self.spill_dir, path))
+                recovered += 1
+            except OSError:
+                pass            # another worker put it back first
+        return recovered
+
+    # store the spilled batches, each one is claimed by renaming it so that two workers never store the same one
+    # a batch that still can't be stored goes back with one more attempt in its name, and into the quarantine folder once it
+    # has had all of them, so a batch the database will never take only holds up the others for so long. Returns how many histories were stored
+    def replay_spills(self) -> int:
+        from .routes.functions import add_entries
+
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return 0
+
+        stored = 0
+        for name in sorted(os.listdir(self.spill_dir)):
+            if not name.endswith('.ndjson'):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            claimed = f'{path}.{os.getpid()}.replaying'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue        # another worker got it first
+
+            try:
+                with open(claimed) as f:
+                    batch = [load_record(line) for line in f if line.strip()]
+                error = add_entries([record_history(record) for record in batch])
+            except Exception as e:
+                error = e       # like a file that isn't valid json
+            if not error:
+                os.remove(claimed)
+                stored += len(batch)
+                continue
+
+            print(error)
+            base, attempts = spill_attempts(name)
+            if attempts + 1 >= self.max_attempts:
+                os.makedirs(os.path.join(self.spill_dir, 'quarantine'), exist_ok=True)
+                os.rename(claimed, os.path.join(self.spill_dir, 'quarantine', f'{base}.ndjson'))
+                print(f'quarantined {name} after {attempts + 1} attempts')
+            else:
+                os.rename(claimed, os.path.join(self.spill_dir, f'{base}.{attempts + 1}.ndjson'))
+            break       # the database may well be down again, the rest waits for the next batch that works
+        return stored
+
+    # store whatever is still on the queue before the worker exits, spilling it if the thread can't get it done in time
+    def shutdown(self, timeout=10) -> None:
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+        if self._thread.is_alive():
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self.spill(batch)
+        self._pid = None
+
+
+# get the history writer of the current app, made on first use
+def get_history_writer() -> HistoryWriter:
+    if 'history_writer' not in current_app.extensions:
+        current_app.extensions['history_writer'] = HistoryWriter(
+            current_app._get_current_object(),
+            get_setting('WRITE_BEHIND_BATCH_SIZE'),
+            get_setting('WRITE_BEHIND_INTERVAL_MS') / 1000,
+            get_setting('WRITE_BEHIND_MAX_QUEUE'),
+            get_setting('WRITE_BEHIND_SPILL_DIR'),
+            get_setting('WRITE_BEHIND_SPILL_ATTEMPTS')
+        )
+    return current_app.extensions['history_writer']
@@ -0,0 +1,13 @@
+# benchmarks, run each one from the repo root with python -m benchmarks.<name>, or all of them with python -m benchmarks
+import numpy as np
+
+# the usual numbers of a list of timings in milliseconds
+def summarize(samples) -> dict:
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'count' : int(len(samples)),
+        'mean_ms' : float(samples.mean()),
+        'p50_ms' : float(np.percentile(samples, 50)),
+        'p99_ms' : float(np.percentile(samples, 99)),
+        'max_ms' : float(samples.max())
+    }
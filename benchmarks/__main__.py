@@ -0,0 +1,79 @@
+# the whole benchmark suite in one go, without the real model server: /predict against the fake one, the transformer,
+# the encoders and the search, saved together in one json file along with the commit it ran on
+# --compare prints how much every number changed against an earlier run, --quick is a smaller run to check nothing is broken
+# python -m benchmarks [--quick] [--output results.json] [--compare baseline.json]
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+from benchmarks import encoders, predict, search, transformer
+
+# the numbers to compare between runs for each benchmark, and the fields that tell its results apart
+COMPARED = {
+    'predict' : (('model', 'signed_in', 'concurrency'), ('requests_per_second', 'p50_ms', 'p99_ms')),
+    'transformer' : (('model', 'reused_buffer'), ('p50_ms', 'p99_ms')),
+    'encoders' : (('model', 'encoder'), ('bytes', 'encode_ms', 'decode_ms')),
+    'search' : (('rows', 'search', 'page'), ('p50_ms', 'p99_ms'))
+}
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(quick=False) -> dict:
+    benchmarks = {
+        'predict' : lambda: predict.run(requests=20 if quick else 200, concurrency=(1, 4), latency=0.01),
+        'transformer' : lambda: transformer.run(repeat=20 if quick else 200),
+        'encoders' : lambda: encoders.run(repeat=5 if quick else 50),
+        'search' : lambda: search.run(rows=(1000,) if quick else (1000, 10000, 100000), repeat=5 if quick else 20, others=10000 if quick else 200000)
+    }
+
+    results = {
+        'commit' : git_commit(),
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'timestamp' : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'quick' : quick,
+        'results' : {}
+    }
+    for name, benchmark in benchmarks.items():
+        print(f'running {name}', flush=True)
+        results['results'][name] = benchmark()
+    return results
+
+# every compared number of this run next to the same one in the baseline
+def compare(results, baseline) -> list:
+    lines = []
+    for name, (keys, values) in COMPARED.items():
+        before = {tuple(r[key] for key in keys) : r for r in baseline['results'].get(name, [])}
+        for result in results['results'].get(name, []):
+            key = tuple(result[key] for key in keys)
+            if key not in before:
+                continue
+            for value in values:
+                old, new = before[key][value], result[value]
+                change = (new - old) / old * 100 if old else 0
+                lines.append(f'{name:<12} {" ".join(str(k) for k in key):<28} {value:<20} {old:>10.2f} {new:>10.2f} {change:>+8.1f}%')
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true', help='fewer requests and rows, to check that everything runs')
+    parser.add_argument('--output', default='benchmark_results.json', help='save the results as json')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'{"benchmark":<12} {"case":<28} {"value":<20} {"before":>10} {"after":>10} {"change":>9}')
+        for line in compare(results, baseline):
+            print(line)
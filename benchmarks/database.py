@@ -0,0 +1,116 @@
+# write throughput of the history table with several processes writing at once, like the gunicorn workers do,
+# for a few sqlite settings (see SQLITE_* in the config) or for any other database given with --database-url
+# python -m benchmarks.database [--writers 1 4 8] [--seconds 3] [--database-url postgresql://...] [--output results.json]
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+# the sqlite settings to compare, as the environment variables the config reads
+# the first is how sqlite behaved before any of them existed, and the last is the defaults
+PROFILES = {
+    'rollback_journal' : {'SQLITE_JOURNAL_MODE' : 'delete', 'SQLITE_SYNCHRONOUS' : 'full', 'SQLITE_CACHE_SIZE' : '-2000', 'SQLITE_MMAP_SIZE' : '0', 'SQLITE_BUSY_TIMEOUT' : '5000'},
+    'wal_no_busy_timeout' : {'SQLITE_JOURNAL_MODE' : 'wal', 'SQLITE_SYNCHRONOUS' : 'normal', 'SQLITE_CACHE_SIZE' : '-2000', 'SQLITE_MMAP_SIZE' : '0', 'SQLITE_BUSY_TIMEOUT' : '0'},
+    'wal' : {'SQLITE_JOURNAL_MODE' : 'wal', 'SQLITE_SYNCHRONOUS' : 'normal', 'SQLITE_CACHE_SIZE' : '-2000', 'SQLITE_MMAP_SIZE' : '0', 'SQLITE_BUSY_TIMEOUT' : '10000'},
+    'wal_cache_mmap' : {'SQLITE_JOURNAL_MODE' : 'wal', 'SQLITE_SYNCHRONOUS' : 'normal', 'SQLITE_CACHE_SIZE' : '-16000', 'SQLITE_MMAP_SIZE' : str(64 * 1024 * 1024), 'SQLITE_BUSY_TIMEOUT' : '10000'}
+}
+
+# the app has to be imported after the environment is set, since the config reads it when it's imported,
+# which is why everything that touches the app runs in a fresh process
+def make_app(env):
+    os.environ.update(env)
+    from application import create_app
+    return create_app('PROD')
+
+# one writer process, storing histories through the same path as the website until the time is up
+def writer(env, start, seconds, results) -> None:
+    from application import db
+    from application.models import History
+    from application.routes.functions import add_entry
+
+    writes = errors = 0
+    try:
+        app = make_app(env)
+        with app.app_context():
+            start.wait()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                history = History(user_id=1, probs=[0.5, 0.25] + [0.25 / 13] * 13, highest_prob=0.5, pred='Bean', image=b'\0' * 2048, model='31')
+                if add_entry(history) is None:
+                    writes += 1
+                else:
+                    errors += 1
+            db.session.remove()
+    finally:
+        # always answer, otherwise the benchmark would wait for this writer forever
+        results.put((writes, errors))
+
+# make the tables and the user the histories belong to
+def prepare(env) -> None:
+    from application import db
+    from application.models import User
+
+    app = make_app(env)
+    with app.app_context():
+        if db.session.get(User, 1) is None:
+            db.session.add(User(id=1, email='bench@test.com', password='Bench12345$'))
+            db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+def run_one(env, writers, seconds) -> dict:
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=prepare, args=(env,))
+    process.start()
+    process.join()
+
+    start, results = context.Event(), context.Queue()
+    processes = [context.Process(target=writer, args=(env, start, seconds, results)) for _ in range(writers)]
+    for process in processes:
+        process.start()
+
+    time.sleep(2)       # give them all time to start up before the clock starts
+    start.set()
+    counts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    writes, errors = sum(count[0] for count in counts), sum(count[1] for count in counts)
+    return {'writers' : writers, 'writes' : writes, 'errors' : errors, 'writes_per_second' : writes / seconds}
+
+def run(writers=(1, 4, 8), seconds=3, database_url=None) -> list:
+    results = []
+    if database_url:
+        profiles = {'database_url' : {'DATABASE_URL' : database_url}}
+    else:
+        profiles = PROFILES
+
+    for name, env in profiles.items():
+        for count in writers:
+            with tempfile.TemporaryDirectory() as folder:
+                env = dict(env)
+                env.setdefault('DATABASE_URL', f'sqlite:///{folder}/bench.db')
+                result = {'profile' : name}
+                result.update(run_one(env, count, seconds))
+                results.append(result)
+                print(f'{name} with {count} writers: {result["writes_per_second"]:.1f} writes/s, {result["errors"]} errors', flush=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--database-url', help='benchmark this database instead of the sqlite settings')
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.writers, args.seconds, args.database_url)
+    print(f'{"profile":<20} {"writers":>7} {"writes":>7} {"errors":>7} {"writes/s":>9}')
+    for r in results:
+        print(f'{r["profile"]:<20} {r["writers"]:>7} {r["writes"]:>7} {r["errors"]:>7} {r["writes_per_second"]:>9.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,92 @@
+# times every stage of turning an uploaded jpeg into the model input, decoding it whole and resizing (the old way)
+# against decoding it at a reduced scale, for every resize filter, along with how far the input ends up from the old way
+# python -m benchmarks.decode [--repeat 20] [--side 512] [--output results.json]
+import argparse
+import io
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+from application.config import BaseConfig
+from application.routes.functions import transformer, resize_image, RESIZE_FILTERS
+
+IMAGE_DIR = './tests/test_veg_images'
+
+# the test images as the jpegs users would upload, at the given size
+def load_uploads(side) -> list:
+    uploads = []
+    for name in sorted(os.listdir(IMAGE_DIR)):
+        buffer = io.BytesIO()
+        Image.open(f'{IMAGE_DIR}/{name}').convert('RGB').resize((side, side)).save(buffer, 'JPEG', quality=90)
+        uploads.append(buffer.getvalue())
+    return uploads
+
+# one upload through the stages, returns the milliseconds of each one and the model input
+def run_stages(data, model_input_size, reduced, color) -> tuple:
+    times = {}
+
+    start = time.perf_counter()
+    img = Image.open(io.BytesIO(data))
+    times['open_ms'] = time.perf_counter()
+
+    if reduced:
+        img.draft('RGB' if color else 'L', (model_input_size, model_input_size))
+    img.load()
+    times['decode_ms'] = time.perf_counter()
+
+    img = resize_image(img, model_input_size)
+    times['resize_ms'] = time.perf_counter()
+
+    tensor = transformer(img, model_input_size)
+    times['transform_ms'] = time.perf_counter()
+
+    # turn the timestamps into how long each stage took
+    previous = start
+    for stage, end in times.items():
+        times[stage], previous = (end - previous) * 1000, end
+    times['total_ms'] = sum(times.values())
+    return times, tensor
+
+def run(repeat=20, side=512) -> list:
+    results = []
+    uploads = load_uploads(side)
+
+    for model_input_size in [31, 128]:
+        references = [transformer(Image.open(io.BytesIO(data)).resize((model_input_size, model_input_size)), model_input_size) for data in uploads]
+
+        for resize_filter in RESIZE_FILTERS:
+            BaseConfig.RESIZE_FILTER = resize_filter
+            for path, reduced, color in [('full', False, True), ('reduced', True, True), ('reduced_gray', True, False)]:
+                totals, errors = {}, []
+                for _ in range(repeat):
+                    for data, reference in zip(uploads, references):
+                        times, tensor = run_stages(data, model_input_size, reduced, color)
+                        for stage, value in times.items():
+                            totals[stage] = totals.get(stage, 0) + value
+                        errors.append(np.abs(tensor - reference).mean())
+
+                result = {'model' : model_input_size, 'filter' : resize_filter, 'path' : path}
+                result.update({stage : value / (repeat * len(uploads)) for stage, value in totals.items()})
+                result['mean_abs_error'] = float(np.mean(errors))
+                results.append(result)
+
+    BaseConfig.RESIZE_FILTER = 'bicubic'
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--side', type=int, default=512, help='the size the test images are uploaded at')
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.side)
+    print(f'{"model":>5} {"filter":<9} {"path":<13} {"open ms":>8} {"decode ms":>10} {"resize ms":>10} {"transform ms":>13} {"total ms":>9} {"error":>7}')
+    for r in results:
+        print(f'{r["model"]:>5} {r["filter"]:<9} {r["path"]:<13} {r["open_ms"]:>8.3f} {r["decode_ms"]:>10.3f} {r["resize_ms"]:>10.3f} '
+              f'{r["transform_ms"]:>13.3f} {r["total_ms"]:>9.3f} {r["mean_abs_error"]:>7.4f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
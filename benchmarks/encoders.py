@@ -0,0 +1,61 @@
+# compares the payload size as well as the encode and decode time of every encoder against the original instances format
+# python -m benchmarks.encoders [--repeat 50] [--output results.json]
+import argparse
+import json
+import os
+import time
+from PIL import Image
+from application.routes.functions import transformer
+from application.inference import ENCODERS
+
+IMAGE_DIR = './tests/test_veg_images'
+
+# average milliseconds per call of fn over the repeats
+def timeit(fn, repeat) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def run(repeat=50) -> list:
+    results = []
+    image = Image.open(f'{IMAGE_DIR}/{sorted(os.listdir(IMAGE_DIR))[0]}')
+
+    for model_input_size in [31, 128]:
+        tensor = transformer(image, model_input_size)
+        baseline = None
+
+        for name, encoder in ENCODERS.items():
+            body = encoder.encode(tensor)
+            result = {
+                'model' : model_input_size,
+                'encoder' : name,
+                'bytes' : len(body),
+                'encode_ms' : timeit(lambda: encoder.encode(tensor), repeat),
+                'decode_ms' : timeit(lambda: encoder.decode(body), repeat)
+            }
+
+            # everything is compared against the original format
+            if name == 'instances':
+                baseline = result
+            result['size_vs_instances'] = result['bytes'] / baseline['bytes']
+            result['encode_vs_instances'] = result['encode_ms'] / baseline['encode_ms']
+            results.append(result)
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print(f'{"model":>5} {"encoder":<12} {"bytes":>9} {"encode ms":>10} {"decode ms":>10} {"size":>6} {"encode":>7}')
+    for r in results:
+        print(f'{r["model"]:>5} {r["encoder"]:<12} {r["bytes"]:>9} {r["encode_ms"]:>10.3f} {r["decode_ms"]:>10.3f} '
+              f'{r["size_vs_instances"]:>6.2f} {r["encode_vs_instances"]:>7.2f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,82 @@
+# a stand-in for the tf serving model server, so everything can be benchmarked (and tried out) without the real one
+# it answers in whichever format it was asked in, with the same deterministic probabilities as the fake backend,
+# after waiting for the given latency to stand in for the model itself
+# python -m benchmarks.fake_server [--port 8501] [--latency 0.02], then point MODEL_SERVER_URL at it
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from application.inference import FakeBackend, detect_encoder
+
+class FakeModelServer(object):
+    def __init__(self, latency=0, host='127.0.0.1', port=0) -> None:
+        self.latency = latency
+        self.requests = 0
+        self.backend = FakeBackend()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'       # keep alive, like tf serving
+            # otherwise the body waits on the delayed ack of the headers, which adds ~40ms to every request on a kept alive connection
+            disable_nagle_algorithm = True
+
+            # the model status, like tf serving's
+            def do_GET(self):
+                data = json.dumps({'model_version_status' : [{'version' : '1', 'state' : 'AVAILABLE'}]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                encoder = detect_encoder(body)
+                data = encoder.encode_predictions(server.backend.predict(encoder.decode(body)).tolist())
+                self.send_response(200)
+                self.send_header('Content-Type', encoder.content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://{host}:{self.httpd.server_port}'
+        self._thread = None
+
+    def start(self) -> 'FakeModelServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8501)
+    parser.add_argument('--latency', type=float, default=0, help='seconds every prediction takes')
+    args = parser.parse_args()
+
+    server = FakeModelServer(args.latency, args.host, args.port)
+    print(f'fake model server on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
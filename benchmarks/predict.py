@@ -0,0 +1,115 @@
+# throughput and latency of /predict for each model size, against the fake model server so nothing leaves this machine
+# the requests go through the whole app, from the upload to the history being stored, only the model itself is made up
+# python -m benchmarks.predict [--requests 200] [--concurrency 1 4] [--latency 0.01] [--write-behind] [--output results.json]
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from benchmarks import summarize
+from benchmarks.fake_server import FakeModelServer
+from application import create_app, db
+from application.config import TestingConfig
+from application.models import User
+
+IMAGE_DIR = './tests/test_veg_images'
+
+# the app with a real database file, talking to the fake model server, with the prediction cache off
+# so that every request really goes to the model
+def make_app(folder, server_url, write_behind=False):
+    settings = {
+        'SQLALCHEMY_DATABASE_URI' : f'sqlite:///{folder}/bench.db',
+        'MODEL_SERVER_URL' : server_url,
+        'PREDICTION_CACHE_SIZE' : 0,
+        'METRICS_DIR' : None,
+        'HISTORY_WRITE_BEHIND' : write_behind
+    }
+    originals = {name : getattr(TestingConfig, name) for name in settings}
+    for name, value in settings.items():
+        setattr(TestingConfig, name, value)
+    try:
+        app = create_app('TEST')
+    finally:
+        for name, value in originals.items():
+            setattr(TestingConfig, name, value)
+
+    with app.app_context():
+        db.session.add(User(email='bench@test.com', password='Bench12345$'))
+        db.session.commit()
+        db.session.remove()
+    return app
+
+# each thread gets its own client, signed in when the history is to be stored, and sends its share of the requests
+def run_clients(app, model_input_size, requests, concurrency, signed_in) -> dict:
+    images = []
+    for name in sorted(os.listdir(IMAGE_DIR)):
+        with open(f'{IMAGE_DIR}/{name}', 'rb') as f:
+            images.append((f.read(), name))
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client_thread(count):
+        client = app.test_client()
+        if signed_in:
+            client.post('/signin', data={'email' : 'bench@test.com', 'password' : 'Bench12345$'})
+        for i in range(count):
+            data, name = images[i % len(images)]
+            start = time.perf_counter()
+            res = client.post('/predict', data={'image' : (io.BytesIO(data), name), 'model' : f'{model_input_size} pixels model'},
+                              content_type='multipart/form-data')
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if res.status_code != 200 or b'id="error"' in res.data:
+                    errors.append(res.status_code)
+
+    threads = [threading.Thread(target=client_thread, args=(requests // concurrency,)) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = summarize(latencies)
+    result['requests_per_second'] = len(latencies) / elapsed
+    result['errors'] = len(errors)
+    return result
+
+def run(requests=200, concurrency=(1, 4), latency=0.01, write_behind=False) -> list:
+    results = []
+    with FakeModelServer(latency) as server, tempfile.TemporaryDirectory() as folder:
+        app = make_app(folder, server.url, write_behind)
+        for model_input_size in [31, 128]:
+            for signed_in in [False, True]:
+                for count in concurrency:
+                    result = {'model' : model_input_size, 'signed_in' : signed_in, 'concurrency' : count, 'model_latency_ms' : latency * 1000, 'write_behind' : write_behind}
+                    result.update(run_clients(app, model_input_size, requests, count, signed_in))
+                    results.append(result)
+        if 'history_writer' in app.extensions:
+            app.extensions['history_writer'].shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200, help='requests for each model size and concurrency')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the fake model takes for every prediction')
+    parser.add_argument('--write-behind', action='store_true', help='store the histories with HISTORY_WRITE_BEHIND')
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.requests, args.concurrency, args.latency, args.write_behind)
+    print(f'{"model":>5} {"signed in":>9} {"threads":>7} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>6}')
+    for r in results:
+        print(f'{r["model"]:>5} {str(r["signed_in"]):>9} {r["concurrency"]:>7} {r["requests_per_second"]:>8.1f} {r["p50_ms"]:>8.2f} {r["p99_ms"]:>8.2f} {r["errors"]:>6}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,108 @@
+# latency of the history search with 1k, 10k and 100k histories of one user, for a few combinations of the filters
+# and for the page after the first one, since every page should cost the same with keyset pagination
+# the user's histories are mixed in with the histories of many other users, since a search should only cost what
+# the user's own histories do, however many everyone else has
+# python -m benchmarks.search [--rows 1000 10000 100000] [--others 200000] [--users 1000] [--repeat 20] [--output results.json]
+import argparse
+import datetime
+import json
+import tempfile
+import time
+import numpy as np
+from sqlalchemy import insert
+from benchmarks import summarize
+from application import create_app, db
+from application.config import TestingConfig
+from application.models import User, History, HistoryProb
+from application.routes.functions import search_histories, LABELS
+
+# the searches to time, by name
+SEARCHES = {
+    'all' : {},
+    'pred' : {'pred' : 'Bean'},
+    'model_min_prob' : {'model' : '31', 'min_prob' : 0.5},
+    'label_top_k' : {'label' : 'Bean', 'top_k' : 3},
+    'label_min_prob' : {'label' : 'Bean', 'label_min_prob' : 0.5},
+    'max_margin' : {'max_margin' : 0.01},
+    'dates' : {'date_from' : datetime.date(2024, 1, 10), 'date_to' : datetime.date(2024, 1, 20)}
+}
+
+def make_app(folder):
+    original = TestingConfig.SQLALCHEMY_DATABASE_URI
+    TestingConfig.SQLALCHEMY_DATABASE_URI = f'sqlite:///{folder}/bench.db'
+    try:
+        return create_app('TEST')
+    finally:
+        TestingConfig.SQLALCHEMY_DATABASE_URI = original
+
+# histories with random probabilities, spread over a year, inserted in bulk along with their history_prob rows
+# user 1 (the one searched) has rows of them, and the others histories are spread over the other users, all mixed together
+def seed(rows, others=0, users=1000, seed=0) -> None:
+    db.session.execute(insert(User), [{'id' : i, 'email' : f'bench{i}@test.com', 'password' : 'Bench12345$'} for i in range(1, users + 2)])
+    db.session.commit()
+
+    rng = np.random.default_rng(seed)
+    total = rows + others
+    owners = rng.integers(2, users + 2, total)
+    owners[rng.choice(total, rows, replace=False)] = 1
+    probs = rng.dirichlet(np.ones(len(LABELS)) * 0.3, total)
+    ranks = np.argsort(np.argsort(-probs, axis=1), axis=1) + 1
+    start = datetime.datetime(2024, 1, 1)
+    for first in range(0, total, 10000):
+        chunk = range(first, min(first + 10000, total))
+        db.session.execute(insert(History), [{
+            'id' : i + 1, 'user_id' : int(owners[i]), 'highest_prob' : float(probs[i].max()), 'pred' : LABELS[int(probs[i].argmax())],
+            'image' : b'', 'model' : ('31', '128')[i % 2], 'timestamp' : start + datetime.timedelta(days=365) * i / total
+        } for i in chunk])
+        db.session.execute(insert(HistoryProb), [{
+            'history_id' : i + 1, 'label' : label, 'prob' : float(probs[i, label]), 'rank' : int(ranks[i, label])
+        } for i in chunk for label in range(len(LABELS))])
+    db.session.commit()
+
+def time_search(filters, repeat, after=None) -> tuple:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows, next_after = search_histories(1, after=after, **filters)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, len(rows), next_after
+
+def run(rows=(1000, 10000, 100000), repeat=20, others=200000, users=1000) -> list:
+    results = []
+    for count in rows:
+        with tempfile.TemporaryDirectory() as folder:
+            app = make_app(folder)
+            with app.app_context():
+                seed(count, others, users)
+                for name, filters in SEARCHES.items():
+                    samples, found, next_after = time_search(filters, repeat)
+                    result = {'rows' : count, 'others' : others, 'search' : name, 'page' : 1, 'found' : found}
+                    result.update(summarize(samples))
+                    results.append(result)
+
+                    if next_after is not None:
+                        samples, found, _ = time_search(filters, repeat, next_after)
+                        result = {'rows' : count, 'others' : others, 'search' : name, 'page' : 2, 'found' : found}
+                        result.update(summarize(samples))
+                        results.append(result)
+                db.session.remove()
+                db.engine.dispose()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--others', type=int, default=200000, help='histories of the other users')
+    parser.add_argument('--users', type=int, default=1000, help='how many other users')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat, args.others, args.users)
+    print(f'{"rows":>7} {"search":<16} {"page":>4} {"found":>5} {"p50 ms":>8} {"p99 ms":>8}')
+    for r in results:
+        print(f'{r["rows"]:>7} {r["search"]:<16} {r["page"]:>4} {r["found"]:>5} {r["p50_ms"]:>8.2f} {r["p99_ms"]:>8.2f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,49 @@
+# time of the transformer, from the decoded upload to the tensor the model takes, for each model size
+# python -m benchmarks.transformer [--repeat 200] [--output results.json]
+import argparse
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+from benchmarks import summarize
+from application.routes.functions import transformer
+
+IMAGE_DIR = './tests/test_veg_images'
+
+def run(repeat=200) -> list:
+    results = []
+    images = []
+    for name in sorted(os.listdir(IMAGE_DIR)):
+        with Image.open(f'{IMAGE_DIR}/{name}') as img:
+            img.load()
+            images.append(img)
+
+    for model_input_size in [31, 128]:
+        out = np.empty((1, model_input_size, model_input_size, 1), dtype=np.float32)
+        for reuse in [False, True]:
+            samples = []
+            for i in range(repeat):
+                img = images[i % len(images)]
+                start = time.perf_counter()
+                transformer(img, model_input_size, out if reuse else None)
+                samples.append((time.perf_counter() - start) * 1000)
+            result = {'model' : model_input_size, 'reused_buffer' : reuse}
+            result.update(summarize(samples))
+            results.append(result)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print(f'{"model":>5} {"reused buffer":>13} {"mean ms":>8} {"p50 ms":>8} {"p99 ms":>8}')
+    for r in results:
+        print(f'{r["model"]:>5} {str(r["reused_buffer"]):>13} {r["mean_ms"]:>8.3f} {r["p50_ms"]:>8.3f} {r["p99_ms"]:>8.3f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,6 +1,11 @@
 import pytest
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from application import create_app, db
+from application.config import TestingConfig
 from application.models import User
+from application.inference import detect_encoder
 
 @pytest.fixture
 def client():
@@ -27,4 +32,70 @@ def authenticated_client(client):
         'password' : 'Test12345$'
     }
     client.post('/signin', data=data, follow_redirects=True)    # enable redirect as we first go back to home page
-    return client
\ No newline at end of file
+    return client
+
+# swap the models for the deterministic fake backend, so the tests don't need the model server
+# this has to come before the client fixture in the test's arguments, since the config is read when the app is made
+@pytest.fixture
+def fake_backends(monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'MODEL_BACKENDS', {
+        'model_31' : {'type' : 'fake'},
+        'model_128' : {'type' : 'fake'}
+    })
+
+# a tiny stand-in for the tf serving model server, so the http side of things can be tested without the real one
+# it always predicts the first label, answering in whichever format it was asked in,
+# and can be told to fail the first few requests with a 503. The model status says it serves version, or fails without one
+@pytest.fixture
+def model_server():
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.status_requests += 1
+            if server.version is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            data = json.dumps({'model_version_status' : [{'version' : server.version, 'state' : 'AVAILABLE'}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            server.requests.append((self.path, body))
+
+            if server.failures > 0:
+                server.failures -= 1
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            encoder = detect_encoder(body)
+            batch = encoder.decode(body).shape[0]
+            data = encoder.encode_predictions([[1.0] + [0.0] * 14] * batch)
+            self.send_response(200)
+            self.send_header('Content-Type', encoder.content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.failures = 0
+    server.version = '1'
+    server.status_requests = 0
+    server.url = f'http://127.0.0.1:{server.server_port}'
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
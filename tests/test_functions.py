@@ -1,9 +1,31 @@
 # simply tests all the individual functions, especially those under application/routes/functions.py
 import pytest
 import os
+import io
+import json
+import time
 from PIL import Image
-from application.routes.functions import make_prediction, add_entry, edit_entry
-from application.models import User
+import numpy as np
+from application.routes.functions import make_prediction, add_entry, edit_entry, transformer, encode_history_image, decode_history_image, image_save_options, open_image, resize_image, RESIZE_FILTERS
+from application.config import BaseConfig, TestingConfig
+from application.migrations import upgrade_database, migrate_history_images
+from application import create_app, db
+from sqlalchemy import inspect, text, func, create_engine, MetaData, Table, Column, Integer, String, Float, LargeBinary, DateTime, PickleType, ForeignKey
+import sqlite3
+import gzip
+import datetime
+import fcntl
+import subprocess
+from application.inference import cache as inference_cache
+from application.inference import backends, ENCODERS, detect_encoder, get_session, get_backend, NumpyEngine, FakeBackend, PredictionCache, BatchingBackend, CircuitOpenError
+from concurrent.futures import ThreadPoolExecutor
+from application.cache import LRUCache
+from application.models import User, History, HistoryProb, PredictionJob
+from application.similarity import image_hash, hamming_distances, HashIndex
+from application.writebehind import HistoryWriter, dump_record
+from sqlalchemy import select
+from benchmarks.fake_server import FakeModelServer
+import requests
 
 # test both the models on a few randomly selected images
 # but first get all the directory of all the test images
@@ -19,6 +41,359 @@ def test_prediction(image, model_input_size):
     assert pred.lower() == image.split('.')[0]                      # and test the prediction labels
 
 
+# test that the transformer still produces the same tensor as the original per-pixel implementation
+@pytest.mark.parametrize('image', images)
+@pytest.mark.parametrize('model_input_size', [31, 128])
+def test_transformer(image, model_input_size):
+    img = Image.open(f'{image_dir}/{image}').resize((model_input_size, model_input_size))
+
+    # the original implementation, normalising every pixel with a python function
+    expected = np.vectorize(lambda x: x / 255)(np.array(img.convert('L'))).reshape(1, model_input_size, model_input_size, 1)
+
+    tensor = transformer(img, model_input_size)
+    assert tensor.shape == (1, model_input_size, model_input_size, 1)
+    assert tensor.dtype == np.float32
+    assert np.allclose(tensor, expected, atol=1e-6)
+
+    # and writing into a preallocated buffer should give back that very same buffer
+    buffer = np.zeros((1, model_input_size, model_input_size, 1), dtype=np.float32)
+    assert transformer(img, model_input_size, out=buffer) is buffer
+    assert np.array_equal(buffer, tensor)
+
+
+# test that the session to the model server is reused, and that a model server that is not ready yet gets retried
+def test_model_server_session(model_server, monkeypatch):
+    monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_URL', model_server.url)
+    monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_BACKOFF', 0)
+    monkeypatch.setattr(backends, '_session', None)     # start from a fresh session and backends with the patched settings
+    monkeypatch.setattr(backends, '_backends', {})
+
+    # the same session should come back every time
+    assert get_session() is get_session()
+
+    model_server.failures = 2
+    img = Image.open(f'{image_dir}/{images[0]}')
+    pred, probs = make_prediction(31, img)
+
+    # two 503s and then the actual prediction
+    assert len(model_server.requests) == 3
+    assert model_server.requests[-1][0] == '/v1/models/model_31:predict'
+    assert pred == 'Bean' and len(probs[0]) == 15
+
+
+# test that the predictions of a model on the model server are cached by the version it serves, and not at all without one
+# the predictions never wait for the version: it's found out by a thread of its own (or the keep alive) and read from there
+def test_served_version_cache(model_server, monkeypatch):
+    monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_URL', model_server.url)
+    monkeypatch.setattr(inference_cache, '_cache', None)
+    monkeypatch.setattr(backends, '_session', None)
+    monkeypatch.setattr(backends, '_backends', {})
+    img = Image.open(f'{image_dir}/{images[1]}')
+    backend = remote = get_backend(31)
+    while not isinstance(remote, backends.RemoteBackend):
+        remote = remote.backend         # under the breaker and the batching
+
+    # before the version is known nothing is cached, the first prediction only sets off finding it out
+    make_prediction(31, img)
+    remote._refresher.join()
+    assert len(model_server.requests) == 1 and model_server.status_requests == 1 and backend.version == '1'
+    make_prediction(31, img)
+    make_prediction(31, img)
+    assert len(model_server.requests) == 2 and model_server.status_requests == 1
+
+    # deployed again, the old prediction isn't used once the new version is found out
+    model_server.version = '2'
+    backend.refresh_version()
+    make_prediction(31, img)
+    assert len(model_server.requests) == 3
+
+    # and a model server that doesn't say isn't cached at all
+    model_server.version = None
+    backend.refresh_version()
+    make_prediction(31, img)
+    make_prediction(31, img)
+    assert len(model_server.requests) == 5
+
+    # once it's out of date, reading it gives the last one straight away and asks again on the side
+    model_server.version = '3'
+    remote._checked -= BaseConfig.MODEL_VERSION_REFRESH
+    assert backend.version is None
+    remote._refresher.join()
+    assert backend.version == '3' and model_server.status_requests == 4
+
+
+# test that the circuit breaker fails fast once the model server keeps failing, and lets a probe through after the cooldown
+def test_circuit_breaker(model_server, monkeypatch):
+    monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_URL', model_server.url)
+    monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_RETRIES', 0)
+    monkeypatch.setattr(BaseConfig, 'MODEL_BREAKER_MIN_REQUESTS', 3)
+    monkeypatch.setattr(BaseConfig, 'MODEL_BREAKER_COOLDOWN', 0.2)
+    monkeypatch.setattr(BaseConfig, 'PREDICTION_CACHE_SIZE', 0)
+    monkeypatch.setattr(inference_cache, '_cache', None)
+    monkeypatch.setattr(backends, '_session', None)
+    monkeypatch.setattr(backends, '_backends', {})
+    img = Image.open(f'{image_dir}/{images[0]}')
+    breaker = get_backend(31).breaker
+
+    # every failure reaches the model server until there are enough of them, and then nothing does
+    model_server.failures = 100
+    for _ in range(3):
+        with pytest.raises(requests.HTTPError):
+            make_prediction(31, img)
+    assert breaker.state == 'open' and not get_backend(31).available()
+    with pytest.raises(CircuitOpenError):
+        make_prediction(31, img)
+    assert len(model_server.requests) == 3
+
+    # a probe that fails opens it again for another cooldown
+    time.sleep(0.25)
+    assert get_backend(31).available()
+    with pytest.raises(requests.HTTPError):
+        make_prediction(31, img)
+    assert breaker.state == 'open' and len(model_server.requests) == 4
+
+    # and one that works closes it
+    model_server.failures = 0
+    time.sleep(0.25)
+    pred, _ = make_prediction(31, img)
+    assert pred == 'Bean' and breaker.state == 'closed'
+    assert breaker.status()['trips'] == 2 and breaker.status()['rejected'] == 1
+
+    # without a cache the version is never asked for
+    assert model_server.status_requests == 0
+
+    # the other model has a breaker of its own
+    assert get_backend(128).breaker.state == 'closed'
+
+
+# test that the benchmarks' stand in model server answers like the fake backend, through the real remote backend
+def test_fake_model_server(monkeypatch):
+    monkeypatch.setattr(backends, '_session', None)
+    monkeypatch.setattr(backends, '_backends', {})
+    monkeypatch.setattr(BaseConfig, 'PREDICTION_CACHE_SIZE', 0)     # the other tests' predictions of the same images may be cached
+    monkeypatch.setattr(inference_cache, '_cache', None)
+    with FakeModelServer() as server:
+        monkeypatch.setattr(BaseConfig, 'MODEL_SERVER_URL', server.url)
+        img = Image.open(f'{image_dir}/{images[0]}')
+        for model_input_size in [31, 128]:
+            pred, probs = make_prediction(model_input_size, img)
+            # the fake backend gets the image as it comes out of the wire, some formats round it on the way
+            encoder = ENCODERS[BaseConfig.MODEL_BACKENDS[f'model_{model_input_size}']['encoder']]
+            expected = FakeBackend().predict(encoder.decode(encoder.encode(transformer(img, model_input_size))))
+            assert np.allclose(probs, expected, atol=1e-6)
+        assert server.requests == 2
+
+
+# test that every encoder gets the image and the predictions across the wire intact, and can be told apart by the serving side
+@pytest.mark.parametrize('encoder', ENCODERS.keys())
+@pytest.mark.parametrize('model_input_size', [31, 128])
+def test_encoders(encoder, model_input_size):
+    encoder = ENCODERS[encoder]
+    tensor = transformer(Image.open(f'{image_dir}/{images[0]}'), model_input_size)
+    body = encoder.encode(tensor)
+
+    assert detect_encoder(body) is encoder
+    assert np.allclose(encoder.decode(body), tensor, atol=1e-5)
+
+    preds = np.random.default_rng(0).random((2, 15), dtype=np.float32)
+    assert np.allclose(encoder.decode_predictions(encoder.encode_predictions(preds)), preds)
+
+
+# test the numpy engine on a small made up cnn, against convolution and pooling done the slow way
+def test_numpy_engine(tmp_path):
+    rng = np.random.default_rng(0)
+    layers = [
+        {'type' : 'conv2d', 'padding' : 'valid', 'activation' : 'relu'},
+        {'type' : 'maxpool2d', 'pool_size' : 2},
+        {'type' : 'flatten'},
+        {'type' : 'dense', 'activation' : 'softmax'}
+    ]
+    weights = {
+        '0/kernel' : rng.normal(size=(3, 3, 1, 4)).astype(np.float32),
+        '0/bias' : rng.normal(size=4).astype(np.float32),
+        '3/kernel' : rng.normal(size=(6 * 6 * 4, 15)).astype(np.float32),
+        '3/bias' : rng.normal(size=15).astype(np.float32)
+    }
+    path = tmp_path / 'model.npz'
+    np.savez(path, layers=json.dumps(layers), **weights)
+
+    x = rng.random((2, 14, 14, 1), dtype=np.float32)
+    probs = NumpyEngine(str(path))(x)
+
+    # the same model, one loop at a time
+    conv = np.zeros((2, 12, 12, 4), dtype=np.float32)
+    for i in range(12):
+        for j in range(12):
+            conv[:, i, j] = np.tensordot(x[:, i:i + 3, j:j + 3], weights['0/kernel'], axes=3)
+    conv = np.maximum(conv + weights['0/bias'], 0)
+    pooled = conv.reshape(2, 6, 2, 6, 2, 4).max(axis=(2, 4))
+    logits = pooled.reshape(2, -1) @ weights['3/kernel'] + weights['3/bias']
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+    assert probs.shape == (2, 15)
+    assert np.allclose(probs, expected, atol=1e-5)
+
+# test strided and dilated convolutions with same padding, and overlapping pooling, against the slow way too
+def test_numpy_engine_strides(tmp_path):
+    rng = np.random.default_rng(1)
+    layers = [
+        {'type' : 'conv2d', 'padding' : 'same', 'strides' : [2, 2], 'dilation_rate' : [1, 1], 'activation' : 'linear'},
+        {'type' : 'conv2d', 'padding' : 'valid', 'strides' : [1, 1], 'dilation_rate' : [2, 2], 'activation' : 'relu'},
+        {'type' : 'maxpool2d', 'pool_size' : [3, 3], 'strides' : [2, 2], 'padding' : 'same'}
+    ]
+    weights = {
+        '0/kernel' : rng.normal(size=(3, 3, 1, 2)).astype(np.float32),
+        '0/bias' : rng.normal(size=2).astype(np.float32),
+        '1/kernel' : rng.normal(size=(3, 3, 2, 3)).astype(np.float32)     # no bias
+    }
+    path = tmp_path / 'model.npz'
+    np.savez(path, layers=json.dumps(layers), **weights)
+
+    x = rng.random((2, 15, 15, 1), dtype=np.float32)
+    out = NumpyEngine(str(path))(x)
+
+    # same padding with stride 2 on 15 pixels: 8 outputs, 2 pixels of padding split one before and one after
+    padded = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    first = np.zeros((2, 8, 8, 2), dtype=np.float32)
+    for i in range(8):
+        for j in range(8):
+            first[:, i, j] = np.tensordot(padded[:, 2 * i:2 * i + 3, 2 * j:2 * j + 3], weights['0/kernel'], axes=3)
+    first += weights['0/bias']
+
+    # a dilation of 2 makes the 3x3 kernel reach over 5x5 pixels
+    second = np.zeros((2, 4, 4, 3), dtype=np.float32)
+    for i in range(4):
+        for j in range(4):
+            second[:, i, j] = np.tensordot(first[:, i:i + 5:2, j:j + 5:2], weights['1/kernel'], axes=3)
+    second = np.maximum(second, 0)
+
+    # 3x3 pooling every 2 pixels on 4 pixels: 2 outputs, 1 pixel of padding after
+    padded = np.pad(second, ((0, 0), (0, 1), (0, 1), (0, 0)), constant_values=-np.inf)
+    expected = np.zeros((2, 2, 2, 3), dtype=np.float32)
+    for i in range(2):
+        for j in range(2):
+            expected[:, i, j] = padded[:, 2 * i:2 * i + 3, 2 * j:2 * j + 3].max(axis=(1, 2))
+
+    assert out.shape == (2, 2, 2, 3)
+    assert np.allclose(out, expected, atol=1e-5)
+
+
+# test that exporting a model the numpy engine can't run exactly fails, instead of making a model that predicts something else
+def test_export_keras_model(tmp_path):
+    def keras_layer(kind, **config):
+        return type(kind, (object,), {'get_config' : lambda self: dict(config, name=kind.lower()), 'get_weights' : lambda self: []})()
+
+    class Model(object):
+        def __init__(self, *layers) -> None:
+            self.layers = layers
+
+    path = str(tmp_path / 'model.npz')
+    backends.export_keras_model(Model(
+        keras_layer('Conv2D', padding='same', strides=(2, 2), dilation_rate=(1, 1), activation='relu', data_format='channels_last', groups=1),
+        keras_layer('MaxPooling2D', pool_size=(3, 3), strides=None, padding='valid', data_format='channels_last'),
+        keras_layer('Flatten', data_format='channels_last')
+    ), path)
+    layers = json.loads(str(np.load(path)['layers']))
+    assert layers[0]['strides'] == [2, 2] and layers[0]['dilation_rate'] == [1, 1] and layers[0]['padding'] == 'same'
+    assert layers[1] == {'type' : 'maxpool2d', 'activation' : 'linear', 'pool_size' : [3, 3], 'strides' : [3, 3], 'padding' : 'valid'}
+
+    unsupported = [
+        keras_layer('BatchNormalization'),
+        keras_layer('Conv2D', padding='valid', activation='gelu'),
+        keras_layer('Conv2D', padding='valid', activation='relu', data_format='channels_first'),
+        keras_layer('Conv2D', padding='valid', activation='relu', groups=2),
+        keras_layer('MaxPooling2D', pool_size=(2, 2), padding='causal')
+    ]
+    for layer in unsupported:
+        with pytest.raises(ValueError):
+            backends.export_keras_model(Model(layer), path)
+
+
+# test that the fake backend always gives the same probabilities for the same image, and different ones for different images
+def test_fake_backend():
+    tensors = [transformer(Image.open(f'{image_dir}/{image}'), 31) for image in images]
+    backend = FakeBackend()
+
+    first = backend.predict(np.concatenate(tensors))
+    assert first.shape == (len(images), 15)
+    assert np.allclose(first.sum(axis=1), 1)
+    assert np.array_equal(first, backend.predict(np.concatenate(tensors)))
+    assert not np.array_equal(first[0], first[1])
+
+
+# test that concurrent predictions get batched together, and that everyone still gets the prediction of their own image
+def test_micro_batching():
+    fake = FakeBackend()
+    calls = []
+    class CountingBackend(FakeBackend):
+        def predict(self, batch):
+            calls.append(batch.shape[0])
+            return fake.predict(batch)
+
+    backend = BatchingBackend(CountingBackend(), max_batch_size=4, max_wait=0.2)
+    tensors = [np.full((1, 31, 31, 1), i / 10, dtype=np.float32) for i in range(8)]
+
+    with ThreadPoolExecutor(8) as pool:
+        preds = list(pool.map(backend.predict, tensors))
+    backend.close()
+
+    assert sum(calls) == 8 and len(calls) < 8 and max(calls) <= 4
+    for tensor, pred in zip(tensors, preds):
+        assert np.array_equal(pred, fake.predict(tensor))
+
+    # and an error from the model goes to everyone waiting on it
+    class BrokenBackend(FakeBackend):
+        def predict(self, batch):
+            raise ConnectionError('model is down')
+
+    backend = BatchingBackend(BrokenBackend(), max_batch_size=4, max_wait=0.01)
+    with pytest.raises(ConnectionError):
+        backend.predict(tensors[0])
+    backend.close()
+
+
+# test the lru cache evicts the least recently used first, by count and by size, and that items expire
+def test_lru_cache(monkeypatch):
+    cache = LRUCache(max_items=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')          # so b becomes the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+    cache = LRUCache(max_items=10, max_bytes=10)
+    cache.set('a', b'12345')
+    cache.set('b', b'123456')
+    assert cache.get('a') is None and cache.get('b') == b'123456'
+
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+
+
+# test the prediction cache, the key has to change with the model and its version, and the shared tier works across caches
+def test_prediction_cache(tmp_path):
+    tensor = transformer(Image.open(f'{image_dir}/{images[0]}'), 31)
+    key = PredictionCache.key(tensor, 'model_31', '1')
+    assert key != PredictionCache.key(tensor, 'model_31', '2')
+    assert key != PredictionCache.key(tensor, 'model_128', '1')
+    assert key != PredictionCache.key(tensor * 0.5, 'model_31', '1')
+
+    probs = np.linspace(0, 1, 15, dtype=np.float32)
+    path = str(tmp_path / 'cache.db')
+    worker1 = PredictionCache(max_items=10, shared_path=path)
+    worker2 = PredictionCache(max_items=10, shared_path=path)
+
+    assert worker2.get(key) is None
+    worker1.set(key, probs)
+    assert np.array_equal(worker2.get(key), probs)      # from the shared tier
+    assert np.array_equal(worker2.get(key), probs)      # and now from its own lru
+    assert worker2.stats()['shared_hits'] == 1 and worker2.stats()['hits'] == 1 and worker2.stats()['misses'] == 1
+
+
 # test the adding entry of user to see if adding the new user works, the email and password should have been the same after inserting
 @pytest.mark.database
 @pytest.mark.parametrize('email', ['wTf@mytest.com', 'A@b.C'])
@@ -66,4 +441,380 @@ def test_editing_user(authenticated_client, email, password):
 
     # then the email and password changed should be reflected
     user = User.query.filter_by(email=email).first()
-    assert bool(user) and user.password == password
\ No newline at end of file
+    assert bool(user) and user.password == password
+
+
+# test that the history images come back the same from every storage format, webp is lossless by default too
+@pytest.mark.parametrize('image_format', ['raw', 'gray', 'png', 'webp'])
+def test_history_image_formats(image_format):
+    img = Image.open(f'{image_dir}/{images[0]}').resize((128, 128))
+    data, stored_format, width, height = encode_history_image(img, image_format)
+    assert stored_format == image_format and (width, height) == (128, 128)
+
+    decoded = decode_history_image(data, stored_format, width, height)
+    original = np.asarray(img.convert(decoded.mode), dtype=np.float32)
+    assert decoded.size == (128, 128)
+    assert np.abs(np.asarray(decoded, dtype=np.float32) - original).mean() < 1e-6
+
+    # the compressed ones have to actually be smaller
+    if image_format in ('png', 'webp'):
+        assert len(data) < len(img.tobytes())
+
+
+# test that lossless webp is saved with the effort rather than the quality, since pillow takes a quality of 100 as the most effort
+# and that takes tens of milliseconds per image on the prediction page
+def test_history_image_effort(monkeypatch):
+    assert image_save_options('webp') == {'lossless' : True, 'quality' : 0, 'method' : 0}
+    assert image_save_options('png') == {}
+    monkeypatch.setattr(BaseConfig, 'HISTORY_IMAGE_QUALITY', 80)
+    assert image_save_options('webp') == {'quality' : 80}
+    monkeypatch.setattr(BaseConfig, 'HISTORY_IMAGE_QUALITY', 100)
+    monkeypatch.setattr(BaseConfig, 'HISTORY_IMAGE_EFFORT', 100)
+    assert image_save_options('webp') == {'lossless' : True, 'quality' : 100, 'method' : 6}
+    monkeypatch.setattr(BaseConfig, 'HISTORY_IMAGE_EFFORT', 0)
+
+    # and what that costs, the best of a few so a busy machine doesn't fail it
+    img = Image.open(f'{image_dir}/{images[0]}').resize((128, 128))
+    samples = []
+    for _ in range(5):
+        start = time.perf_counter()
+        encode_history_image(img, 'webp')
+        samples.append(time.perf_counter() - start)
+    assert min(samples) < 0.02
+
+
+# test upgrading a database made by the old version, with the images still stored as raw rgb bytes
+@pytest.mark.database
+def test_upgrade_database(tmp_path, monkeypatch):
+    path = tmp_path / 'old.db'
+    img = Image.open(f'{image_dir}/{images[0]}').resize((31, 31))
+
+    # the tables exactly as the first version of the app made them: its models, made by sqlalchemy (so without autoincrement)
+    metadata = MetaData()
+    Table('user', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('email', String, unique=True, nullable=False),
+          Column('password', String, nullable=False))
+    Table('history', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('user_id', ForeignKey('user.id'), nullable=False),
+          Column('probs', PickleType, nullable=False),
+          Column('highest_prob', Float, nullable=False),
+          Column('pred', String, nullable=False),
+          Column('image', LargeBinary, nullable=False),
+          Column('model', String, nullable=False),
+          Column('timestamp', DateTime(True), server_default=func.current_timestamp()))
+    engine = create_engine(f'sqlite:///{path}')
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(metadata.tables['user'].insert(), {'email' : 'old@test.com', 'password' : 'Test12345$'})
+        conn.execute(metadata.tables['history'].insert(), [
+            {'user_id' : 1, 'probs' : [1.0] + [0.0] * 14, 'highest_prob' : 1, 'pred' : 'Bean', 'image' : img.tobytes(), 'model' : '31'},
+            {'user_id' : 1, 'probs' : [0.0, 0.75, 0.25] + [0.0] * 12, 'highest_prob' : 0.75, 'pred' : 'Bitter_Gourd', 'image' : img.tobytes(), 'model' : '31'}
+        ])
+    engine.dispose()
+
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{path}')
+    app = create_app('TEST')
+    with app.app_context():
+        summary = upgrade_database()
+        assert 'history.image_format' in summary['schema']
+        assert summary['history_probs'] == 2
+        assert summary['autoincrement'] == ['user', 'history']
+        assert summary['history_hashes'] == 2
+
+        # the image is left as it was, re-encoding it has to be asked for
+        history = db.session.get(History, 1)
+        assert history.image_format == 'raw' and history.image == img.tobytes()
+        assert migrate_history_images() == 2
+        db.session.refresh(history)
+        assert history.image_format == app.config['HISTORY_IMAGE_FORMAT'] and history.image_width == 31
+        decoded = decode_history_image(history.image, history.image_format, history.image_width, history.image_height)
+        assert np.array_equal(np.asarray(decoded.convert('RGB')), np.asarray(img))
+
+        # the probabilities moved out of the pickle, and made it through the history table being made again for autoincrement
+        assert history.probs == [1.0] + [0.0] * 14
+        assert [row.rank for row in history.prob_rows][:2] == [1, 2]
+        assert db.session.get(History, 2).probs == [0.0, 0.75, 0.25] + [0.0] * 12
+        assert db.session.scalar(select(func.count()).select_from(HistoryProb)) == 2 * 15
+        assert 'probs' not in {column['name'] for column in inspect(db.engine).get_columns('history')}
+
+        # and running it again does nothing
+        summary = upgrade_database()
+        assert summary['schema'] == [] and summary['history_probs'] == 0 and summary['autoincrement'] == [] and summary['history_hashes'] == 0
+        assert migrate_history_images() == 0
+        db.session.remove()
+        db.engine.dispose()
+
+
+
+# test that the tables made without autoincrement get it, so a deleted history's id is never given to the next one
+@pytest.mark.database
+def test_upgrade_autoincrement(tmp_path, monkeypatch):
+    path = tmp_path / 'old.db'
+    conn = sqlite3.connect(path)
+    conn.execute('create table user (id integer not null primary key, email varchar not null unique, password varchar not null)')
+    conn.execute('create table history (id integer not null primary key, user_id integer not null references user (id), highest_prob float not null, '
+                 'pred varchar not null, image blob not null, model varchar not null, timestamp datetime default current_timestamp)')
+    conn.execute('create table history_prob (history_id integer not null references history (id), label smallint not null, prob float not null, '
+                 'rank smallint not null, primary key (history_id, label))')
+    conn.execute("insert into user (email, password) values ('old@test.com', 'Test12345$')")
+    image = Image.new('RGB', (31, 31)).tobytes()
+    conn.executemany("insert into history (user_id, highest_prob, pred, image, model) values (1, 1, 'Bean', ?, '31')", [(image,)] * 3)
+    conn.execute('delete from history where id = 3')
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{path}')
+    app = create_app('TEST')
+    with app.app_context():
+        summary = upgrade_database()
+        assert summary['autoincrement'] == ['user', 'history']
+        assert upgrade_database()['autoincrement'] == []
+
+        # the rows and the indexes made it, and the other tables still point at the history
+        assert db.session.scalars(select(History.id).order_by(History.id)).all() == [1, 2]
+        assert 'ix_history_user_timestamp' in {index['name'] for index in inspect(db.engine).get_indexes('history')}
+        assert inspect(db.engine).get_foreign_keys('history_prob')[0]['referred_table'] == 'history'
+
+        # a deleted id isn't used again
+        db.session.execute(text('delete from history where id = 2'))
+        history = History(probs=[1.0] + [0.0] * 14, image=b'\x00', image_format='raw', user_id=1, model='31', highest_prob=1, pred='Bean')
+        assert add_entry(history) is None and history.id == 3
+        db.session.remove()
+        db.engine.dispose()
+
+
+# test that the probabilities of a history can be filtered on in sql, by the probability and the rank of any label
+@pytest.mark.database
+def test_history_probs(client):
+    img = Image.new('RGB', (31, 31))
+    for carrot, bean in [(0.1, 0.9), (0.3, 0.6), (0.5, 0.4)]:
+        probs = [0.0] * 15
+        probs[0], probs[7] = bean, carrot
+        assert add_entry(History(probs=probs, image=img.tobytes(), image_format='raw', user_id=1, model='31', highest_prob=max(probs), pred='Bean')) is None
+
+    assert db.session.get(History, 2).probs[7] == 0.3
+
+    # carrot at least 20%
+    query = select(History.id).join(HistoryProb).where(HistoryProb.label == 7, HistoryProb.prob >= 0.2).order_by(History.id)
+    assert db.session.scalars(query).all() == [2, 3]
+
+    # carrot as the most probable one
+    query = select(History.id).join(HistoryProb).where(HistoryProb.label == 7, HistoryProb.rank == 1)
+    assert db.session.scalars(query).all() == [3]
+
+
+# the image hash has to stay (nearly) the same for the same image at another size or compressed, and not for another image
+def test_image_hash():
+    imgs = [Image.open(f'{image_dir}/{image}').convert('RGB') for image in images]
+    hashes = [image_hash(img) for img in imgs]
+    assert all(-2 ** 63 <= value < 2 ** 63 for value in hashes)
+
+    for img, value in zip(imgs, hashes):
+        assert hamming_distances([image_hash(img.resize((31, 31)))], value)[0] <= 6
+        decoded = decode_history_image(*encode_history_image(img.resize((128, 128)), 'webp'))
+        assert hamming_distances([image_hash(decoded)], value)[0] <= 6
+    assert min(hamming_distances(hashes[1:], hashes[0])) > 10
+
+    # and the bit count is right for every bit, including the sign
+    assert list(hamming_distances([0, 1, -1, -2 ** 63, 2 ** 63 - 1], 0)) == [0, 1, 64, 1, 63]
+
+
+# test searching the index of hashes, closest first then newest first, and adding to it
+def test_hash_index():
+    index = HashIndex([1, 2, 3, 4], [0b0000, 0b0001, 0b0011, 0b0001])
+    assert index.count == 4 and index.max_id == 4
+    assert index.search(0, limit=10) == [(1, 0), (4, 1), (2, 1), (3, 2)]
+    assert index.search(0, limit=2, exclude=1) == [(4, 1), (2, 1)]
+    assert index.search(0, max_distance=1, exclude=1) == [(4, 1), (2, 1)]
+
+    extended = index.extended([7], [-1])
+    assert extended.count == 5 and extended.max_id == 7 and index.count == 4
+    assert extended.search(-1, limit=1) == [(7, 0)]
+    assert HashIndex([], []).search(0) == []
+
+    # a big one still has to be quick, without decoding a single image
+    rng = np.random.default_rng(0)
+    index = HashIndex(np.arange(1, 100001), rng.integers(-2 ** 63, 2 ** 63 - 1, 100000, dtype=np.int64))
+    start = time.perf_counter()
+    results = index.search(int(index.hashes[500]), limit=12, max_distance=64)
+    assert time.perf_counter() - start < 0.5
+    assert results[0] == (501, 0) and len(results) == 12
+
+
+# decoding a jpeg at a reduced scale (and in gray) has to give nearly the same model input as decoding it whole and resizing it
+# the test images are re-encoded at a couple of sizes, so that both models get to use the reduced decoding
+@pytest.mark.parametrize('image', images)
+@pytest.mark.parametrize('model_input_size', [31, 128])
+@pytest.mark.parametrize('side', [224, 512])
+@pytest.mark.parametrize('color', [True, False])
+def test_reduced_jpeg_decoding(image, model_input_size, side, color, monkeypatch):
+    buffer = io.BytesIO()
+    Image.open(f'{image_dir}/{image}').convert('RGB').resize((side, side)).save(buffer, 'JPEG', quality=90)
+
+    full = transformer(Image.open(io.BytesIO(buffer.getvalue())).resize((model_input_size, model_input_size)), model_input_size)
+    img, error = open_image(io.BytesIO(buffer.getvalue()), model_input_size, color)
+    assert error is None
+    assert img.mode == ('RGB' if color else 'L')
+    if side >= 2 * model_input_size:
+        assert model_input_size <= img.size[0] < side
+
+    reduced = transformer(resize_image(img, model_input_size), model_input_size)
+    assert np.abs(full - reduced).mean() < 0.01 and np.abs(full - reduced).max() < 0.05
+
+    # every filter works, even if they don't all look the same
+    for name in RESIZE_FILTERS:
+        monkeypatch.setattr(BaseConfig, 'RESIZE_FILTER', name)
+        assert resize_image(img, model_input_size).size == (model_input_size, model_input_size)
+
+
+# the sqlite pragmas and the pool from the config, and several threads writing at once without "database is locked"
+@pytest.mark.database
+def test_database_tuning(tmp_path, monkeypatch):
+    app = create_app('TEST')
+    assert 'pool_size' not in app.config['SQLALCHEMY_ENGINE_OPTIONS']      # in memory, one shared connection
+
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "tuned.db"}')
+    monkeypatch.setattr(TestingConfig, 'DB_POOL_SIZE', 3)
+    app = create_app('TEST')
+    with app.app_context():
+        pragma = lambda name: db.session.execute(text(f'pragma {name}')).scalar()
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == 1       # normal
+        assert pragma('busy_timeout') == TestingConfig.SQLITE_BUSY_TIMEOUT
+        assert pragma('cache_size') == TestingConfig.SQLITE_CACHE_SIZE
+        assert pragma('auto_vacuum') == 2       # incremental, since the database is new
+        assert db.engine.pool.size() == 3
+        db.session.add(User(email='writer@test.com', password='Test12345$'))
+        db.session.commit()
+        db.session.remove()
+
+    def write(i):
+        with app.app_context():
+            for j in range(20):
+                history = History(user_id=1, probs=[1.0] + [0.0] * 14, highest_prob=1.0, pred='Bean', image=b'', model='31')
+                assert add_entry(history) is None
+            db.session.remove()
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(write, range(4)))
+
+    with app.app_context():
+        assert db.session.scalar(select(func.count(History.id))) == 80
+        db.session.remove()
+        db.engine.dispose()
+
+
+# the histories older than the retention are purged a chunk at a time, archived first, and the rest are left alone
+# a worker that finds another one purging already skips it
+@pytest.mark.database
+def test_retention_purge(tmp_path, monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "retention.db"}')
+    monkeypatch.setattr(TestingConfig, 'HISTORY_RETENTION_DAYS', 30)
+    monkeypatch.setattr(TestingConfig, 'RETENTION_INTERVAL', 0)        # no thread, run_once is called here instead
+    monkeypatch.setattr(TestingConfig, 'RETENTION_ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setattr(TestingConfig, 'RETENTION_LOCK_FILE', str(tmp_path / 'retention.lock'))
+    monkeypatch.setattr(TestingConfig, 'DELETE_CHUNK_SIZE', 2)
+    app = create_app('TEST')
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with app.app_context():
+        add_entry(User(email='test@test.com', password='Test12345$'))
+        for days in [100, 60, 45, 31, 29, 1]:
+            history = History(user_id=1, probs=[0.9, 0.1] + [0.0] * 13, highest_prob=0.9, pred='Bean', image=b'\1' * 4096, model='31')
+            history.timestamp = now - datetime.timedelta(days=days)
+            add_entry(history)
+
+        # the finished jobs from before JOB_RETENTION_HOURS go too, but never one that is still running
+        for job_id, status, hours in [('a', 'done', 48), ('b', 'failed', 48), ('c', 'done', 1), ('d', 'running', 48)]:
+            add_entry(PredictionJob(id=job_id, model='31', status=status, created=now - datetime.timedelta(hours=hours)))
+        db.session.remove()
+
+    # another worker holds the lock
+    with open(tmp_path / 'retention.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert app.extensions['retention_purger'].run_once() is None
+    assert app.extensions['retention_purger'].run_once() == {'histories' : 4, 'jobs' : 2}
+
+    with app.app_context():
+        assert db.session.scalars(select(History.id).order_by(History.id)).all() == [5, 6]
+        assert db.session.scalars(select(PredictionJob.id).order_by(PredictionJob.id)).all() == ['c', 'd']
+        assert db.session.scalar(select(func.count()).select_from(HistoryProb)) == 2 * 15
+        assert db.session.execute(text('pragma freelist_count')).scalar() == 0     # the space of the purged ones went back to the disk
+        db.session.remove()
+
+    # and everything that was purged is in the archive, in two chunks
+    archives = os.listdir(tmp_path / 'archive')
+    with gzip.open(tmp_path / 'archive' / archives[0], 'rt') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['id'] for line in lines] == [1, 2, 3, 4]
+    assert lines[0]['probabilities']['Bean'] == 0.9 and len(lines[0]['image']) > 4096
+
+    # the cli does the same, with the days given
+    res = app.test_cli_runner().invoke(args=['purge-history', '--days', '10'])
+    assert 'purged: 1 histories' in res.output and 'purged: 0 jobs' in res.output
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+# test that the history writer puts back the spill files of a worker that died while storing them, puts aside a spill file
+# that keeps failing instead of being held up by it for good, and keeps going after a batch that blows up
+@pytest.mark.database
+def test_write_behind_recovery(tmp_path, monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "write_behind.db"}')
+    app = create_app('TEST')
+    with app.app_context():
+        add_entry(User(email='test@test.com', password='Test12345$'))
+        db.session.remove()
+
+    spill = tmp_path / 'spill'
+    writer = HistoryWriter(app, 10, 0.05, 100, str(spill), max_attempts=3)
+    record = {'user_id' : 1, 'highest_prob' : 0.9, 'pred' : 'Bean', 'image' : b'\1' * 16, 'image_format' : 'raw', 'image_width' : 4,
+              'image_height' : 4, 'image_hash' : None, 'model' : '31', 'probs' : [0.9, 0.1] + [0.0] * 13,
+              'timestamp' : datetime.datetime.now(datetime.timezone.utc)}
+
+    # one claimed by a worker that is gone, one by a worker that is still storing it, and one that will never be stored
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    spill.mkdir()
+    (spill / f'a.ndjson.{dead.pid}.replaying').write_text(dump_record(record))
+    (spill / f'b.ndjson.{os.getppid()}.replaying').write_text(dump_record(record))
+    (spill / '0.ndjson').write_text('not json\n')
+
+    def stored():
+        with app.app_context():
+            count = History.query.count()
+            db.session.remove()
+            return count
+
+    # when the writer starts the first is put back, and the bad one fails and holds up the rest: once then,
+    # and again once the first batch is stored
+    writer.put(History(**{name : value for name, value in record.items() if name != 'timestamp'}))
+    writer.join()
+    assert sorted(os.listdir(spill)) == ['0.2.ndjson', 'a.ndjson', f'b.ndjson.{os.getppid()}.replaying']
+    assert stored() == 1
+
+    # a batch that blows up (even when spilling it) doesn't end the thread, and after its third attempt the bad file is put aside
+    with monkeypatch.context() as broken:
+        broken.setattr(writer, 'spill', lambda batch: 1 / 0)
+        broken.setattr('application.writebehind.record_history', lambda record: 1 / 0)
+        writer.put(History(**{name : value for name, value in record.items() if name != 'timestamp'}))
+        writer.join()
+    assert writer._thread.is_alive() and stored() == 1
+
+    writer.put(History(**{name : value for name, value in record.items() if name != 'timestamp'}))
+    writer.join()
+    assert os.listdir(spill / 'quarantine') == ['0.ndjson']
+    assert stored() == 2
+
+    # and with the bad file out of the way, the next one stores the rest
+    writer.put(History(**{name : value for name, value in record.items() if name != 'timestamp'}))
+    writer.join()
+    assert sorted(os.listdir(spill)) == [f'b.ndjson.{os.getppid()}.replaying', 'quarantine']
+    assert stored() == 4
+    writer.shutdown()
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
@@ -3,9 +3,29 @@ import pytest
 import os
 from PIL import Image
 import io
+import json
+import zipfile
+import datetime
+import struct
+import zlib
+import gzip
+import shutil
+import hashlib
+import logging
+import csv
+import threading
 import numpy as np
-from application.models import User, History
-from application.routes.functions import LABELS
+from application.models import User, History, HistoryProb
+from application import create_app, db
+from application.config import TestingConfig
+from application.assets import compress_static, compile_templates
+from application.metrics import MetricsRegistry
+from sqlalchemy import event, update, delete
+from werkzeug.serving import make_server
+from application.routes import functions
+from application.inference import backends
+from application.routes.functions import LABELS, transformer, add_entry, make_history, open_image, resize_image
+from application.inference import FakeBackend, get_backend
 from bs4 import BeautifulSoup
 
 # easily make the soup
@@ -299,6 +319,52 @@ def test_account_deletion(authenticated_client):
     assert user is None
 
 
+# deleting histories: one at a time only for the user's own, the ticked ones, and all the ones matching a search,
+# and then the whole account, with statements that never load the histories
+@pytest.mark.api
+@pytest.mark.database
+def test_bulk_delete_api(authenticated_client):
+    img = Image.open('./tests/test_veg_images/bean.jpg').convert('RGB').resize((31, 31))
+    add_entry(User(email='other@test.com', password='Test12345$'))
+    for i in range(8):
+        probs = [0.0] * 15
+        probs[i % 2] = 1.0
+        add_entry(make_history(img, 31, LABELS[i % 2], probs, 1))
+    add_entry(make_history(img, 31, LABELS[0], [1.0] + [0.0] * 14, 2))
+
+    def remaining(user_id):
+        return sorted(history.id for history in History.query.filter_by(user_id=user_id))
+
+    # someone else's history can't be deleted
+    res = authenticated_client.post('/delete_history/9')
+    assert make_soup(res.data).find('div', {'id' : 'error'}) and remaining(2) == [9]
+    assert authenticated_client.post('/delete_history/1').status_code == 302
+    assert remaining(1) == [2, 3, 4, 5, 6, 7, 8]
+
+    # the ticked ones, where the other user's is left alone
+    assert b'name="history_ids"' in authenticated_client.post('/search', data={'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0}).data
+    res = authenticated_client.post('/delete_histories', data={'history_ids' : ['2', '3', '9']})
+    assert res.status_code == 302 and remaining(1) == [4, 5, 6, 7, 8] and remaining(2) == [9]
+    assert make_soup(authenticated_client.post('/delete_histories').data).find('div', {'id' : 'error'})
+
+    # everything matching the search
+    res = authenticated_client.post('/search/delete', data={'model' : 'Any', 'prediction' : LABELS[1], 'prob_pred' : 0})
+    assert res.status_code == 302 and remaining(1) == [5, 7]
+    assert HistoryProb.query.filter(HistoryProb.history_id.in_([2, 3, 4, 6, 8])).count() == 0
+
+    # and the account, with everything in it
+    queries = []
+    def count_history_loads(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'history.image,' in statement:
+            queries.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count_history_loads)
+    assert authenticated_client.post('/delete_user').status_code == 302
+    event.remove(db.engine, 'before_cursor_execute', count_history_loads)
+    assert queries == [] and User.query.filter_by(email='test@test.com').first() is None
+    assert remaining(1) == [] and HistoryProb.query.filter(HistoryProb.history_id.in_([5, 7])).count() == 0
+    assert remaining(2) == [9]
+
+
 # now test with an authenticated client and then attempt to retrieve the history data
 @pytest.mark.api      
 @pytest.mark.database 
@@ -391,4 +457,702 @@ def test_make_pred_delete(authenticated_client, image, model_input_size):
     history2 = History.query.get(1)
     
     # and then assert that the highest probability is the correct one
-    assert history2 == None
\ No newline at end of file
+    assert history2 == None
+
+
+# the same prediction with the fake backend, so this runs without the model server
+# the history must hold exactly what the backend predicted
+@pytest.mark.api
+@pytest.mark.database
+@pytest.mark.parametrize('model_input_size', [128, 31])
+def test_api_prediction_fake_backend(fake_backends, authenticated_client, model_input_size):
+    data = {}
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        data['image'] = (io.BytesIO(f.read()), 'carrot.jpg')
+    data['model'] = f'{model_input_size} pixels model'
+
+    res = authenticated_client.post('/predict', data=data, content_type='multipart/form-data')
+    assert res.status_code == 200
+
+    # work out what the fake backend says about this image, decoded and resized the same way as an upload
+    img, _ = open_image('./tests/test_veg_images/carrot.jpg', model_input_size)
+    img = resize_image(img, model_input_size)
+    expected = FakeBackend().predict(transformer(img, model_input_size))[0]
+
+    history = History.query.get(1)
+    assert int(history.model) == model_input_size
+    assert np.allclose(history.probs, expected)
+    assert LABELS[np.argmax(expected)].encode() in res.data
+
+    # and the stored image can be shown again
+    res = authenticated_client.get('/history/1')
+    assert res.status_code == 200
+    assert make_soup(res.data).find('div', {'id' : 'error'}) is None
+
+
+# uploading the same image twice should only go to the model once, but still be saved into the history both times
+@pytest.mark.api
+@pytest.mark.database
+def test_prediction_cache_api(fake_backends, authenticated_client):
+    for _ in range(2):
+        data = {}
+        with open('./tests/test_veg_images/bean.jpg', 'rb') as f:
+            data['image'] = (io.BytesIO(f.read()), 'bean.jpg')
+        data['model'] = '31 pixels model'
+        res = authenticated_client.post('/predict', data=data, content_type='multipart/form-data')
+        assert res.status_code == 200
+
+    stats = authenticated_client.application.extensions['prediction_cache'].stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    assert History.query.count() == 2
+    assert History.query.get(1).probs == History.query.get(2).probs
+
+
+# make a prediction through the job api, then long poll the job until it's done, and it must end up in the history
+@pytest.mark.api
+@pytest.mark.database
+def test_api_prediction_job(fake_backends, authenticated_client):
+    data = {}
+    with open('./tests/test_veg_images/pumpkin.jpg', 'rb') as f:
+        data['image'] = (io.BytesIO(f.read()), 'pumpkin.jpg')
+    data['model'] = '128 pixels model'
+
+    res = authenticated_client.post('/api/predict', data=data, content_type='multipart/form-data')
+    assert res.status_code == 202
+    job_id = res.json['job_id']
+    assert res.json['status'] == 'queued'
+
+    res = authenticated_client.get(f'/api/jobs/{job_id}?wait=10')
+    assert res.status_code == 200
+    assert res.json['status'] == 'done'
+
+    # and it's the same as what the history has stored
+    history = History.query.get(res.json['history_id'])
+    assert history.pred == res.json['prediction']
+    assert np.allclose(list(res.json['probabilities'].values()), history.probs)
+
+    # nobody else gets to see it
+    authenticated_client.get('/signout')
+    assert authenticated_client.get(f'/api/jobs/{job_id}').status_code == 404
+
+
+# the job api has the same validation as the prediction page, and unknown jobs are not found
+@pytest.mark.api
+def test_xfail_api_prediction_job(fake_backends, client):
+    data = {}
+    with open('./tests/test_veg_images/pumpkin.jpg', 'rb') as f:
+        data['image'] = (io.BytesIO(f.read()), 'pumpkin.gif')
+    data['model'] = '128 pixels model'
+
+    res = client.post('/api/predict', data=data, content_type='multipart/form-data')
+    assert res.status_code == 400 and res.json['errors']
+    assert client.get('/api/jobs/doesnotexist').status_code == 404
+
+
+# batch upload of a couple of separate images plus a zip, with one image in the zip that is not allowed
+# every image gets its own line back, and the good ones all end up in the history
+@pytest.mark.api
+@pytest.mark.database
+def test_api_prediction_batch(fake_backends, authenticated_client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        for image in images:
+            zip_file.write(f'{image_dir}/{image}', f'crate/{image}')
+        small = io.BytesIO()
+        Image.new('RGB', (20, 20)).save(small, 'PNG')
+        zip_file.writestr('crate/tiny.png', small.getvalue())
+    archive.seek(0)
+
+    data = {'model' : '31 pixels model', 'archive' : (archive, 'crate.zip'), 'images' : []}
+    for image in images[:2]:
+        with open(f'{image_dir}/{image}', 'rb') as f:
+            data['images'].append((io.BytesIO(f.read()), image))
+
+    res = authenticated_client.post('/api/predict/batch', data=data, content_type='multipart/form-data')
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+    results = [line for line in lines[:-1] if 'prediction' in line]
+    failed = [line for line in lines[:-1] if 'errors' in line]
+    assert len(results) == len(images) + 2
+    assert len(failed) == 1 and failed[0]['filename'] == 'crate/tiny.png'
+    assert lines[-1] == {'done' : True, 'images' : len(images) + 3, 'failed' : 1}
+
+    # the history has exactly what was streamed back
+    assert History.query.count() == len(results)
+    for result in results:
+        history = History.query.get(result['history_id'])
+        assert history.pred == result['prediction'] and history.model == '31'
+
+
+# a batch with more images than allowed still gets a line for every image, the ones past the limit with an error
+@pytest.mark.api
+def test_api_prediction_batch_limit(fake_backends, client):
+    client.application.config['BATCH_MAX_IMAGES'] = 3
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        for image in images[:3]:
+            zip_file.write(f'{image_dir}/{image}', f'crate/{image}')
+    archive.seek(0)
+
+    data = {'model' : '31 pixels model', 'archive' : (archive, 'crate.zip'), 'images' : []}
+    for image in images[:2]:
+        with open(f'{image_dir}/{image}', 'rb') as f:
+            data['images'].append((io.BytesIO(f.read()), image))
+
+    res = client.post('/api/predict/batch', data=data, content_type='multipart/form-data')
+    assert res.status_code == 200
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+    # the errors come back straight away and the predictions once their batch is done, so the lines aren't in upload order
+    results = {line['filename'] : line for line in lines[:-1]}
+    assert sorted(results) == sorted(images[:2] + [f'crate/{image}' for image in images[:3]])
+    assert all('prediction' in results[filename] for filename in images[:2] + [f'crate/{images[0]}'])
+    assert all(results[f'crate/{image}']['errors'] == ['Error: Only 3 images are taken per upload'] for image in images[1:3])
+    assert lines[-1] == {'done' : True, 'images' : 5, 'failed' : 2}
+
+
+# the history image comes from its own endpoint, with an etag so that asking for it again gets a 304
+# and only the owner of the history can get it
+@pytest.mark.api
+@pytest.mark.database
+def test_history_image_api(fake_backends, authenticated_client):
+    data = {}
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        data['image'] = (io.BytesIO(f.read()), 'carrot.jpg')
+    data['model'] = '128 pixels model'
+    authenticated_client.post('/predict', data=data, content_type='multipart/form-data')
+
+    # the history page points to it with its version, which is what lets the browser keep it for good
+    url = make_soup(authenticated_client.get('/history/1').data).find('img', {'id' : 'img'})['src']
+    assert url.startswith('/history/1/image?v=')
+    assert url.encode() in authenticated_client.post('/search', data={'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0}).data
+
+    res = authenticated_client.get(url)
+    assert res.status_code == 200
+    assert res.mimetype.startswith('image/')
+    assert Image.open(io.BytesIO(res.data)).size == (128, 128)
+    assert 'immutable' in res.headers['Cache-Control']
+
+    etag = res.headers['ETag']
+    res = authenticated_client.get(url, headers={'If-None-Match' : etag})
+    assert res.status_code == 304 and res.data == b''
+
+    # without the version (or with an old one) it has to be checked again every time
+    assert authenticated_client.get('/history/1/image').headers['Cache-Control'] == 'private, no-cache'
+    assert authenticated_client.get('/history/1/image?v=0').headers['Cache-Control'] == 'private, no-cache'
+
+    # another image under the same id (like one made after a delete, before autoincrement) gets another etag
+    db.session.execute(update(History).where(History.id == 1).values(timestamp=datetime.datetime(2020, 1, 1)))
+    db.session.commit()
+    res = authenticated_client.get(url, headers={'If-None-Match' : etag})
+    assert res.status_code == 200 and res.headers['ETag'] != etag and res.headers['Cache-Control'] == 'private, no-cache'
+
+    assert authenticated_client.get('/history/2/image').status_code == 404
+    authenticated_client.get('/signout')
+    assert authenticated_client.get('/history/1/image').status_code != 200
+
+
+# go through the search results page by page, every history must show up exactly once, newest first
+# most of them are made in the same second, so the ties have to be broken properly as well
+@pytest.mark.api
+@pytest.mark.database
+def test_search_pagination_api(authenticated_client):
+    authenticated_client.application.config['SEARCH_PAGE_SIZE'] = 3
+    img = Image.open('./tests/test_veg_images/bean.jpg').resize((31, 31))
+    for i in range(8):
+        probs = [0.0] * 15
+        probs[i % 2] = 0.5 + i / 20
+        add_entry(make_history(img, 31, LABELS[i % 2], probs, 1))
+
+    # an unrelated user's history that must never show up
+    other = User(email='other@test.com', password='Test12345$')
+    add_entry(other)
+    add_entry(make_history(img, 31, LABELS[0], [1.0] + [0.0] * 14, other.id))
+
+    def search(data):
+        soup = make_soup(authenticated_client.post('/search', data=data).data)
+        ids = [int(form['action'].split('/')[-1]) for form in soup.find_all('form', {'name' : 'get_history'})]
+        after = soup.find('form', {'name' : 'next_page'})
+        return ids, (after.find('input', {'name' : 'after'})['value'] if after else None)
+
+    seen, after = [], ''
+    while after is not None:
+        ids, after = search({'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'after' : after})
+        assert len(ids) <= 3
+        seen += ids
+    assert seen == list(range(8, 0, -1))
+
+    # and the filters still work together with the pages
+    seen, after = [], ''
+    while after is not None:
+        ids, after = search({'model' : '31 pixels model', 'prediction' : LABELS[1], 'prob_pred' : 70, 'after' : after})
+        seen += ids
+    assert seen == [8, 6]
+
+    # the last history of a page being deleted before the next page is asked for doesn't end the pages early
+    ids, after = search({'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'after' : ''})
+    assert ids == [8, 7, 6]
+    db.session.execute(delete(History).where(History.id == 6))
+    db.session.commit()
+    ids, after = search({'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'after' : after})
+    assert ids == [5, 4, 3]
+
+    # and a cursor the search didn't make is an error, not a page
+    res = authenticated_client.post('/search', data={'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'after' : 'nope'})
+    assert b'Error: Invalid page' in res.data
+
+
+# the filters on the whole distribution: a label in the top k, a minimum probability for a label,
+# the margin between the top 2 and the date range, each of them on its own and together
+@pytest.mark.api
+@pytest.mark.database
+def test_search_advanced_filters_api(authenticated_client):
+    img = Image.open('./tests/test_veg_images/bean.jpg').resize((31, 31))
+    seeds = [
+        # probabilities of the first 3 labels, and the day it was made
+        ([0.6, 0.3, 0.1], datetime.datetime(2024, 1, 1, 0, 0, 0)),
+        ([0.5, 0.45, 0.05], datetime.datetime(2024, 1, 2, 12, 0, 0)),
+        ([0.1, 0.2, 0.7], datetime.datetime(2024, 1, 2, 23, 59, 59)),
+        ([0.9, 0.03, 0.07], datetime.datetime(2024, 1, 3, 0, 0, 0)),
+    ]
+    for probs, timestamp in seeds:
+        probs = probs + [0.0] * 12
+        history = make_history(img, 31, LABELS[probs.index(max(probs))], probs, 1)
+        history.timestamp = timestamp
+        add_entry(history)
+
+    def search(**filters):
+        data = {'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0}
+        data.update(filters)
+        res = authenticated_client.post('/search', data=data)
+        soup = make_soup(res.data)
+        return sorted(int(form['action'].split('/')[-1]) for form in soup.find_all('form', {'name' : 'get_history'}))
+
+    assert search() == [1, 2, 3, 4]
+    assert search(label=LABELS[1], top_k=2) == [1, 2, 3]
+    assert search(label=LABELS[1], top_k=1) == []
+    assert search(label=LABELS[2], label_prob=50) == [3]
+    assert search(label=LABELS[1], top_k=2, label_prob=25) == [1, 2]
+    assert search(max_margin=10) == [2]
+    assert search(max_margin=50) == [1, 2, 3]
+    assert search(date_from='2024-01-02', date_to='2024-01-02') == [2, 3]
+    assert search(date_from='2024-01-01', date_to='2024-01-01') == [1]
+    assert search(date_from='2024-01-03') == [4]
+    assert search(date_to='2024-01-02', label=LABELS[0], top_k=1) == [1, 2]
+
+    # the label filters need a label, and the dates have to be in order
+    assert b'Select a label' in authenticated_client.post('/search', data={'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'top_k' : 2}).data
+    assert b'end date' in authenticated_client.post('/search', data={'model' : 'Any', 'prediction' : 'Any', 'prob_pred' : 0, 'date_from' : '2024-01-03', 'date_to' : '2024-01-01'}).data
+
+
+# the export has every history of the user and only theirs, read from the database a few at a time
+@pytest.mark.api
+@pytest.mark.database
+def test_export_history_api(authenticated_client):
+    authenticated_client.application.config['EXPORT_CHUNK_SIZE'] = 2
+    img = Image.open('./tests/test_veg_images/carrot.jpg').convert('RGB')
+    add_entry(User(email='other@test.com', password='Test12345$'))
+    for i in range(5):
+        probs = [0.0] * 15
+        probs[i], probs[i + 1] = 0.75, 0.25
+        add_entry(make_history(img.resize((31, 31)), 31, LABELS[i], probs, 1))
+    add_entry(make_history(img.resize((31, 31)), 31, LABELS[0], [1.0] + [0.0] * 14, 2))
+
+    res = authenticated_client.get('/history/export.csv')
+    assert res.status_code == 200 and res.is_streamed and res.mimetype == 'text/csv'
+    assert res.headers['Content-Disposition'] == 'attachment; filename=history.csv'
+    rows = list(csv.DictReader(io.StringIO(res.data.decode())))
+    assert [int(row['id']) for row in rows] == [1, 2, 3, 4, 5]
+    assert [row['prediction'] for row in rows] == LABELS[:5]
+    assert float(rows[2][LABELS[2]]) == 0.75 and float(rows[2][LABELS[3]]) == 0.25 and float(rows[2][LABELS[0]]) == 0
+
+    res = authenticated_client.get('/history/export.ndjson')
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+    assert [line['id'] for line in lines] == [1, 2, 3, 4, 5]
+    assert lines[4]['probability'] == 0.75 and lines[4]['probabilities'][LABELS[5]] == 0.25
+
+    # the zip has the images, and the csv at the end
+    res = authenticated_client.get('/history/export.zip')
+    with zipfile.ZipFile(io.BytesIO(res.data)) as zip_file:
+        names = zip_file.namelist()
+        # the images keep the format they are stored in when the browser can show it
+        assert [name.rsplit('.', 1)[0] for name in names] == [f'images/{i + 1}_{LABELS[i]}' for i in range(5)] + ['history']
+        assert Image.open(zip_file.open(names[0])).size == (31, 31)
+        assert zip_file.read('history.csv') == authenticated_client.get('/history/export.csv').data
+
+    # any other format is just a history that doesn't exist
+    assert 'Content-Disposition' not in authenticated_client.get('/history/export.xml').headers
+    authenticated_client.get('/signout')
+    assert authenticated_client.get('/history/export.csv').status_code == 401
+
+
+# the similar images of a history: the same photo at the other model size or slightly changed shows up first,
+# other photos don't, and the index keeps up with new and deleted histories
+@pytest.mark.database
+def test_similar_histories(authenticated_client):
+    bean = Image.open('./tests/test_veg_images/bean.jpg').convert('RGB')
+    carrot = Image.open('./tests/test_veg_images/carrot.jpg').convert('RGB')
+    probs = [1.0] + [0.0] * 14
+    add_entry(make_history(bean.resize((31, 31)), 31, LABELS[0], probs, 1))
+    add_entry(make_history(bean.resize((128, 128)), 128, LABELS[0], probs, 1))
+    add_entry(make_history(carrot.resize((128, 128)), 128, LABELS[0], probs, 1))
+
+    def similar(history_id):
+        soup = make_soup(authenticated_client.get(f'/history/{history_id}/similar').data)
+        return [int(form['action'].split('/')[-1]) for form in soup.find_all('form', {'name' : 'get_history'})]
+
+    assert similar(1) == [2]
+    assert similar(3) == []
+    assert b'/history/1/similar' in authenticated_client.get('/history/1').data
+
+    # a new one shows up straight away, and a deleted one is gone
+    add_entry(make_history(bean.rotate(2).resize((128, 128)), 128, LABELS[0], probs, 1))
+    assert sorted(similar(1)) == [2, 4]
+    authenticated_client.post('/delete_history/2')
+    assert similar(1) == [4]
+
+    # another user's histories are never searched
+    other = User(email='other@test.com', password='Test12345$')
+    add_entry(other)
+    add_entry(make_history(bean.resize((31, 31)), 31, LABELS[0], probs, other.id))
+    assert similar(1) == [4]
+    assert b'Result is not available' in authenticated_client.get('/history/5/similar').data
+
+    # another worker deleting one and adding one keeps the count the same, the index still has to notice
+    db.session.execute(delete(HistoryProb).where(HistoryProb.history_id == 4))
+    db.session.execute(delete(History).where(History.id == 4))
+    db.session.commit()
+    add_entry(make_history(bean.rotate(1).resize((128, 128)), 128, LABELS[0], probs, 1))
+    assert similar(1) == [6]
+
+
+# the upload pipeline: an image is decoded only once, and anything not allowed is rejected from its header alone,
+# including decompression bombs, while bodies over MAX_CONTENT_LENGTH are refused outright
+@pytest.mark.api
+def test_upload_pipeline_api(fake_backends, client, monkeypatch):
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        carrot = f.read()
+
+    # a png that only has a header, which claims whatever size it's told, followed by junk instead of pixels
+    def png_header(width, height):
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+        return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + chunk(b'IDAT', b'junk')
+
+    def predict(image, filename, url='/predict'):
+        return client.post(url, data={'image' : (io.BytesIO(image), filename), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+
+    # count the decodes of a good upload
+    opened = []
+    original_open = Image.open
+    monkeypatch.setattr(Image, 'open', lambda *args, **kwargs: opened.append(args) or original_open(*args, **kwargs))
+    res = predict(carrot, 'carrot.jpg')
+    assert res.status_code == 200 and make_soup(res.data).find('div', {'id' : 'error'}) is None
+    assert len(opened) == 1
+
+    # the size is checked from the header, the junk pixels never get decoded
+    assert b'must not exceed the specified width/height' in predict(png_header(2000, 2000), 'big.png').data
+    assert b'too many pixels' in predict(png_header(20000, 20000), 'bomb.png').data
+    assert b'Not a readable image' in predict(png_header(128, 128), 'broken.png').data
+    assert b'Not a readable image' in predict(b'not an image at all', 'text.png').data
+
+    # the gif decoder is never even tried, whatever the file is called
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(buffer, 'GIF')
+    assert b'Not a readable image' in predict(buffer.getvalue(), 'gif.png').data
+
+    # too big a body, as a page for the website and as json for the api
+    client.application.config['MAX_CONTENT_LENGTH'] = len(carrot) // 2
+    res = predict(carrot, 'carrot.jpg')
+    assert res.status_code == 413 and b'Upload is too large' in res.data
+    res = predict(carrot, 'carrot.jpg', '/api/predict')
+    assert res.status_code == 413 and res.json['errors'] == ['Error 413: Upload is too large']
+
+
+# the signed in user comes from the cache, so pages don't query the user table at all,
+# while a changed email or password and a deleted account show up straight away
+# this one makes its own app without holding an app context, otherwise flask login would keep the user in g between the requests
+@pytest.mark.api
+@pytest.mark.database
+def test_user_cache_api():
+    app = create_app('TEST')
+    with app.app_context():
+        add_entry(User(email='test@test.com', password='Test12345$'))
+        engine = db.engine
+
+    queries = []
+    def count_user_queries(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM user' in statement:
+            queries.append(statement)
+    event.listen(engine, 'before_cursor_execute', count_user_queries)
+
+    client = app.test_client()
+    client.post('/signin', data={'email' : 'test@test.com', 'password' : 'Test12345$'})
+    queries.clear()
+
+    # only the first page has to get the user
+    for page in ['/', '/setting', '/search']:
+        assert client.get(page).status_code == 200
+    cache = app.extensions['user_cache']
+    assert len(queries) == 1 and cache.misses == 1 and cache.hits == 2
+
+    # changing the email checks the current one against the cached user, and the next request sees the new one
+    res = client.post('/changeEmail', data={'current_email' : 'test@test.com', 'new_email' : 'new@test.com'})
+    assert b'Email changed successfully' in res.data
+    res = client.post('/changeEmail', data={'current_email' : 'new@test.com', 'new_email' : 'newer@test.com'})
+    assert b'Email changed successfully' in res.data
+    assert len(queries) == 2    # the one miss after the first change
+    with app.app_context():
+        assert db.session.get(User, 1).email == 'newer@test.com'
+
+    # and once the account is gone, so is the user of the session
+    client.post('/delete_user')
+    assert client.get('/setting').status_code == 401
+    event.remove(engine, 'before_cursor_execute', count_user_queries)
+
+
+# the static files: the url has the hash of the file, which lets the browser keep it for good,
+# and the compressed copy is sent to the browsers that take it
+def test_static_assets(client, tmp_path):
+    app = client.application
+    shutil.copy(os.path.join(app.static_folder, 'main.css'), tmp_path / 'main.css')
+    app.static_folder = str(tmp_path)
+    with open(tmp_path / 'main.css', 'rb') as f:
+        css = f.read()
+
+    link = make_soup(client.get('/').data).find('link', {'rel' : 'stylesheet', 'href' : lambda href: href.startswith('/static/')})['href']
+    assert link == f'/static/main.css?v={hashlib.sha256(css).hexdigest()[:12]}'
+
+    res = client.get(link)
+    assert res.data == css and 'Content-Encoding' not in res.headers
+    assert res.cache_control.immutable and res.cache_control.max_age == app.config['STATIC_MAX_AGE']
+    assert not client.get('/static/main.css').cache_control.immutable
+    assert not client.get('/static/main.css?v=outdated').cache_control.immutable
+
+    # once compressed, the copy goes to whoever takes gzip, and everyone else still gets the file itself
+    assert compress_static(str(tmp_path)) == [str(tmp_path / 'main.css.gz')]
+    assert compress_static(str(tmp_path)) == []
+    res = client.get(link, headers={'Accept-Encoding' : 'gzip, deflate'})
+    assert res.headers['Content-Encoding'] == 'gzip' and res.mimetype == 'text/css'
+    assert gzip.decompress(res.data) == css and len(res.data) < len(css)
+    assert 'Accept-Encoding' in res.headers['Vary']
+    assert client.get(link).data == css
+
+    assert client.get('/static/missing.css').status_code == 404
+    assert client.get('/static/../__init__.py').status_code == 404
+
+
+# the compiled templates are kept in the shared folder
+def test_template_bytecode_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'JINJA_CACHE_DIR', str(tmp_path))
+    app = create_app('TEST')
+    templates = os.listdir(os.path.join(app.root_path, app.template_folder))
+    assert compile_templates(app) == len(templates)
+    assert len(os.listdir(tmp_path)) == len(templates)
+
+
+# the stages of a prediction show up on /metrics and in the request log, added up with the numbers the other workers left in the folder
+@pytest.mark.api
+def test_metrics_api(fake_backends, client, tmp_path, caplog):
+    client.application.config.update(METRICS_DIR=str(tmp_path), METRICS_FLUSH_INTERVAL=0, REQUEST_LOG=True)
+
+    def read_metrics():
+        values = {}
+        for line in client.get('/metrics').data.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    before = read_metrics()
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        data = {'image' : (io.BytesIO(f.read()), 'carrot.jpg'), 'model' : '31 pixels model'}
+    with caplog.at_level(logging.INFO, logger='application.requests'):
+        assert client.post('/predict', data=data, content_type='multipart/form-data').status_code == 200
+    after = read_metrics()
+
+    for stage in ['validate', 'decode', 'resize', 'transform', 'model', 'render']:
+        name = f'vegclf_stage_seconds_count{{stage="{stage}"}}'
+        assert after[name] - before.get(name, 0) == 1
+        assert after[f'vegclf_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}'] == after[name]
+    assert after['vegclf_requests_total{endpoint="routes.predict",method="POST",status="200"}'] - before.get('vegclf_requests_total{endpoint="routes.predict",method="POST",status="200"}', 0) == 1
+
+    # the caches' own counters are there too, the prediction was a miss and the same image again is a hit
+    stats = client.application.extensions['prediction_cache'].stats()
+    assert after['vegclf_cache_misses_total{cache="prediction"}'] == stats['misses'] and after['vegclf_cache_items{cache="prediction"}'] == stats['items']
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        client.post('/predict', data={'image' : (io.BytesIO(f.read()), 'carrot.jpg'), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+    assert read_metrics()['vegclf_cache_hits_total{cache="prediction"}'] == after.get('vegclf_cache_hits_total{cache="prediction"}', 0) + 1
+
+    # the log line of the request, with its stages
+    line = json.loads([record.getMessage() for record in caplog.records if record.name == 'application.requests'][-1])
+    assert line['endpoint'] == 'routes.predict' and line['status'] == 200
+    assert set(line['stages_ms']) >= {'validate', 'decode', 'model', 'render'} and line['duration_ms'] >= line['stages_ms']['model']
+
+    # this worker's numbers are in the folder for the others, and another worker's are added on
+    assert os.path.isfile(tmp_path / f'{os.getpid()}.json')
+    other = MetricsRegistry()
+    other.observe('vegclf_stage_seconds', {'stage' : 'model'}, 0.2)
+    with open(tmp_path / '999999.json', 'w') as f:
+        json.dump(other.snapshot(), f)
+    with open(tmp_path / '999998.json', 'w') as f:
+        f.write('{broken')
+    combined = read_metrics()
+    assert combined['vegclf_stage_seconds_count{stage="model"}'] == after['vegclf_stage_seconds_count{stage="model"}'] + 1
+    assert combined['vegclf_stage_seconds_bucket{stage="model",le="0.25"}'] >= after['vegclf_stage_seconds_bucket{stage="model",le="0.25"}'] + 1
+
+
+# the load generator against a real server: the users get seeded, every action of the mix works, and the results get saved
+# like the user cache test, the app is its own so that the server's requests don't share the user in g
+@pytest.mark.api
+@pytest.mark.database
+def test_bench_command(fake_backends, tmp_path):
+    app = create_app('TEST')
+    server = make_server('127.0.0.1', 0, app)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        res = app.test_cli_runner().invoke(args=['bench', '--url', f'http://127.0.0.1:{server.server_port}', '--duration', '2',
+                                                 '--concurrency', '1', '--users', '2', '--histories', '5', '--output', str(tmp_path / 'bench.json')])
+    finally:
+        server.shutdown()
+    assert res.exit_code == 0, res.output
+
+    with open(tmp_path / 'bench.json') as f:
+        results = json.load(f)
+    assert results['total']['requests'] > 0 and results['total']['errors'] == 0
+    assert results['signin']['requests'] >= 1
+
+    with app.app_context():
+        users = User.query.filter(User.email.like('loadtest%')).all()
+        assert len(users) == 2
+        # with a single client only the first user was signed in as, the other one still has just its seeded histories
+        assert History.query.filter_by(user_id=users[1].id).count() == 5
+
+    # an action that doesn't exist
+    res = app.test_cli_runner().invoke(args=['bench', '--mix', 'nothing=1'])
+    assert res.exit_code != 0 and 'nothing=1' in res.output
+
+
+# with write behind the prediction page doesn't store the history itself: the writer does, a batch at a time,
+# spilling a batch it can't store into a file and storing it later, and storing whatever is left when it shuts down
+@pytest.mark.api
+@pytest.mark.database
+def test_write_behind_api(fake_backends, tmp_path, monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', f'sqlite:///{tmp_path / "write_behind.db"}')
+    monkeypatch.setattr(TestingConfig, 'HISTORY_WRITE_BEHIND', True)
+    monkeypatch.setattr(TestingConfig, 'WRITE_BEHIND_BATCH_SIZE', 3)
+    monkeypatch.setattr(TestingConfig, 'WRITE_BEHIND_INTERVAL_MS', 1000)
+    monkeypatch.setattr(TestingConfig, 'WRITE_BEHIND_SPILL_DIR', str(tmp_path / 'spill'))
+    app = create_app('TEST')
+    with app.app_context():
+        add_entry(User(email='test@test.com', password='Test12345$'))
+        writer = functions.get_history_writer()
+
+    client = app.test_client()
+    client.post('/signin', data={'email' : 'test@test.com', 'password' : 'Test12345$'})
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        data = f.read()
+
+    def predict():
+        res = client.post('/predict', data={'image' : (io.BytesIO(data), 'carrot.jpg'), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+        assert res.status_code == 200 and not make_soup(res.data).find('div', {'id' : 'error'})
+
+    def stored():
+        with app.app_context():
+            count = History.query.filter_by(user_id=1).count()
+            db.session.remove()
+            return count
+
+    # nothing is stored until there's a whole batch (or the interval is up)
+    predict()
+    predict()
+    assert stored() == 0
+    predict()
+    writer.join()
+    assert stored() == 3
+
+    # a batch that fails goes into the spill folder, and is stored along with the next batch that works
+    with monkeypatch.context() as failing:
+        failing.setattr(functions, 'add_entries', lambda entries: Exception('database is locked'))
+        predict()
+        writer.join()
+    assert stored() == 3 and len(os.listdir(tmp_path / 'spill')) == 1
+    predict()
+    writer.join()
+    assert stored() == 5 and os.listdir(tmp_path / 'spill') == []
+
+    # and shutting down stores what is left without waiting for the interval
+    predict()
+    writer.shutdown()
+    assert stored() == 6
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+
+# test that the prediction page and the api fail fast while the model server is down, and that /healthz says so
+@pytest.mark.api
+def test_healthz_api(model_server, monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'MODEL_BACKENDS', {
+        'model_31' : {'type' : 'remote', 'url' : model_server.url},
+        'model_128' : {'type' : 'fake'}
+    })
+    monkeypatch.setattr(TestingConfig, 'MODEL_SERVER_RETRIES', 0)
+    monkeypatch.setattr(TestingConfig, 'MODEL_BREAKER_MIN_REQUESTS', 3)
+    monkeypatch.setattr(TestingConfig, 'PREDICTION_CACHE_SIZE', 0)
+    monkeypatch.setattr(backends, '_session', None)
+    app = create_app('TEST')
+    client = app.test_client()
+    with open('./tests/test_veg_images/carrot.jpg', 'rb') as f:
+        data = f.read()
+
+    def predict():
+        res = client.post('/predict', data={'image' : (io.BytesIO(data), 'carrot.jpg'), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+        assert res.status_code == 200
+        error = make_soup(res.data).find('div', {'id' : 'error'})
+        return error.text.strip() if error else None
+
+    res = client.get('/healthz')
+    assert res.status_code == 200 and res.json['status'] == 'ok' and res.json['database']['ready']
+    assert res.json['models']['model_31']['circuit']['state'] == 'closed'
+    assert 'circuit' not in res.json['models']['model_128']
+
+    # the warm up ping goes to the model server like any prediction
+    assert app.extensions['model_warmer'].ping_all()['model_31']['ok']
+    assert len(model_server.requests) == 1 and 'model_128' not in app.extensions['model_warmer'].pings
+
+    # the model server goes down, the page shows an error instead of crashing, and once two of the three so far failed it isn't even asked
+    model_server.failures = 100
+    assert predict().startswith('Error: The model could not make the prediction')
+    assert predict().startswith('Error: The model could not make the prediction')
+    assert predict().startswith('Error: The model is not available right now')
+    assert len(model_server.requests) == 3
+
+    res = client.post('/api/predict', data={'image' : (io.BytesIO(data), 'carrot.jpg'), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+    # the time left on the breaker's cooldown rounded up, not the whole cooldown
+    assert res.status_code == 503 and 1 <= int(res.headers['Retry-After']) <= 30
+    with app.app_context():
+        get_backend(31).breaker._opened -= 20.5
+    res = client.post('/api/predict', data={'image' : (io.BytesIO(data), 'carrot.jpg'), 'model' : '31 pixels model'}, content_type='multipart/form-data')
+    assert res.status_code == 503 and res.headers['Retry-After'] == '10'
+    assert len(model_server.requests) == 3
+
+    # the other model is still fine
+    res = client.post('/predict', data={'image' : (io.BytesIO(data), 'carrot.jpg'), 'model' : '128 pixels model'}, content_type='multipart/form-data')
+    assert not make_soup(res.data).find('div', {'id' : 'error'})
+
+    res = client.get('/healthz')
+    assert res.status_code == 200 and res.json['status'] == 'degraded'
+    assert not res.json['models']['model_31']['ready'] and res.json['models']['model_128']['ready']
+    assert res.json['models']['model_31']['circuit']['state'] == 'open'
+    assert res.json['models']['model_31']['last_ping']['ok']
+
+    # while the database being gone makes it unhealthy
+    with monkeypatch.context() as broken:
+        broken.setattr(db.session, 'execute', lambda *args: (_ for _ in ()).throw(Exception('database is gone')))
+        res = client.get('/healthz')
+    assert res.status_code == 503 and res.json['status'] == 'unhealthy'